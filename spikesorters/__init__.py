@@ -1,5 +1,9 @@
 from .sorterlist import *
 from .version import version as __version__
 from .basesorter import BaseSorter
-from .launcher import run_sorters, collect_sorting_outputs, iter_output_folders, iter_sorting_output
+from .sorting_cache import SortingCache
+from .task_queue import TaskQueue
+from .run_catalog import RunCatalog
+from .launcher import run_sorters, iter_run_sorters, run_sorter_sweep, collect_sorting_outputs, iter_output_folders, \
+    iter_sorting_output, LazySortingOutputs
 
@@ -17,6 +17,7 @@ a way to adapt params with datasets.
 
 """
 
+import os
 import time
 import copy
 from pathlib import Path
@@ -25,13 +26,20 @@ import json
 import traceback
 import shutil
 import warnings
-from joblib import Parallel, delayed
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from joblib import Parallel, delayed, effective_n_jobs
 
 import numpy as np
 
 import spikeextractors as se
 from spikeextractors.baseextractor import _check_json
-from .sorter_tools import SpikeSortingError
+from .sorter_tools import SpikeSortingError, SpikeSortingTimeoutError, recover_recording
+from .export_store import BinaryExportStore
+from .spike_store import spike_store_folder_name, write_spike_store, has_spike_store, SpikeStoreSortingExtractor
+from .group_export import write_group_exports
 
 
 class BaseSorter:
@@ -39,13 +47,28 @@ class BaseSorter:
     SortingExtractor_Class = None  # convinience to get the extractor
     requires_locations = False
     compatible_with_parallel = {'loky': True, 'multiprocessing': True, 'threading': True}
+    # rough peak memory of a run, used by the scheduler of run_sorters:
+    # memory_base_gb + memory_factor * size of the traces in memory
+    memory_base_gb = 0.5
+    memory_factor = 1.
+    # input file written by _setup_recording for each group (relative to the output folder), in format
+    # 'dat' or 'mda' with export_dtype (None: dtype of the recording). With grouping_property, run() writes
+    # the files of all groups in a single pass over the recording and the setups reuse them
+    export_file_name = None
+    export_format = 'dat'
+    export_dtype = 'int16'
+    # params read by _setup_recording (which must not change self.params): run_sorter_sweep does one setup for
+    # the grid points with the same values of these params and copies it in their folders (None: one setup per
+    # point). The setup files matching setup_data_files are hardlinked instead of copied: _run must only read them
+    setup_params = None
+    setup_data_files = []
     _default_params = {}
     _params_description = {}
     sorter_description = ""
     installation_mesg = ""  # error message when not installed
 
     def __init__(self, recording=None, output_folder=None, verbose=False,
-                 grouping_property=None, delete_output_folder=False):
+                 grouping_property=None, delete_output_folder=False, export_folder=None):
 
         assert self.is_installed(), """The sorter {} is not installed.
         Please install it with:  \n{} """.format(self.sorter_name, self.installation_mesg)
@@ -68,6 +91,7 @@ class BaseSorter:
 
         if grouping_property is None:
             # only one groups
+            self._parent_recording = None
             self.recording_list = [recording]
             self.output_folders = [output_folder]
             if 'group' in recording.get_shared_channel_property_names():
@@ -79,6 +103,7 @@ class BaseSorter:
             # several groups
             if grouping_property not in recording.get_shared_channel_property_names():
                 raise RuntimeError(f"'{grouping_property}' is not one of the channel properties.")
+            self._parent_recording = recording
             self.recording_list = recording.get_sub_extractors_by_property(grouping_property)
             n_group = len(self.recording_list)
             self.output_folders = [output_folder / str(i) for i in range(n_group)]
@@ -97,6 +122,29 @@ class BaseSorter:
 
         self.delete_folders = delete_output_folder
 
+        # binary exports shared with other sorters
+        if export_folder is None:
+            self.export_store = None
+        else:
+            self.export_store = BinaryExportStore(export_folder)
+        self._exported_files = []
+        # files written by _write_group_exports: {absolute path: dtype name}
+        self._prewritten_exports = {}
+
+        # limits of the shell scripts of the sorter (in s), set by run()
+        self.timeout = None
+        self.inactivity_timeout = None
+
+    @classmethod
+    def estimate_memory_gb(cls, recording):
+        """
+        Rough estimate of the peak memory (in GB) used to sort recording, from its number of frames,
+        number of channels and dtype.
+        """
+        itemsize = recording.get_traces(start_frame=0, end_frame=1).dtype.itemsize
+        traces_size_gb = recording.get_num_frames() * recording.get_num_channels() * itemsize / 1024 ** 3
+        return cls.memory_base_gb + cls.memory_factor * traces_size_gb
+
     @classmethod
     def default_params(cls):
         return copy.deepcopy(cls._default_params)
@@ -125,12 +173,74 @@ class BaseSorter:
                 params['recording'] = recording.make_serialized_dict()
                 json.dump(_check_json(params), f, indent=4)
 
-    def run(self, raise_error=True, parallel=False, n_jobs=-1, joblib_backend='loky'):
-        for i, recording in enumerate(self.recording_list):
-            self._setup_recording(recording, self.output_folders[i])
+    def run(self, raise_error=True, parallel=False, n_jobs=-1, joblib_backend='loky', n_jobs_io=4,
+            pipeline_depth=None, timeout=None, inactivity_timeout=None, submit_time=None, skip_setup=False):
+        # submit_time: wall clock time when a launcher submitted the run, the time waited before run() is part
+        # of the queue_wait of each group
+        # skip_setup: the output folders already contain the setup (copied with _copy_setup)
+        launcher_wait = 0. if submit_time is None else max(0., time.time() - submit_time)
 
-        # dump again params because some sorter do a folder reset (tdc)
-        self._dump_params()
+        if parallel:
+            assert self.compatible_with_parallel[joblib_backend], f"{self.sorter_name} is not compatible with " \
+                                                                  f"joblib {joblib_backend} backend"
+
+        if parallel and len(self.recording_list) > 1:
+            if not np.all([recording.check_if_dumpable() for recording in self.recording_list]):
+                raise RuntimeError("RecordingExtractor objects are not dumpable and can't be processed in parallel. "
+                                   "Use parallel=False")
+
+        # a shell based sorter is stopped when it runs longer than timeout (for each group) or when its log is
+        # not written for more than inactivity_timeout
+        self.timeout = timeout
+        self.inactivity_timeout = inactivity_timeout
+
+        # with a pipeline, the setup of the next groups is done while the first ones are sorted
+        pipelined = pipeline_depth is not None and len(self.recording_list) > 1 and not skip_setup
+
+        # time spent in each stage for each group (in s)
+        self._timing = [dict() for _ in self.recording_list]
+
+        # resources of the shell scripts are written by ShellScript next to the sorter log
+        for output_folder in self.output_folders:
+            resource_path = output_folder / f'{self.sorter_name}_resources.json'
+            if resource_path.is_file():
+                resource_path.unlink()
+            # the spike store of a previous run must not be loaded instead of the new output
+            spike_store_folder = output_folder / spike_store_folder_name
+            if spike_store_folder.is_dir():
+                shutil.rmtree(str(spike_store_folder))
+
+        # with a pipeline the exports are written group by group to bound the disk used
+        self._prewritten_exports = {}
+        if not pipelined and not skip_setup and self._can_write_group_exports():
+            t_export = time.perf_counter()
+            self._write_group_exports()
+            group_export_time = time.perf_counter() - t_export
+            for i in range(len(self.recording_list)):
+                self._timing[i]['group_export'] = group_export_time
+
+        if not pipelined and not skip_setup:
+            if not parallel or len(self.recording_list) == 1:
+                for i, recording in enumerate(self.recording_list):
+                    t_setup = time.perf_counter()
+                    self._setup_recording(recording, self.output_folders[i])
+                    self._timing[i]['setup'] = time.perf_counter() - t_setup
+            else:
+                # the exports are I/O bound: at most n_jobs_io setups at the same time
+                n_jobs_setup = effective_n_jobs(n_jobs)
+                if n_jobs_io is not None:
+                    n_jobs_setup = min(n_jobs_setup, n_jobs_io)
+                runner = self._make_runner()
+                outputs = Parallel(n_jobs=n_jobs_setup, backend=joblib_backend)(
+                    delayed(runner._setup_recording_copy)(rec.dump_to_dict(), output_folder)
+                    for (rec, output_folder) in zip(self.recording_list, self.output_folders))
+                for i, (params, exported_files, setup_time) in enumerate(outputs):
+                    self.params = params
+                    self._exported_files.extend(exported_files)
+                    self._timing[i]['setup'] = setup_time
+
+            # dump again params because some sorter do a folder reset (tdc)
+            self._dump_params()
 
         now = datetime.datetime.now()
 
@@ -143,37 +253,50 @@ class BaseSorter:
 
         t0 = time.perf_counter()
 
-        if parallel:
-            assert self.compatible_with_parallel[joblib_backend], f"{self.sorter_name} is not compatible with " \
-                                                                  f"joblib {joblib_backend} backend"
-
-        if parallel and len(self.recording_list) > 1:
-            if not np.all([recording.check_if_dumpable() for recording in self.recording_list]):
-                raise RuntimeError("RecordingExtractor objects are not dumpable and can't be processed in parallel. "
-                                   "Use parallel=False")
-
         try:
-            if not parallel:
+            if pipelined:
+                self._run_pipeline(parallel, n_jobs, joblib_backend, pipeline_depth)
+                self._dump_params()
+            elif not parallel:
                 for i, recording in enumerate(self.recording_list):
-                    self._run(recording, self.output_folders[i])
+                    self._timing[i].update(self._timed_run(recording, self.output_folders[i], time.time()))
             else:
-                Parallel(n_jobs=n_jobs, backend=joblib_backend)(
-                    delayed(self._run)(rec.dump_to_dict(), output_folder)
+                # the submit time is taken when joblib consumes the generator, i.e. when the task is dispatched
+                runner = self._make_runner()
+                run_timings = Parallel(n_jobs=n_jobs, backend=joblib_backend)(
+                    delayed(runner._timed_run)(rec.dump_to_dict(), output_folder, time.time())
                     for (rec, output_folder) in zip(self.recording_list, self.output_folders))
+                for i, run_timing in enumerate(run_timings):
+                    self._timing[i].update(run_timing)
 
             t1 = time.perf_counter()
             run_time = float(t1 - t0)
 
+            # the store is part of a successful run: an error marks the run as failed
+            self._write_spike_stores()
+
         except Exception as err:
+            timed_out = isinstance(err, SpikeSortingTimeoutError)
             if raise_error:
-                raise SpikeSortingError(f"Spike sorting failed: {err}. You can inspect the runtime trace in "
-                                        f"the {self.sorter_name}.log of the output folder.'")
+                ErrorClass = SpikeSortingTimeoutError if timed_out else SpikeSortingError
+                raise ErrorClass(f"Spike sorting failed: {err}. You can inspect the runtime trace in "
+                                 f"the {self.sorter_name}.log of the output folder.'")
             else:
                 run_time = None
                 log['error'] = True
                 log['error_trace'] = traceback.format_exc()
+                log['timeout'] = timed_out
 
         log['run_time'] = run_time
+        if launcher_wait > 0:
+            for timing in self._timing:
+                timing['queue_wait'] = timing.get('queue_wait', 0.) + launcher_wait
+
+        # the sorters have read their input: shared exports can be released
+        if self.export_store is not None:
+            for file_path in self._exported_files:
+                self.export_store.release(file_path)
+            self._exported_files = []
 
         # dump log inside folders
         for i in range(len(self.output_folders)):
@@ -187,6 +310,13 @@ class BaseSorter:
                         runtime_trace.append(line.strip())
                         line = fp.readline()
             log['runtime_trace'] = runtime_trace
+            log['timing'] = self._timing[i]
+            resource_path = output_folder / f'{self.sorter_name}_resources.json'
+            if resource_path.is_file():
+                with open(resource_path, 'r') as fp:
+                    log['resource_usage'] = json.load(fp)
+            else:
+                log.pop('resource_usage', None)
             with open(str(output_folder / 'spikeinterface_log.json'), 'w', encoding='utf8') as f:
                 json.dump(_check_json(log), f, indent=4)
 
@@ -208,6 +338,105 @@ class BaseSorter:
         # need be implemented in subclass
         raise NotImplementedError
 
+    def _run_pipeline(self, parallel, n_jobs, joblib_backend, pipeline_depth):
+        # producer: a thread runs the setups one after the other, and blocks when pipeline_depth groups
+        # are set up but not started yet (this bounds the disk used by exports waiting to be sorted)
+        ready = queue.Queue(maxsize=pipeline_depth)
+        stop = threading.Event()
+
+        def setup_groups():
+            try:
+                for i, recording in enumerate(self.recording_list):
+                    if stop.is_set():
+                        return
+                    ready.put((i, self._setup_recording_copy(recording, self.output_folders[i])))
+                ready.put(None)
+            except BaseException as err:
+                ready.put(err)
+
+        producer = threading.Thread(target=setup_groups, daemon=True)
+        producer.start()
+
+        # consumer: _run starts as soon as a group is ready and a worker is free
+        if not parallel:
+            n_workers = 1
+            executor = None
+        else:
+            n_workers = effective_n_jobs(n_jobs)
+            if joblib_backend == 'threading':
+                executor = ThreadPoolExecutor(max_workers=n_workers)
+            else:
+                executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+        free_workers = threading.Semaphore(n_workers)
+
+        futures = []
+        try:
+            while True:
+                free_workers.acquire()
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                i, (params, exported_files, setup_time) = item
+                self.params = params
+                self._exported_files.extend(exported_files)
+                self._timing[i]['setup'] = setup_time
+                if executor is None:
+                    try:
+                        self._timing[i].update(self._timed_run(self.recording_list[i], self.output_folders[i],
+                                                               time.time()))
+                    finally:
+                        free_workers.release()
+                else:
+                    # the executor pickles the call later: each submission has its own runner and params
+                    runner = self._make_runner()
+                    future = executor.submit(runner._timed_run, self.recording_list[i].dump_to_dict(),
+                                             self.output_folders[i], time.time())
+                    future.add_done_callback(lambda f: free_workers.release())
+                    futures.append((i, future))
+            for i, future in futures:
+                self._timing[i].update(future.result())
+        finally:
+            stop.set()
+            # unblock the producer if it waits on a full queue
+            while producer.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def _make_runner(self):
+        # _run only needs the recording it is given: do not pickle the recordings with self
+        runner = copy.copy(self)
+        runner.recording_list = None
+        runner._parent_recording = None
+        runner.params = copy.deepcopy(self.params)
+        return runner
+
+    def _setup_recording_copy(self, recording, output_folder):
+        # several setups can run at the same time (or in other processes): each one works on its own
+        # copy of the mutable attributes and returns what the parent needs for _run
+        recording = recover_recording(recording)
+        sorter = copy.copy(self)
+        for name, value in self.__dict__.items():
+            if isinstance(value, dict):
+                setattr(sorter, name, copy.deepcopy(value))
+        sorter._exported_files = []
+        t0 = time.perf_counter()
+        sorter._setup_recording(recording, output_folder)
+        setup_time = time.perf_counter() - t0
+        return sorter.params, sorter._exported_files, setup_time
+
+    def _timed_run(self, recording, output_folder, submit_time):
+        # wall clock (time.time) because the submit time can come from another process
+        t_start = time.time()
+        self._run(recording, output_folder)
+        t_stop = time.time()
+        return {'queue_wait': max(0., t_start - submit_time), 'run': t_stop - t_start}
+
     def _setup_recording(self, recording, output_folder):
         # need be implemented in subclass
         # this setup ONE recording (or SubExtractor)
@@ -215,6 +444,100 @@ class BaseSorter:
         # this must take care of geometry file (ORB, CSV, ...)
         raise NotImplementedError
 
+    def _copy_setup(self, setup_folder, output_folder):
+        """
+        Copies the files written by _setup_recording in setup_folder to output_folder.
+
+        The files matching setup_data_files are hardlinked when possible.
+        """
+        setup_folder = Path(setup_folder).absolute()
+        output_folder = Path(output_folder).absolute()
+        data_files = set()
+        for pattern in self.setup_data_files:
+            data_files.update(setup_folder.glob(pattern))
+        for path in sorted(setup_folder.rglob('*')):
+            target = output_folder / path.relative_to(setup_folder)
+            if path.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if target.exists():
+                target.unlink()
+            if path in data_files:
+                try:
+                    os.link(str(path), str(target))
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(str(path), str(target))
+        self._relocate_setup(setup_folder, output_folder)
+
+    def _relocate_setup(self, setup_folder, output_folder):
+        # sorters keeping absolute paths of setup_folder in their setup files update them here
+        pass
+
+    def _can_write_group_exports(self):
+        return self._parent_recording is not None and len(self.recording_list) > 1 and \
+            self.export_file_name is not None and self.export_store is None
+
+    def _write_group_exports(self):
+        file_paths = [output_folder / self.export_file_name for output_folder in self.output_folders]
+        dtype = self._get_export_dtype(self._parent_recording)
+        write_group_exports(self._parent_recording, self.recording_list, file_paths, dtype=dtype,
+                            file_format=self.export_format, chunk_mb=self.params.get('chunk_mb', 500),
+                            verbose=self.verbose)
+        for file_path in file_paths:
+            self._prewritten_exports[str(file_path.absolute())] = dtype.name
+
+    def _get_export_dtype(self, recording):
+        # dtype of the file written by _setup_recording
+        if self.export_dtype is None:
+            return recording.get_traces(start_frame=0, end_frame=1).dtype
+        return np.dtype(self.export_dtype)
+
+    def _is_prewritten(self, file_path, dtype=None):
+        file_path = str(Path(file_path).absolute())
+        if file_path not in self._prewritten_exports:
+            return False
+        return dtype is None or self._prewritten_exports[file_path] == np.dtype(dtype).name
+
+    def _export_binary(self, recording, file_path, dtype='int16'):
+        """
+        Writes recording as a time-major binary file for the sorters that need one.
+
+        With an export store, the export is shared with other sorters and the returned path
+        (to be used in the sorter config) can be the stored file instead of file_path.
+        The file is not written again when run() already wrote it with the other groups.
+        """
+        p = self.params
+        chunk_mb = p.get('chunk_mb', 500)
+        n_jobs = p.get('n_jobs_bin', 1)
+        if self._is_prewritten(file_path, dtype=dtype):
+            return Path(file_path).absolute()
+        if self.export_store is None:
+            recording.write_to_binary_dat_format(file_path, time_axis=0, dtype=dtype, chunk_mb=chunk_mb,
+                                                 n_jobs=n_jobs, verbose=self.verbose)
+            return Path(file_path).absolute()
+        self._exported_files.append(Path(file_path).absolute())
+        return self.export_store.acquire(recording, file_path, dtype=dtype, chunk_mb=chunk_mb, n_jobs=n_jobs,
+                                         verbose=self.verbose)
+
+    def _export_mda(self, recording, save_path):
+        """
+        Writes recording in the mda dataset format (raw.mda, geom.csv, params.json) in save_path.
+        """
+        save_path = Path(save_path)
+        p = self.params
+        if not self._is_prewritten(save_path / 'raw.mda'):
+            se.MdaRecordingExtractor.write_recording(recording=recording, save_path=str(save_path),
+                                                     n_jobs=p.get('n_jobs_bin', 1), chunk_mb=p.get('chunk_mb', 500),
+                                                     verbose=self.verbose)
+            return
+        # raw.mda was written by run() with the other groups: only the small files are left
+        np.savetxt(str(save_path / 'geom.csv'), np.array(recording.get_channel_locations()), delimiter=',')
+        with open(str(save_path / 'params.json'), 'w', encoding='utf8') as f:
+            json.dump({'samplerate': float(recording.get_sampling_frequency())}, f)
+
     def _run(self, recording, output_folder):
         # need be implemented in subclass
         # this run the sorter on ONE recording (or SubExtractor)
@@ -223,13 +546,51 @@ class BaseSorter:
 
     @staticmethod
     def get_result_from_folder(output_folder):
+        # need be implemented in subclass
         raise NotImplementedError
 
-    def get_result_list(self, raise_error=True):
+    @classmethod
+    def get_spike_store_from_folder(cls, output_folder):
+        """
+        Loads the spike store written at the end of run(), which is faster than parsing the sorter output.
+        The store only keeps the spike trains and the json-compatible unit properties: spike features
+        (e.g. amplitudes) and the methods of the sorter extractor need get_result_from_folder().
+        Falls back to get_result_from_folder() when the folder has no store.
+        """
+        spike_store_folder = Path(output_folder) / spike_store_folder_name
+        if has_spike_store(spike_store_folder):
+            return SpikeStoreSortingExtractor(spike_store_folder)
+        return cls.get_result_from_folder(output_folder)
+
+    def _write_spike_stores(self):
+        for i, output_folder in enumerate(self.output_folders):
+            t0 = time.perf_counter()
+            sorting = self.get_result_from_folder(output_folder)
+            write_spike_store(sorting, output_folder / spike_store_folder_name,
+                              sampling_frequency=self.recording_list[i].get_sampling_frequency())
+            self._timing[i]['spike_store'] = time.perf_counter() - t0
+
+    def _update_log_timing(self, i, timing):
+        # add stages done after run() to the log of one group
+        log_file = self.output_folders[i] / 'spikeinterface_log.json'
+        if not log_file.is_file():
+            return
+        with open(str(log_file), 'r', encoding='utf8') as f:
+            log = json.load(f)
+        log.setdefault('timing', {}).update(timing)
+        with open(str(log_file), 'w', encoding='utf8') as f:
+            json.dump(_check_json(log), f, indent=4)
+
+    def get_result_list(self, raise_error=True, use_spike_store=False):
         sorting_list = []
         for i, _ in enumerate(self.recording_list):
             try:
-                sorting = self.get_result_from_folder(self.output_folders[i])
+                t0 = time.perf_counter()
+                if use_spike_store:
+                    sorting = self.get_spike_store_from_folder(self.output_folders[i])
+                else:
+                    sorting = self.get_result_from_folder(self.output_folders[i])
+                self._update_log_timing(i, {'get_result_from_folder': time.perf_counter() - t0})
                 sorting_list.append(sorting)
             except Exception as err:
                 if raise_error:
@@ -238,9 +599,10 @@ class BaseSorter:
                     warnings.warn(f"Sorting output {i} could not be loaded")
         return sorting_list
 
-    def get_result(self, raise_error=True):
-        sorting_list = self.get_result_list(raise_error=raise_error)
-        
+    def get_result(self, raise_error=True, use_spike_store=False):
+        sorting_list = self.get_result_list(raise_error=raise_error, use_spike_store=use_spike_store)
+
+        t0 = time.perf_counter()
         if len(sorting_list) == 1:
             sorting = sorting_list[0]
         elif len(sorting_list) > 1:
@@ -258,14 +620,19 @@ class BaseSorter:
         else:
             raise SpikeSortingError(f"None of the sorting outputs could be loaded")
 
+        sorting.set_sampling_frequency(self.recording_list[0].get_sampling_frequency())
+        sorting.copy_epochs(self.recording_list[0])
+        sorting.copy_times(self.recording_list[0])
+
+        # assembly of all groups: the same value is added to each log
+        get_result_time = time.perf_counter() - t0
+        for i in range(len(self.output_folders)):
+            self._update_log_timing(i, {'get_result': get_result_time})
+
         if self.delete_folders:
             for out in self.output_folders:
                 if self.verbose:
                     print("Removing ", str(out))
                 shutil.rmtree(str(out), ignore_errors=True)
 
-        sorting.set_sampling_frequency(self.recording_list[0].get_sampling_frequency())
-        sorting.copy_epochs(self.recording_list[0])
-        sorting.copy_times(self.recording_list[0])
-
         return sorting
@@ -1,12 +1,16 @@
 from pathlib import Path
 import os
+import json
 from typing import Union
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import spikeextractors as se
+from spikeextractors.baseextractor import _check_json
 from ..basesorter import BaseSorter
 from ..utils.shellscript import ShellScript
-from ..sorter_tools import recover_recording
+from ..sorter_tools import recover_recording, get_bindat_source, SpikeSortingTimeoutError
 
 try:
     import h5py
@@ -17,6 +21,9 @@ except ImportError:
 
 PathType = Union[str, Path]
 
+# channel ids and h5 file names of the channels in the output folder
+channel_list_file_name = 'combinato_channels.json'
+
 
 def check_if_installed(combinato_path: Union[str, None]):
     if combinato_path is None:
@@ -40,6 +47,8 @@ class CombinatoSorter(BaseSorter):
     sorter_name: str = 'combinato'
     combinato_path: Union[str, None] = os.getenv('COMBINATO_PATH', None)
     requires_locations = False
+    setup_params = ['link_raw_file']
+    setup_data_files = ['recording_*.h5']
     _default_params = {
         'detect_sign': -1,  # -1 - 1 - 0
         'MaxClustersPerTemp': 5,
@@ -56,7 +65,10 @@ class CombinatoSorter(BaseSorter):
         'index_maximum': 19,
         'upsampling_factor': 3,
         'denoise': True,
-        'do_filter': True
+        'do_filter': True,
+        'chunk_mb': 500,
+        'link_raw_file': False,
+        'n_jobs_channels': None
     }
 
     _params_description = {
@@ -76,7 +88,12 @@ class CombinatoSorter(BaseSorter):
         'index_maximum': "Number of samples from the beginning of the spike waveform up to (not including) the peak",
         'upsampling_factor': 'upsampling factor',
         'denoise': 'Use denoise filter',
-        'do_filter': 'Use bandpass filter'
+        'do_filter': 'Use bandpass filter',
+        'chunk_mb': "Chunk size in Mb for saving the h5 file (default 500Mb)",
+        'link_raw_file': "If True, a single channel raw binary recording is referenced by the h5 file "
+                         "instead of being copied",
+        'n_jobs_channels': "Number of channels sorted in parallel (if None, the number of cpus). "
+                           "The timeout of run_sorter applies to all channels together"
     }
 
     sorter_description = """Combinato is a complete data-analysis framework for spike sorting in noisy recordings 
@@ -122,20 +139,22 @@ class CombinatoSorter(BaseSorter):
             raise Exception(CombinatoSorter.installation_mesg)
 
         os.makedirs(str(output_folder), exist_ok=True)
-        # Generate h5 files in the dataset directory
-        chid = recording.get_channel_ids()[0]
-        vcFile_h5 = str(output_folder / ('recording.h5'))
-        f = h5py.File(vcFile_h5, mode='w')
-        f.create_dataset("sr", data=[recording.get_sampling_frequency()], dtype='float32')
-
-        f.create_dataset("data", data=recording.get_traces(channel_ids=[chid]).flatten())
-        f.close()
+        # Generate one h5 file per channel in the dataset directory: combinato sorts each channel independently
+        channel_ids = recording.get_channel_ids()
+        file_names = [f'recording_{i}' for i in range(len(channel_ids))]
+        write_combinato_h5(recording, [output_folder / (file_name + '.h5') for file_name in file_names],
+                           channel_ids=channel_ids, chunk_mb=self.params['chunk_mb'],
+                           link_raw_file=self.params['link_raw_file'])
+        with open(str(output_folder / channel_list_file_name), 'w', encoding='utf8') as f:
+            json.dump(_check_json({'channel_ids': list(channel_ids), 'file_names': file_names}), f, indent=4)
 
     def _run(self, recording, output_folder):
         recording = recover_recording(recording)
 
         p = self.params.copy()
         p['threshold_factor'] = p.pop('detect_threshold')
+        del p['chunk_mb'], p['link_raw_file']
+        n_jobs = p.pop('n_jobs_channels')
         sign_thr = p.pop('detect_sign')
         if sign_thr == 0:
             sign_thr = ''
@@ -148,44 +167,187 @@ class CombinatoSorter(BaseSorter):
             print("Warning! The recording is already filtered, but Combinato will filter again. You can disable "
                   "filters by setting 'do_filter' to False")
 
-        recording.get_channel_ids()
         tmpdir = output_folder
         os.makedirs(str(tmpdir), exist_ok=True)
 
+        with open(str(output_folder / channel_list_file_name), 'r', encoding='utf8') as f:
+            file_names = json.load(f)['file_names']
+        if n_jobs is None:
+            n_jobs = os.cpu_count()
+        n_jobs = max(1, min(n_jobs, len(file_names)))
+
         if self.verbose:
-            print('Running combinato in {tmpdir}...'.format(tmpdir=tmpdir))
+            print('Running combinato in {tmpdir} on {n} channels with {n_jobs} jobs...'.format(
+                tmpdir=tmpdir, n=len(file_names), n_jobs=n_jobs))
         outFile = open(tmpdir / "local_options.py", "w")
         outFile.writelines("options = {}".format(p))
         outFile.close()
 
+        # the channels are independent: each one is extracted and clustered by its own shell script.
+        # timeout applies to the whole run: each channel only gets the time left before the deadline
+        t0 = time.time()
+        deadline = None if self.timeout is None else t0 + self.timeout
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(self._run_channel, output_folder, file_name, sign_thr, deadline)
+                       for file_name in file_names]
+            retcodes = []
+            errors = []
+            for future in futures:
+                try:
+                    retcodes.append(future.result())
+                except Exception as err:
+                    errors.append(err)
+        elapsed_time = time.time() - t0
+
+        # ShellScript writes the resources of each channel next to its log: merged for the sorter
+        channel_usages = []
+        for file_name in file_names:
+            channel_resource_path = output_folder / f'{self.sorter_name}_{file_name}_resources.json'
+            if channel_resource_path.is_file():
+                with open(str(channel_resource_path), 'r') as f:
+                    channel_usages.append(json.load(f))
+        if len(channel_usages) > 0:
+            usage = _merge_resource_usage(channel_usages)
+            usage['elapsed_time_s'] = elapsed_time
+            with open(str(output_folder / f'{self.sorter_name}_resources.json'), 'w') as f:
+                json.dump(usage, f, indent=4)
+
+        # one log for the runtime trace of spikeinterface_log.json
+        with open(str(output_folder / f'{self.sorter_name}.log'), 'w') as log_file:
+            for file_name in file_names:
+                # ShellScript adds .txt to the log of a script without suffix
+                for channel_log in (output_folder / f'{self.sorter_name}_{file_name}.log',
+                                    output_folder / f'{self.sorter_name}_{file_name}.log.txt'):
+                    if channel_log.is_file():
+                        log_file.write(f'--- {file_name} ---\n')
+                        log_file.write(channel_log.read_text())
+
+        if len(errors) > 0:
+            raise errors[0]
+        if any(retcode != 0 for retcode in retcodes):
+            raise Exception('combinato returned a non-zero exit code')
+
+    def _run_channel(self, output_folder, file_name, sign_thr, deadline=None):
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise SpikeSortingTimeoutError(f'TIMEOUT: {file_name} not started, running for more than '
+                                               f'{self.timeout} s')
         shell_cmd = '''
             {extra_cmd}
             cd "{tmpdir}"
-            python {css_folder}/css-extract --h5 --files recording.h5
-            python {css_folder}/css-simple-clustering {sign_thr} --datafile recording/data_recording.h5
+            python {css_folder}/css-extract --h5 --files {file_name}.h5
+            python {css_folder}/css-simple-clustering {sign_thr} --datafile {file_name}/data_{file_name}.h5
         '''
 
         if 'win' in sys.platform and sys.platform != 'darwin':
-            extra_cmd = str(tmpdir)[:2]
+            extra_cmd = str(output_folder)[:2]
             shell_cmd = shell_cmd.replace('/', '\\')
         else:
             extra_cmd = '#!/bin/bash'
 
-        shell_cmd = shell_cmd.format(extra_cmd=extra_cmd, tmpdir=tmpdir, css_folder=CombinatoSorter.combinato_path,
-                                     sign_thr=sign_thr)
-        shell_cmd = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+        shell_cmd = shell_cmd.format(extra_cmd=extra_cmd, tmpdir=output_folder,
+                                     css_folder=CombinatoSorter.combinato_path, sign_thr=sign_thr,
+                                     file_name=file_name)
+        shell_cmd = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}_{file_name}',
+                                log_path=output_folder / f'{self.sorter_name}_{file_name}.log', verbose=self.verbose,
+                                timeout=timeout, inactivity_timeout=self.inactivity_timeout)
         shell_cmd.start()
-
-        retcode = shell_cmd.wait()
-
-        if retcode != 0:
-            raise Exception('combinato returned a non-zero exit code')
+        return shell_cmd.wait()
 
     @staticmethod
     def get_result_from_folder(output_folder):
 
         output_folder = Path(output_folder)
-        result_fname = str(output_folder / 'recording')
-        sorting = se.CombinatoSortingExtractor(datapath=result_fname)
-        return sorting
+        channel_list_file = output_folder / channel_list_file_name
+        if not channel_list_file.is_file():
+            # output of a single channel run
+            result_fname = str(output_folder / 'recording')
+            sorting = se.CombinatoSortingExtractor(datapath=result_fname)
+            return sorting
+
+        with open(str(channel_list_file), 'r', encoding='utf8') as f:
+            channel_list = json.load(f)
+        sorting_list = []
+        for channel_id, file_name in zip(channel_list['channel_ids'], channel_list['file_names']):
+            sorting = se.CombinatoSortingExtractor(datapath=str(output_folder / file_name))
+            for unit_id in sorting.get_unit_ids():
+                sorting.set_unit_property(unit_id, 'channel', channel_id)
+                # the units are renumbered by MultiSortingExtractor: keep the id of the combinato output
+                sorting.set_unit_property(unit_id, 'combinato_unit_id', unit_id)
+            sorting_list.append(sorting)
+        if len(sorting_list) == 1:
+            return sorting_list[0]
+        return se.MultiSortingExtractor(sortings=sorting_list)
+
+
+def _merge_resource_usage(usages):
+    # channels sorted in parallel: cpu time and io add up, peaks are the largest of the channels
+    merged = {'source': usages[0].get('source')}
+    for key in ('cpu_time_s', 'read_bytes', 'write_bytes'):
+        values = [usage[key] for usage in usages if usage.get(key) is not None]
+        merged[key] = sum(values) if len(values) > 0 else None
+    for key in ('peak_rss_mb', 'max_threads'):
+        values = [usage[key] for usage in usages if usage.get(key) is not None]
+        merged[key] = max(values) if len(values) > 0 else None
+    return merged
+
+
+def write_combinato_h5(recording, file_paths, channel_ids=None, chunk_mb=500, link_raw_file=False):
+    """
+    Writes channels of recording in the h5 input format of combinato ('data' and 'sr' datasets),
+    one file per channel.
+
+    The traces of all channels are read once, by chunks, and appended to resizable datasets, so that
+    the memory used does not depend on the duration of the recording.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording to write
+    file_paths: list
+        One h5 file per channel
+    channel_ids: list or None
+        The channels to write. If None, all channels
+    chunk_mb: int
+        Size in Mb of the chunks read from recording
+    link_raw_file: bool
+        If True and recording is a single channel BinDatRecordingExtractor, 'data' is an external dataset
+        that references the raw file instead of a copy
+    """
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    channel_ids = list(channel_ids)
+    assert len(file_paths) == len(channel_ids)
+    num_frames = recording.get_num_frames()
+
+    bindat_source = get_bindat_source(recording)
+    if link_raw_file and bindat_source is not None and recording.get_num_channels() == 1:
+        dtype = recording._timeseries.dtype
+        with h5py.File(str(file_paths[0]), mode='w') as f:
+            f.create_dataset("sr", data=[recording.get_sampling_frequency()], dtype='float32')
+            f.create_dataset("data", shape=(num_frames,), dtype=dtype,
+                             external=[(str(bindat_source[0]), bindat_source[1], num_frames * dtype.itemsize)])
+        return
+
+    dtype = recording.get_traces(channel_ids=channel_ids[:1], start_frame=0, end_frame=1).dtype
+    chunk_size = max(1, int(chunk_mb * 1e6 / (len(channel_ids) * dtype.itemsize)))
+    files = []
+    try:
+        datasets = []
+        for file_path in file_paths:
+            f = h5py.File(str(file_path), mode='w')
+            files.append(f)
+            f.create_dataset("sr", data=[recording.get_sampling_frequency()], dtype='float32')
+            datasets.append(f.create_dataset("data", shape=(0,), maxshape=(None,), dtype=dtype,
+                                             chunks=(max(1, min(chunk_size, 2 ** 20)),)))
+        for start_frame in range(0, num_frames, chunk_size):
+            end_frame = min(start_frame + chunk_size, num_frames)
+            traces = recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
+            for i, data in enumerate(datasets):
+                data.resize((end_frame,))
+                data[start_frame:end_frame] = traces[i]
+    finally:
+        for f in files:
+            f.close()
@@ -0,0 +1,104 @@
+"""
+Shared store of binary exports.
+
+Several sorters (Kilosort family, YASS, Klusta) need the same int16 time-major
+binary copy of a recording. With a store, the binary is written once per
+(recording fingerprint, dtype) and each sorter gets a hardlink in its output folder.
+When hardlinks are not possible (other filesystem, no support) the sorter gets
+the absolute path of the stored file instead.
+
+Each stored file keeps the list of the files that were handed out (holders).
+Holders are released once the sorter has run, and cleanup() removes the stored
+files that have no holder anymore.
+"""
+from pathlib import Path
+import os
+import json
+
+import numpy as np
+
+from .sorter_tools import FileLock, get_recording_fingerprint
+
+
+class BinaryExportStore:
+    def __init__(self, store_folder):
+        self.store_folder = Path(store_folder).absolute()
+        self.store_folder.mkdir(parents=True, exist_ok=True)
+
+    def acquire(self, recording, file_path, dtype='int16', chunk_mb=500, n_jobs=1, verbose=False):
+        """
+        Makes the binary export of recording available at file_path.
+
+        Returns the path the sorter must read: file_path when it could be linked to the stored
+        file (or written directly for non dumpable recordings), otherwise the stored file itself.
+        """
+        file_path = Path(file_path).absolute()
+        fingerprint = get_recording_fingerprint(recording)
+        if fingerprint is None:
+            # no way to know if the export can be shared
+            recording.write_to_binary_dat_format(file_path, time_axis=0, dtype=dtype, chunk_mb=chunk_mb,
+                                                 n_jobs=n_jobs, verbose=verbose)
+            return file_path
+
+        key = f'{fingerprint}_{np.dtype(dtype).name}'
+        data_file = self.store_folder / (key + '.dat')
+        with FileLock(self.store_folder / (key + '.lock')):
+            if not data_file.is_file():
+                if verbose:
+                    print(f'Writing shared binary export {data_file}')
+                partial_file = self.store_folder / (key + '_partial.dat')
+                recording.write_to_binary_dat_format(partial_file, time_axis=0, dtype=dtype, chunk_mb=chunk_mb,
+                                                     n_jobs=n_jobs, verbose=verbose)
+                os.replace(str(partial_file), str(data_file))
+            holders = self._read_holders(key)
+            if str(file_path) not in holders:
+                holders.append(str(file_path))
+            self._write_holders(key, holders)
+
+        if file_path.is_file() and file_path.samefile(data_file):
+            return file_path
+        if file_path.exists():
+            file_path.unlink()
+        try:
+            os.link(str(data_file), str(file_path))
+            return file_path
+        except OSError:
+            return data_file
+
+    def release(self, file_path):
+        """
+        Removes file_path from the holders of the stored files.
+        """
+        file_path = str(Path(file_path).absolute())
+        for holders_file in self.store_folder.glob('*.json'):
+            key = holders_file.stem
+            with FileLock(self.store_folder / (key + '.lock')):
+                holders = self._read_holders(key)
+                if file_path in holders:
+                    holders.remove(file_path)
+                    self._write_holders(key, holders)
+
+    def cleanup(self):
+        """
+        Removes the stored files that have no holder.
+        Holders that were hardlinked keep their own copy of the data.
+        """
+        for holders_file in self.store_folder.glob('*.json'):
+            key = holders_file.stem
+            with FileLock(self.store_folder / (key + '.lock')):
+                if len(self._read_holders(key)) == 0:
+                    data_file = self.store_folder / (key + '.dat')
+                    if data_file.is_file():
+                        data_file.unlink()
+                    holders_file.unlink()
+
+    def _read_holders(self, key):
+        holders_file = self.store_folder / (key + '.json')
+        if not holders_file.is_file():
+            return []
+        with open(holders_file, 'r', encoding='utf8') as f:
+            return json.load(f)['holders']
+
+    def _write_holders(self, key, holders):
+        with open(self.store_folder / (key + '.json'), 'w', encoding='utf8') as f:
+            json.dump({'holders': holders}, f, indent=4)
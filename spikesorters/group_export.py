@@ -0,0 +1,102 @@
+"""
+Single pass export of the groups of a recording.
+
+With grouping_property, each sub recording is exported by the sorter in its own setup, so the
+source file is read once per group. write_group_exports() reads each chunk of the parent recording
+once, slices the channels of each group and appends them to the file of the group.
+
+Supported formats:
+  * 'dat' : time-major raw binary (int16 for kilosort/klusta/yass, float32 for tridesclous)
+  * 'mda' : mountainlab array (channels x frames) used by ironclust
+"""
+from pathlib import Path
+
+import numpy as np
+
+
+# dtype codes of the mda header
+_mda_dtype_codes = {
+    'uint8': -2,
+    'float32': -3,
+    'int16': -4,
+    'int32': -5,
+    'uint16': -6,
+    'float64': -7,
+    'uint32': -8,
+}
+
+
+def _write_mda_header(f, dtype, num_channels, num_frames):
+    dtype = np.dtype(dtype)
+    if dtype.name not in _mda_dtype_codes:
+        raise ValueError(f"dtype {dtype.name} can not be written in mda format")
+    if num_frames < 2 ** 31:
+        np.array([_mda_dtype_codes[dtype.name], dtype.itemsize, 2, num_channels, num_frames], dtype='int32').tofile(f)
+    else:
+        # negative number of dimensions: dimensions are stored as int64
+        np.array([_mda_dtype_codes[dtype.name], dtype.itemsize, -2], dtype='int32').tofile(f)
+        np.array([num_channels, num_frames], dtype='int64').tofile(f)
+
+
+def write_group_exports(recording, recording_list, file_paths, dtype=None, file_format='dat', chunk_mb=500,
+                        verbose=False):
+    """
+    Writes the traces of each sub recording of recording in a single pass over recording.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The parent recording
+    recording_list: list
+        The sub recordings (e.g. from get_sub_extractors_by_property), their channel ids must be
+        channel ids of recording
+    file_paths: list
+        The output file of each sub recording
+    dtype: dtype or None
+        The dtype of the files. If None, the dtype of the traces of recording
+    file_format: str
+        'dat' (time-major raw binary) or 'mda'
+    chunk_mb: int
+        Size in Mb of the chunks read from recording
+    verbose: bool
+        If True, the progress is printed
+    """
+    assert file_format in ('dat', 'mda'), "file_format must be 'dat' or 'mda'"
+    assert len(recording_list) == len(file_paths)
+
+    parent_channel_ids = list(recording.get_channel_ids())
+    group_channel_ids = [list(rec.get_channel_ids()) for rec in recording_list]
+    # only the channels used by a group are read
+    read_channel_ids = [ch for ch in parent_channel_ids if any(ch in ch_ids for ch_ids in group_channel_ids)]
+    read_index = {ch: i for i, ch in enumerate(read_channel_ids)}
+    group_indices = [np.array([read_index[ch] for ch in ch_ids], dtype='int64') for ch_ids in group_channel_ids]
+
+    num_frames = recording.get_num_frames()
+    traces_dtype = recording.get_traces(channel_ids=read_channel_ids[:1], start_frame=0, end_frame=1).dtype
+    if dtype is None:
+        dtype = traces_dtype
+    dtype = np.dtype(dtype)
+    chunk_size = max(1, int(chunk_mb * 1e6 / (len(read_channel_ids) * traces_dtype.itemsize)))
+
+    files = []
+    try:
+        for file_path, ch_ids in zip(file_paths, group_channel_ids):
+            file_path = Path(file_path)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(file_path, 'wb')
+            files.append(f)
+            if file_format == 'mda':
+                _write_mda_header(f, dtype, len(ch_ids), num_frames)
+
+        num_chunks = int(np.ceil(num_frames / chunk_size))
+        for chunk_index, start_frame in enumerate(range(0, num_frames, chunk_size)):
+            end_frame = min(start_frame + chunk_size, num_frames)
+            traces = recording.get_traces(channel_ids=read_channel_ids, start_frame=start_frame, end_frame=end_frame)
+            for f, indices in zip(files, group_indices):
+                # both formats store the channels of one frame next to each other
+                traces[indices].T.astype(dtype, order='C').tofile(f)
+            if verbose:
+                print(f'Group export: chunk {chunk_index + 1}/{num_chunks}')
+    finally:
+        for f in files:
+            f.close()
@@ -3,6 +3,8 @@ import os
 from typing import Union
 import numpy as np
 import sys
+import queue
+import threading
 
 import spikeextractors as se
 from ..basesorter import BaseSorter
@@ -33,6 +35,7 @@ class HDSortSorter(BaseSorter):
     sorter_name: str = 'hdsort'
     hdsort_path: Union[str, None] = os.getenv('HDSORT_PATH', None)
     requires_locations = False
+    memory_base_gb = 2.0
     _default_params = {
         'detect_threshold': 4.2,
         'detect_sign': -1,  # -1 - 1
@@ -197,7 +200,8 @@ class HDSortSorter(BaseSorter):
                     '''.format(tmpdir=output_folder)
 
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()
@@ -240,27 +244,102 @@ class HDSortSorter(BaseSorter):
             save_path = Path(save_path)
             if save_path.suffix == '':
                 save_path = Path(str(save_path) + '.h5')
-            mapping_dtype = np.dtype([('electrode', np.int32), ('x', np.float64), ('y', np.float64),
-                                      ('channel', np.int32)])
-
             assert 'location' in recording.get_shared_channel_property_names(), "'location' property is needed " \
                                                                                 "to run HDSort"
-
-            with h5py.File(save_path, 'w') as f:
-                f.create_group('ephys')
-                f.create_dataset('version', data=str(20161003))
-                ephys = f['ephys']
-                ephys.create_dataset('frame_rate', data=recording.get_sampling_frequency())
-                ephys.create_dataset('frame_numbers', data=np.arange(recording.get_num_frames()))
-                # save mapping
-                mapping = np.empty(recording.get_num_channels(), dtype=mapping_dtype)
-                x = recording.get_channel_locations()[:, 0]
-                y = recording.get_channel_locations()[:, 1]
-                for i, ch in enumerate(recording.get_channel_ids()):
-                    mapping[i] = (ch, x[i], y[i], ch)
-                ephys.create_dataset('mapping', data=mapping)
-                # save traces
-                recording.write_to_h5_dataset_format('/ephys/signal', file_handle=f, time_axis=1,
-                                                     chunk_size=chunk_size, chunk_mb=chunk_mb)
+            write_hdsort_h5(recording, save_path, chunk_size=chunk_size, chunk_mb=chunk_mb)
             self.params['file_name'] = str(save_path.absolute())
 
+
+def write_hdsort_h5(recording, save_path, chunk_size=None, chunk_mb=500):
+    """
+    Writes recording in the mea1k h5 format read by HDSort.
+
+    The traces and the frame numbers are written by chunks, while a background thread reads the next chunks.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording to write (with 'location' property)
+    save_path: str or Path
+        The h5 file
+    chunk_size: int or None
+        Number of frames of the chunks. If None, it is computed from chunk_mb
+    chunk_mb: int or None
+        Size in Mb of the chunks. If chunk_size and chunk_mb are None, the traces are written in one chunk
+    """
+    import h5py
+
+    mapping_dtype = np.dtype([('electrode', np.int32), ('x', np.float64), ('y', np.float64),
+                              ('channel', np.int32)])
+    with h5py.File(save_path, 'w') as f:
+        f.create_group('ephys')
+        f.create_dataset('version', data=str(20161003))
+        ephys = f['ephys']
+        ephys.create_dataset('frame_rate', data=recording.get_sampling_frequency())
+        # save mapping
+        channel_ids = np.array(recording.get_channel_ids())
+        locations = np.array(recording.get_channel_locations())
+        mapping = np.empty(recording.get_num_channels(), dtype=mapping_dtype)
+        mapping['electrode'] = channel_ids
+        mapping['x'] = locations[:, 0]
+        mapping['y'] = locations[:, 1]
+        mapping['channel'] = channel_ids
+        ephys.create_dataset('mapping', data=mapping)
+        # save traces and frame numbers by chunks
+        num_frames = recording.get_num_frames()
+        dtype = recording.get_traces(start_frame=0, end_frame=1).dtype
+        if chunk_size is None:
+            if chunk_mb is None:
+                chunk_size = max(1, num_frames)
+            else:
+                chunk_size = max(1, int(chunk_mb * 1e6 / (recording.get_num_channels() * dtype.itemsize)))
+        frame_numbers = ephys.create_dataset('frame_numbers', shape=(num_frames,), dtype='int64')
+        signal = ephys.create_dataset('signal', shape=(recording.get_num_channels(), num_frames), dtype=dtype)
+        for start_frame, end_frame, traces in _iter_traces_prefetched(recording, chunk_size):
+            signal[:, start_frame:end_frame] = traces
+            frame_numbers[start_frame:end_frame] = np.arange(start_frame, end_frame, dtype='int64')
+
+
+def _iter_traces_prefetched(recording, chunk_size, prefetch=2):
+    """
+    Yields (start_frame, end_frame, traces) chunk by chunk. A background thread reads the next chunks
+    (at most prefetch of them) while the current one is written.
+    """
+    num_frames = recording.get_num_frames()
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # gives up when the consumer has stopped
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_chunks():
+        try:
+            for start_frame in range(0, num_frames, chunk_size):
+                end_frame = min(start_frame + chunk_size, num_frames)
+                traces = recording.get_traces(start_frame=start_frame, end_frame=end_frame)
+                if not put((start_frame, end_frame, traces)):
+                    return
+            put(None)
+        except BaseException as err:
+            put(err)
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
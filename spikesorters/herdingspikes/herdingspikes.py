@@ -20,6 +20,7 @@ class HerdingspikesSorter(BaseSorter):
     
     requires_locations = True
     compatible_with_parallel = {'loky': True, 'multiprocessing': True, 'threading': False}
+    memory_factor = 1.5
     _default_params = {
         # core params
         'clustering_bandwidth': 5.5,  # 5.0,
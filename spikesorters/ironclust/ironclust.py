@@ -36,6 +36,11 @@ class IronClustSorter(BaseSorter):
     ironclust_path: Union[str, None] = os.getenv('IRONCLUST_PATH', None)
     
     requires_locations = True
+    memory_base_gb = 2.0
+    memory_factor = 2.0
+    export_file_name = 'ironclust_dataset/raw.mda'
+    export_format = 'mda'
+    export_dtype = None
 
     _default_params = {
         'detect_sign': -1,  # Use -1, 0, or 1, depending on the sign of the spikes in the recording
@@ -152,14 +157,12 @@ class IronClustSorter(BaseSorter):
             print("Could not set IRONCLUST_PATH environment variable:", e)
 
     def _setup_recording(self, recording: se.RecordingExtractor, output_folder: Path):
-        p = self.params
         if not self.is_installed():
             raise Exception(IronClustSorter.installation_mesg)
 
         dataset_dir = output_folder / 'ironclust_dataset'
         # Generate three files in the dataset directory: raw.mda, geom.csv, params.json
-        se.MdaRecordingExtractor.write_recording(recording=recording, save_path=str(dataset_dir),
-                                                 n_jobs=p["n_jobs_bin"], chunk_mb=p["chunk_mb"], verbose=self.verbose)
+        self._export_mda(recording, dataset_dir)
 
     def _run(self, recording: se.RecordingExtractor, output_folder: Path):
         recording = recover_recording(recording)
@@ -224,7 +227,8 @@ class IronClustSorter(BaseSorter):
             '''.format(tmpdir=tmpdir)
 
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()
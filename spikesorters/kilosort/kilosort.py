@@ -9,7 +9,7 @@ import numpy as np
 import spikeextractors as se
 from ..basesorter import BaseSorter
 from ..utils.shellscript import ShellScript
-from ..sorter_tools import get_git_commit, recover_recording
+from ..sorter_tools import get_git_commit, recover_recording, get_bindat_source
 
 PathType = Union[str, Path]
 
@@ -37,6 +37,9 @@ class KilosortSorter(BaseSorter):
     kilosort_path: Union[str, None] = os.getenv('KILOSORT_PATH', None)
     
     requires_locations = False
+    memory_base_gb = 2.0
+    memory_factor = 0.5
+    export_file_name = 'recording.dat'
     
     _default_params = {
         'detect_threshold': 6,
@@ -114,10 +117,13 @@ class KilosortSorter(BaseSorter):
         if positions.shape[1] != 2:
             raise RuntimeError("3D 'location' are not supported. Set 2D locations instead")
 
-        # save binary file
-        input_file_path = output_folder / 'recording'
-        recording.write_to_binary_dat_format(input_file_path, dtype='int16', chunk_mb=p["chunk_mb"],
-                                             n_jobs=p["n_jobs_bin"], verbose=self.verbose)
+        # save binary file, unless the recording is already an int16 time-major raw file without header
+        bindat_source = get_bindat_source(recording, dtype='int16')
+        if bindat_source is not None and bindat_source[1] == 0:
+            dat_file = bindat_source[0]
+        else:
+            input_file_path = output_folder / 'recording.dat'
+            dat_file = self._export_binary(recording, input_file_path, dtype='int16')
 
         # set up kilosort config files and run kilosort on data
         with (source_dir / 'kilosort_master.m').open('r') as f:
@@ -164,7 +170,7 @@ class KilosortSorter(BaseSorter):
             nchanTOT=recording.get_num_channels(),
             nchan=recording.get_num_channels(),
             sample_rate=recording.get_sampling_frequency(),
-            dat_file=str((output_folder / 'recording.dat').absolute()),
+            dat_file=str(dat_file),
             Nfilt=int(p['Nfilt']),
             ntbuff=int(p['ntbuff']),
             NT=int(p['NT']),
@@ -207,7 +213,8 @@ class KilosortSorter(BaseSorter):
                         matlab -nosplash -nodisplay -log -r kilosort_master
                     '''.format(tmpdir=output_folder)
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()
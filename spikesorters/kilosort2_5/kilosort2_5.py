@@ -9,7 +9,7 @@ import json
 import spikeextractors as se
 from ..basesorter import BaseSorter
 from ..utils.shellscript import ShellScript
-from ..sorter_tools import get_git_commit, recover_recording
+from ..sorter_tools import get_git_commit, recover_recording, get_bindat_source
 
 PathType = Union[str, Path]
 
@@ -36,6 +36,9 @@ class Kilosort2_5Sorter(BaseSorter):
     sorter_name: str = 'kilosort2_5'
     kilosort2_5_path: Union[str, None] = os.getenv('KILOSORT2_5_PATH', None)
     requires_locations = False
+    memory_base_gb = 2.0
+    memory_factor = 0.5
+    export_file_name = 'recording.dat'
 
     _default_params = {
         'detect_threshold': 6,
@@ -138,10 +141,13 @@ class Kilosort2_5Sorter(BaseSorter):
         if positions.shape[1] != 2:
             raise RuntimeError("3D 'location' are not supported. Set 2D locations instead")
 
-        # save binary file
-        input_file_path = output_folder / 'recording.dat'
-        recording.write_to_binary_dat_format(input_file_path, dtype='int16', chunk_mb=p["chunk_mb"],
-                                             n_jobs=p["n_jobs_bin"], verbose=self.verbose)
+        # save binary file, unless the recording is already an int16 time-major raw file without header
+        bindat_source = get_bindat_source(recording, dtype='int16')
+        if bindat_source is not None and bindat_source[1] == 0:
+            dat_file = bindat_source[0]
+        else:
+            input_file_path = output_folder / 'recording.dat'
+            dat_file = self._export_binary(recording, input_file_path, dtype='int16')
 
         if p['car']:
             use_car = 1
@@ -178,7 +184,7 @@ class Kilosort2_5Sorter(BaseSorter):
         kilosort2_5_config_txt = kilosort2_5_config_txt.format(
             nchan=recording.get_num_channels(),
             sample_rate=recording.get_sampling_frequency(),
-            dat_file=str((output_folder / 'recording.dat').absolute()),
+            dat_file=str(dat_file),
             nblocks=p['nblocks'],
             do_correction=do_correction,
             sig=p['sig'],
@@ -230,7 +236,8 @@ class Kilosort2_5Sorter(BaseSorter):
                         matlab -nosplash -nodisplay -log -r kilosort2_5_master
                     '''.format(tmpdir=output_folder)
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
         retcode = shell_script.wait()
 
@@ -9,7 +9,7 @@ import json
 import spikeextractors as se
 from ..basesorter import BaseSorter
 from ..utils.shellscript import ShellScript
-from ..sorter_tools import get_git_commit, recover_recording
+from ..sorter_tools import get_git_commit, recover_recording, get_bindat_source
 
 PathType = Union[str, Path]
 
@@ -36,6 +36,9 @@ class Kilosort3Sorter(BaseSorter):
     sorter_name: str = 'kilosort3'
     kilosort3_path: Union[str, None] = os.getenv('KILOSORT3_PATH', None)
     requires_locations = False
+    memory_base_gb = 2.0
+    memory_factor = 0.5
+    export_file_name = 'recording.dat'
 
     _default_params = {
         'detect_threshold': 6,
@@ -132,10 +135,13 @@ class Kilosort3Sorter(BaseSorter):
         if positions.shape[1] != 2:
             raise RuntimeError("3D 'location' are not supported. Set 2D locations instead")
 
-        # save binary file
-        input_file_path = output_folder / 'recording.dat'
-        recording.write_to_binary_dat_format(input_file_path, dtype='int16', chunk_mb=p["chunk_mb"],
-                                             verbose=self.verbose)
+        # save binary file, unless the recording is already an int16 time-major raw file without header
+        bindat_source = get_bindat_source(recording, dtype='int16')
+        if bindat_source is not None and bindat_source[1] == 0:
+            dat_file = bindat_source[0]
+        else:
+            input_file_path = output_folder / 'recording.dat'
+            dat_file = self._export_binary(recording, input_file_path, dtype='int16')
 
         if p['car']:
             use_car = 1
@@ -168,7 +174,7 @@ class Kilosort3Sorter(BaseSorter):
         kilosort3_config_txt = kilosort3_config_txt.format(
             nchan=recording.get_num_channels(),
             sample_rate=recording.get_sampling_frequency(),
-            dat_file=str((output_folder / 'recording.dat').absolute()),
+            dat_file=str(dat_file),
             nblocks=p['nblocks'],
             sig=p['sig'],
             projection_threshold=p['projection_threshold'],
@@ -219,7 +225,8 @@ class Kilosort3Sorter(BaseSorter):
                         matlab -nosplash -nodisplay -log -r kilosort3_master
                     '''.format(tmpdir=output_folder)
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
         retcode = shell_script.wait()
 
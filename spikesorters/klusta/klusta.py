@@ -24,6 +24,7 @@ class KlustaSorter(BaseSorter):
     sorter_name = 'klusta'
     
     requires_locations = False
+    export_file_name = 'recording.dat'
 
     _default_params = {
         'adjacency_radius': None,
@@ -99,10 +100,8 @@ class KlustaSorter(BaseSorter):
             dtype = recording._timeseries.dtype.str
         else:
             # save binary file (chunk by hcunk) into a new file
-            raw_filename = output_folder / 'recording.dat'
             dtype = 'int16'
-            recording.write_to_binary_dat_format(raw_filename, time_axis=0, dtype=dtype,chunk_mb=p["chunk_mb"],
-                                                n_jobs=p["n_jobs_bin"], verbose=self.verbose)
+            raw_filename = self._export_binary(recording, output_folder / 'recording.dat', dtype=dtype)
 
         if p['detect_sign'] < 0:
             detect_sign = 'negative'
@@ -143,7 +142,8 @@ class KlustaSorter(BaseSorter):
                     '''.format(klusta_config=output_folder / 'config.prm')
 
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()
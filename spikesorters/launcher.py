@@ -2,21 +2,37 @@
 Utils functions to launch several sorter on several recording in parralell or not.
 """
 import os
+import sys
+import asyncio
+import warnings
 from pathlib import Path
 import multiprocessing
 import shutil
 import json
 import traceback
 import json
+from collections.abc import Mapping
+import itertools
+import queue
+import threading
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import spikeextractors as se
+from joblib import Parallel, delayed
 
-from .sorterlist import sorter_dict, run_sorter
+from .sorterlist import sorter_dict, sorter_full_list, run_sorter, run_sorter_async
+from .sorter_tools import SpikeSortingError
+from .export_store import BinaryExportStore
+from .task_queue import TaskQueue
+from .run_catalog import RunCatalog
 
 
 def _run_one(arg_list):
     # the multiprocessing python module force to have one unique tuple argument
-    rec, sorter_name, output_folder, grouping_property, verbose, params, run_sorter_kwargs = arg_list
+    rec, sorter_name, output_folder, grouping_property, verbose, params, run_sorter_kwargs, export_folder = arg_list
     if isinstance(rec, dict):
         recording = se.load_extractor_from_dict(rec)
     else:
@@ -24,13 +40,452 @@ def _run_one(arg_list):
 
     SorterClass = sorter_dict[sorter_name]
     sorter = SorterClass(recording=recording, output_folder=output_folder,
-                         grouping_property=grouping_property, verbose=verbose, delete_output_folder=False)
+                         grouping_property=grouping_property, verbose=verbose, delete_output_folder=False,
+                         export_folder=export_folder)
     sorter.set_params(**params)
     sorter.run(**run_sorter_kwargs)
 
 
+def _imap_with_memory_budget(func, task_list, task_memory_gb, processes, memory_budget_gb):
+    """
+    Runs func on the tasks with a pool of processes and yields (index, output, error) in completion order.
+
+    If memory_budget_gb is given, a task is started only when the sum of the memory estimates of the running
+    tasks stays under memory_budget_gb. Tasks are started in input order, but a task that does not fit lets the
+    next smaller ones start first. A task bigger than the whole budget is run alone.
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    done_queue = queue.Queue()
+    pending = list(range(len(task_list)))
+    running = {}
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            used_gb = sum(running.values())
+            for index in list(pending):
+                if len(running) >= processes:
+                    break
+                fits = memory_budget_gb is None or used_gb + task_memory_gb[index] <= memory_budget_gb
+                if fits or len(running) == 0:
+                    if not fits:
+                        print(f'WARNING! Task {index} needs ~{task_memory_gb[index]:.1f} GB which is more than '
+                              f'memory_budget_gb={memory_budget_gb}: it is run alone')
+                    pending.remove(index)
+                    running[index] = task_memory_gb[index]
+                    used_gb += task_memory_gb[index]
+                    pool.apply_async(func, (task_list[index],),
+                                     callback=lambda output, index=index: done_queue.put((index, output, None)),
+                                     error_callback=lambda err, index=index: done_queue.put((index, None, err)))
+            index, output, err = done_queue.get()
+            running.pop(index)
+            yield index, output, err
+    finally:
+        # when the iteration is stopped early, the running tasks are finished but no new task is started
+        pool.close()
+        pool.join()
+
+
+def _iter_tasks(task_list, task_memory_gb, engine, engine_kwargs, working_folder):
+    """
+    Runs the tasks with the engine and yields (index, error) in completion order.
+    error is None when the task did not raise.
+    """
+    if engine == 'loop':
+        # simple loop in main process
+        for index, arg_list in enumerate(task_list):
+            try:
+                _run_one(arg_list)
+            except Exception as err:
+                yield index, err
+            else:
+                yield index, None
+
+    elif engine == 'multiprocessing':
+        # use mp.Pool
+        processes = engine_kwargs.get('processes', None)
+        memory_budget_gb = engine_kwargs.get('memory_budget_gb', None)
+        for index, _, err in _imap_with_memory_budget(_run_one, task_list, task_memory_gb, processes,
+                                                      memory_budget_gb):
+            yield index, err
+
+    elif engine == 'dask':
+        from dask.distributed import as_completed
+
+        client = engine_kwargs.get('client', None)
+        assert client is not None, 'For dask engine you have to provide : client = dask.distributed.Client(...)'
+
+        tasks = {}
+        for index, arg_list in enumerate(task_list):
+            task = client.submit(_run_one, arg_list)
+            tasks[task] = index
+
+        for task in as_completed(tasks):
+            err = task.exception() if task.status == 'error' else None
+            yield tasks[task], err
+
+    elif engine == 'asyncio':
+        max_concurrency = engine_kwargs.get('max_concurrency', None)
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count()
+        for index, err in _iter_tasks_asyncio(task_list, max_concurrency):
+            yield index, err
+
+    elif engine == 'concurrent_futures':
+        for index, err in _iter_tasks_concurrent_futures(task_list, **engine_kwargs):
+            yield index, err
+
+    elif engine == 'sqlite':
+        db_path = Path(working_folder) / _task_queue_filename
+        for index, err in _iter_tasks_sqlite(task_list, db_path, **engine_kwargs):
+            yield index, err
+
+    elif engine == 'shared_folder':
+        for index, err in _iter_tasks_shared_folder(task_list, working_folder, **engine_kwargs):
+            yield index, err
+
+    else:
+        raise ValueError("engine must be 'loop', 'multiprocessing', 'dask', 'asyncio', 'concurrent_futures', "
+                         "'sqlite' or 'shared_folder'")
+
+
+def _iter_tasks_concurrent_futures(task_list, max_workers=None, mp_context='spawn', max_tasks_per_child=1,
+                                   use_threads=False):
+    """
+    Runs the tasks with a concurrent.futures executor and yields (index, error) in completion order.
+    """
+    if use_threads:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        executor_kwargs = {}
+        if max_tasks_per_child is not None:
+            if sys.version_info >= (3, 11):
+                executor_kwargs['max_tasks_per_child'] = max_tasks_per_child
+            else:
+                warnings.warn('max_tasks_per_child needs python>=3.11: the worker processes are not recycled')
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(mp_context),
+                                       **executor_kwargs)
+
+    futures = {}
+    try:
+        for index, arg_list in enumerate(task_list):
+            futures[executor.submit(_run_one, arg_list)] = index
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
+    finally:
+        # when the iteration is stopped early, the waiting tasks are cancelled and the running ones finish
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _iter_tasks_asyncio(task_list, max_concurrency):
+    """
+    Runs the tasks with run_sorter_async() in an event loop, at most max_concurrency at the same time, and yields
+    (index, error) in completion order.
+    The event loop runs in its own thread, so that the engine also works from a running event loop (e.g. jupyter).
+    """
+    done_queue = queue.Queue()
+    stop = threading.Event()
+
+    async def run_tasks():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # the default executor of the loop has fewer threads than max_concurrency on small machines
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+
+            async def run_task(index, arg_list):
+                rec, sorter_name, output_folder, grouping_property, verbose, params, run_sorter_kwargs, \
+                    export_folder = arg_list
+                async with semaphore:
+                    if stop.is_set():
+                        return
+                    try:
+                        # the semaphore is taken here so that the waiting tasks can be skipped
+                        await run_sorter_async(sorter_name, rec, executor=executor, output_folder=output_folder,
+                                               grouping_property=grouping_property, verbose=verbose,
+                                               export_folder=export_folder, **run_sorter_kwargs, **params)
+                    except Exception as err:
+                        done_queue.put((index, err))
+                    else:
+                        done_queue.put((index, None))
+
+            await asyncio.gather(*[run_task(index, arg_list) for index, arg_list in enumerate(task_list)])
+
+    def run_loop():
+        try:
+            asyncio.run(run_tasks())
+        except BaseException as err:
+            done_queue.put(err)
+
+    loop_thread = threading.Thread(target=run_loop, daemon=True)
+    loop_thread.start()
+    try:
+        for _ in range(len(task_list)):
+            item = done_queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # when the iteration is stopped early, the waiting tasks are not started and the running ones finish
+        stop.set()
+        loop_thread.join()
+
+
+_task_queue_filename = 'spikesorters_tasks.sqlite'
+
+
+def _run_queue_worker(db_path, heartbeat_interval, stop_event):
+    """
+    Runs the tasks of the queue until it is empty or stop_event is set.
+    """
+    task_queue = TaskQueue(db_path)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    while not stop_event.is_set():
+        claimed = task_queue.claim(worker)
+        if claimed is None:
+            break
+        task_id, arg_list = claimed
+        heartbeat_stop = threading.Event()
+
+        def send_heartbeat():
+            while not heartbeat_stop.wait(heartbeat_interval):
+                task_queue.heartbeat(task_id, worker=worker)
+
+        heartbeat_thread = threading.Thread(target=send_heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            _run_one(arg_list)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            heartbeat_stop.set()
+            heartbeat_thread.join()
+        task_queue.finish(task_id, error, worker=worker)
+
+
+def _iter_tasks_sqlite(task_list, db_path, processes=None, heartbeat_interval=10., stale_timeout=60.,
+                       poll_interval=1., retry_failed=False):
+    """
+    Runs the tasks with local worker processes pulling from a SQLite queue and yields (index, error)
+    in completion order. Tasks already done in the queue (previous run) are yielded first, tasks that already
+    failed (and are not retried) are yielded last so that an old failure does not stop the pending tasks.
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    task_queue = TaskQueue(db_path)
+    keys = [str(arg_list[2]) for arg_list in task_list]
+    task_queue.add_tasks(keys, task_list)
+    if retry_failed:
+        task_queue.reset(('failed',))
+    index_of_key = {key: index for index, key in enumerate(keys)}
+    previous_failures = {key: error for key, (state, error) in task_queue.get_states().items()
+                         if key in index_of_key and state == 'failed'}
+
+    ctx = multiprocessing.get_context('spawn')
+    stop_event = ctx.Event()
+    workers = []
+    reported = set()
+    try:
+        while True:
+            # the tasks of dead workers go back in the queue
+            task_queue.requeue_stale(stale_timeout)
+            for key, (state, error) in task_queue.get_states().items():
+                if key in reported or key in previous_failures or key not in index_of_key or \
+                        state not in ('done', 'failed'):
+                    continue
+                reported.add(key)
+                err = None if state == 'done' else SpikeSortingError(f'Task {key} failed:\n{error}')
+                yield index_of_key[key], err
+            n_pending = task_queue.count('pending')
+            if n_pending == 0 and task_queue.count('running') == 0:
+                break
+            # keep enough workers alive for the pending tasks
+            workers = [worker for worker in workers if worker.is_alive()]
+            for _ in range(min(processes - len(workers), n_pending)):
+                worker = ctx.Process(target=_run_queue_worker, args=(str(db_path), heartbeat_interval, stop_event))
+                worker.start()
+                workers.append(worker)
+            time.sleep(poll_interval)
+        for key, error in previous_failures.items():
+            yield index_of_key[key], SpikeSortingError(f'Task {key} failed:\n{error}')
+    finally:
+        # when the iteration is stopped early, the running tasks are finished and the other ones stay pending
+        stop_event.set()
+        for worker in workers:
+            worker.join()
+
+
+def _iter_tasks_shared_folder(task_list, working_folder, processes=1, heartbeat_interval=10., stale_timeout=60.,
+                              poll_interval=5.):
+    """
+    Writes the tasks in the working folder, starts processes local workers and yields (index, error) when the
+    tasks are done, whoever ran them (local workers or 'python -m spikesorters.worker' on other nodes).
+    """
+    # imported here so that 'python -m spikesorters.worker' does not find the module already imported
+    from .worker import write_tasks, read_done, has_running_task, remove_tasks
+
+    names = write_tasks(working_folder, task_list)
+    worker_cmd = [sys.executable, '-m', 'spikesorters.worker', str(working_folder),
+                  '--heartbeat-interval', str(heartbeat_interval), '--stale-timeout', str(stale_timeout),
+                  '--poll-interval', str(poll_interval)]
+    workers = [subprocess.Popen(worker_cmd) for _ in range(processes)]
+    remaining = dict(enumerate(names))
+
+    def read_remaining_done():
+        for index, name in list(remaining.items()):
+            done = read_done(working_folder, name)
+            if done is None:
+                continue
+            remaining.pop(index)
+            err = None if done['error'] is None else SpikeSortingError(f"Task {name} failed on "
+                                                                       f"{done['worker']}:\n{done['error']}")
+            yield index, err
+
+    completed = False
+    try:
+        while len(remaining) > 0:
+            yield from read_remaining_done()
+            if len(remaining) == 0:
+                break
+            if len(workers) > 0 and all(worker.poll() is not None for worker in workers):
+                # a worker can finish a task just before exiting
+                yield from read_remaining_done()
+                if len(remaining) > 0 and not has_running_task(working_folder, remaining.values(), stale_timeout):
+                    exit_codes = [worker.returncode for worker in workers]
+                    raise SpikeSortingError(f"The local workers exited (exit codes {exit_codes}) and no worker runs "
+                                            f"the {len(remaining)} remaining tasks")
+            if len(remaining) > 0:
+                time.sleep(poll_interval)
+        completed = True
+    finally:
+        if completed:
+            # the local workers exit when all the tasks are done
+            for worker in workers:
+                worker.wait()
+        else:
+            # stopped early or failed: the local workers are stopped, the tasks running on other nodes finish
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.terminate()
+            for worker in workers:
+                try:
+                    worker.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+                    worker.wait()
+        # the tasks of this call must not be run again by the workers of a later call
+        remove_tasks(working_folder, names)
+
+
+def _prepare_tasks(sorter_list, recording_dict_or_list, working_folder, sorter_params, grouping_property, mode,
+                   engine, engine_kwargs, verbose, run_sorter_kwargs, export_folder):
+    """
+    Returns the task list, the (rec_name, sorter_name) of each task, the memory estimate of each task,
+    the (rec_name, sorter_name, output_folder) of the outputs kept with mode='keep' and the run catalog.
+    """
+    # absolute because the tasks can be run from another folder (engine='shared_folder')
+    working_folder = Path(working_folder).absolute()
+    if mode == 'raise':
+        assert not working_folder.is_dir(), "'working_folder' already exists, please remove it"
+
+    for sorter_name in sorter_list:
+        assert sorter_name in sorter_dict, '{} is not in sorter list'.format(sorter_name)
+
+    if isinstance(recording_dict_or_list, list):
+        # in case of list
+        recording_dict = {'recording_{}'.format(i): rec for i, rec in enumerate(recording_dict_or_list)}
+    elif isinstance(recording_dict_or_list, dict):
+        recording_dict = recording_dict_or_list
+    else:
+        raise (ValueError('bad recording dict'))
+
+    # when  grouping_property is not None : split in subrecording
+    # but the subrecording must have len=1 because otherwise it break
+    # the internal organisation of folder name.
+    if grouping_property is not None:
+        for rec_name, recording in recording_dict.items():
+            recording_list = recording.get_sub_extractors_by_property(grouping_property)
+            n_group = len(recording_list)
+            assert n_group == 1, 'run_sorters() works only if grouping_property=None or if it split into one subrecording'
+            recording_dict[rec_name] = recording_list[0]
+        grouping_property = None
+
+    # these engines run the sorters in threads of the main process
+    threaded = engine == 'asyncio' or (engine == 'concurrent_futures' and engine_kwargs.get('use_threads', False))
+    if threaded:
+        for sorter_name in sorter_list:
+            assert sorter_dict[sorter_name].compatible_with_parallel['threading'], \
+                f'run_sorters(engine="{engine}") runs the sorters in threads and {sorter_name} is not compatible'
+
+    need_serialize = engine != 'loop' and not threaded
+
+    if engine == 'sqlite' and mode == 'overwrite':
+        db_path = working_folder / _task_queue_filename
+        if db_path.is_file():
+            db_path.unlink()
+
+    catalog = RunCatalog(working_folder)
+
+    # the time waited by the tasks in the engine (e.g. memory budget) is part of their queue_wait timing.
+    # the sqlite and shared_folder queues keep their tasks across calls: their blobs must not change.
+    # asyncio runs the tasks with run_sorter(), which counts its own queue_wait
+    if engine not in ('sqlite', 'shared_folder', 'asyncio'):
+        run_sorter_kwargs = dict(run_sorter_kwargs, submit_time=time.time())
+
+    task_list = []
+    task_names = []
+    task_memory_gb = []
+    kept_outputs = []
+    for rec_name, recording in recording_dict.items():
+        for sorter_name in sorter_list:
+
+            output_folder = working_folder / rec_name / sorter_name
+
+            # with engine='sqlite' and mode='keep', the state of the tasks comes from the queue
+            check_log = engine != 'sqlite' or mode != 'keep'
+            if check_log and _is_run_ok(catalog, rec_name, sorter_name, output_folder):
+                # check is output_folders exists
+                if mode == 'raise':
+                    raise (Exception('output folder already exists for {} {}'.format(rec_name, sorter_name)))
+                elif mode == 'overwrite':
+                    shutil.rmtree(str(output_folder))
+                    catalog.remove(rec_name, sorter_name)
+                elif mode == 'keep':
+                    kept_outputs.append((rec_name, sorter_name, output_folder))
+                    continue
+                else:
+                    raise (ValueError('mode not in raise, overwrite, keep'))
+            params = sorter_params.get(sorter_name, {})
+            if need_serialize:
+                assert recording.check_if_dumpable(), 'run_sorters(engine=... ) if engine is not "loop" then recording have to be dumpable'
+                rec = recording.dump_to_dict()
+            else:
+                rec = recording
+            task_list.append((rec, sorter_name, output_folder, grouping_property, verbose, params, run_sorter_kwargs,
+                              export_folder))
+            task_names.append((rec_name, sorter_name))
+            task_memory_gb.append(sorter_dict[sorter_name].estimate_memory_gb(recording))
+
+    return task_list, task_names, task_memory_gb, kept_outputs, catalog
+
+
+def _is_run_ok(catalog, rec_name, sorter_name, output_folder):
+    run = catalog.get(rec_name, sorter_name)
+    if run is None:
+        # run made before the catalog: read the log once
+        if not (output_folder / 'spikeinterface_log.json').is_file():
+            return False
+        catalog.update(rec_name, sorter_name, output_folder)
+        run = catalog.get(rec_name, sorter_name)
+    # the log file is checked (without being parsed) in case the folder was removed
+    return run['status'] == 'ok' and (output_folder / 'spikeinterface_log.json').is_file()
+
+
 def run_sorters(sorter_list, recording_dict_or_list, working_folder, sorter_params={}, grouping_property=None,
-                mode='raise', engine=None, engine_kwargs={}, verbose=False, with_output=True, run_sorter_kwargs={}):
+                mode='raise', engine=None, engine_kwargs={}, verbose=False, with_output=True, run_sorter_kwargs={},
+                export_folder=None):
     """
     Run several sorters on several recordings.
 
@@ -53,16 +508,43 @@ def run_sorters(sorter_list, recording_dict_or_list, working_folder, sorter_para
             * 'raise' : raise error if subfolder exists
             * 'overwrite' : force recompute
             * 'keep' : do not compute again if f=subfolder exists and log is OK
-    engine: 'loop' or 'multiprocessing' or 'dask'
+    engine: 'loop' or 'multiprocessing' or 'dask' or 'asyncio' or 'concurrent_futures' or 'sqlite' or
+            'shared_folder'
         Which approach to use to run the multiple sorters.
             * 'loop' : run sorters in a loop (serially)
             * 'multiprocessing' : use the Python multiprocessing library to run in parallel
             * 'dask' : use the Dask module to run in parallel
+            * 'asyncio' : run the sorters with run_sorter_async() in an event loop, with the number of sorters
+              running at the same time bounded by a semaphore. Suited to shell based sorters which mostly wait for
+              their process. Recordings are not serialized.
+            * 'concurrent_futures' : use a concurrent.futures ProcessPoolExecutor with fresh (spawn) worker
+              processes, which also works for sorters using multiprocessing internally
+            * 'sqlite' : local worker processes pull the tasks from a SQLite queue stored in the working folder,
+              which keeps the state, timings and errors of each task. An interrupted batch is resumed by
+              calling run_sorters again with mode='keep' (see spikesorters.TaskQueue to inspect the queue)
+            * 'shared_folder' : the tasks are written in the working folder and run by worker processes
+              started with 'python -m spikesorters.worker <working_folder>' on any node sharing the working
+              folder (e.g. NFS). The workers claim the tasks with lock files
     engine_kwargs: dict
         This contains kwargs specific to the launcher engine:
             * 'loop' : no kargs
-            * 'multiprocessing' : {'processes' : } number of processes
+            * 'multiprocessing' : {'processes' : } number of processes, {'memory_budget_gb' : } if given, tasks
+              are only started while the sum of their estimated peak memory fits in this budget (see Notes)
             * 'dask' : {'client':} the dask client for submiting task
+            * 'asyncio' : {'max_concurrency' : } number of sorters running at the same time (default cpu count)
+            * 'concurrent_futures' : {'max_workers' : } number of workers (default of the executor),
+              {'mp_context' : } 'spawn' (default) or 'forkserver',
+              {'max_tasks_per_child' : } tasks run by a worker process before it is replaced (default 1,
+              python>=3.11, None to keep the workers),
+              {'use_threads' : } if True, use a ThreadPoolExecutor instead (default False), suited to shell
+              based sorters. Recordings are then not serialized.
+            * 'sqlite' : {'processes' : } number of worker processes (default cpu count),
+              {'heartbeat_interval' : } in s (default 10), {'stale_timeout' : } running tasks without heartbeat
+              for this time in s are run again (default 60), {'retry_failed' : } run again the tasks that failed
+              in a previous run (default False)
+            * 'shared_folder' : {'processes' : } number of workers started locally (default 1, 0 to only use
+              workers started on other nodes), {'heartbeat_interval' : } and {'stale_timeout' : } in s (default 10
+              and 60) for the local workers, {'poll_interval' : } in s (default 5)
     verbose: bool
         Controls sorter verbosity.
     with_output: bool
@@ -73,6 +555,12 @@ def run_sorters(sorter_list, recording_dict_or_list, working_folder, sorter_para
             * 'parallel' : bool
             * 'n_jobs' : int
             * 'joblib_backend' : 'loky' / 'multiprocessing' / 'threading'
+            * 'timeout' : float, maximum run time in s of shell based sorters
+            * 'inactivity_timeout' : float, shell based sorters are stopped after this time in s without output
+    export_folder: str or None
+        If given, the binary copies of each recording needed by several sorters (Kilosort family, YASS, Klusta)
+        are written once in this folder and hardlinked in the sorter folders. Copies that are not used anymore
+        are removed at the end.
 
     Returns
     -------
@@ -81,97 +569,266 @@ def run_sorters(sorter_list, recording_dict_or_list, working_folder, sorter_para
 
     Notes
     -----
+    A catalog of the runs (status, run time, params hash, number of units and spikes, output size) is kept in
+    the working folder and updated at the end of each run. It is used by mode='keep' and with_output=True, and
+    can be queried with RunCatalog(working_folder).
+
     Using multiprocessing through this function does not allow for subprocesses, so
-    sorters that already use internally multiprocessing will fail.
+    sorters that already use internally multiprocessing will fail. Use engine='concurrent_futures' for them.
+
+    The peak memory of a task is estimated with SorterClass.estimate_memory_gb(recording), from the size of the
+    traces and the memory_base_gb / memory_factor attributes of the sorter. These are rough values: keep some
+    margin in memory_budget_gb.
     """
-    working_folder = Path(working_folder)
-    if mode == 'raise':
-        assert not working_folder.is_dir(), "'working_folder' already exists, please remove it"
+    if engine is None:
+        engine = 'loop'
+
+    task_list, task_names, task_memory_gb, _, catalog = _prepare_tasks(
+        sorter_list, recording_dict_or_list, working_folder, sorter_params, grouping_property, mode, engine,
+        engine_kwargs, verbose, run_sorter_kwargs, export_folder)
+
+    for index, err in _iter_tasks(task_list, task_memory_gb, engine, engine_kwargs, working_folder):
+        rec_name, sorter_name = task_names[index]
+        catalog.update(rec_name, sorter_name, task_list[index][2])
+        if err is not None:
+            raise err
+
+    if export_folder is not None:
+        BinaryExportStore(export_folder).cleanup()
+
+    if with_output:
+        if engine == 'dask':
+            print('Warning!! With engine="dask" you cannot have directly output results\n' \
+                  'Use : run_sorters(..., with_output=False)\n' \
+                  'And then: results = collect_sorting_outputs(output_folders)')
+            return
+
+        # the runs that succeeded are read from the catalog instead of scanning the working folder
+        results = {}
+        for run in catalog.done():
+            rec_name, sorter_name, output_folder = run['rec_name'], run['sorter_name'], Path(run['output_folder'])
+            if not output_folder.is_dir():
+                # removed since its run
+                catalog.remove(rec_name, sorter_name)
+                continue
+            SorterClass = sorter_dict[sorter_name]
+            sorting = SorterClass.get_result_from_folder(output_folder)
+            catalog.set_sorting(rec_name, sorter_name, sorting)
+            results[(rec_name, sorter_name)] = sorting
+        return results
 
+
+def iter_run_sorters(sorter_list, recording_dict_or_list, working_folder, sorter_params={}, grouping_property=None,
+                     mode='raise', engine=None, engine_kwargs={}, verbose=False, run_sorter_kwargs={},
+                     export_folder=None):
+    """
+    Same as run_sorters() but yields (rec_name, sorter_name, sorting_or_error) as soon as each task is done.
+
+    The results kept with mode='keep' are yielded first, then the other ones in completion order.
+    When a sorter fails, or its output can't be loaded, the exception is yielded instead of the SortingExtractor
+    and the other tasks continue. Stopping the iteration early lets the running tasks finish but does not start
+    new ones.
+
+    The parameters are the ones of run_sorters(). With engine='dask', the working_folder must be readable
+    from the main process.
+    """
     if engine is None:
         engine = 'loop'
 
-    for sorter_name in sorter_list:
-        assert sorter_name in sorter_dict, '{} is not in sorter list'.format(sorter_name)
+    task_list, task_names, task_memory_gb, kept_outputs, catalog = _prepare_tasks(
+        sorter_list, recording_dict_or_list, working_folder, sorter_params, grouping_property, mode, engine,
+        engine_kwargs, verbose, run_sorter_kwargs, export_folder)
 
-    if isinstance(recording_dict_or_list, list):
-        # in case of list
-        recording_dict = {'recording_{}'.format(i): rec for i, rec in enumerate(recording_dict_or_list)}
-    elif isinstance(recording_dict_or_list, dict):
-        recording_dict = recording_dict_or_list
+    try:
+        for rec_name, sorter_name, output_folder in kept_outputs:
+            yield rec_name, sorter_name, _load_sorting_or_error(rec_name, sorter_name, output_folder)
+
+        for index, err in _iter_tasks(task_list, task_memory_gb, engine, engine_kwargs, working_folder):
+            rec_name, sorter_name = task_names[index]
+            output_folder = task_list[index][2]
+            if err is None:
+                result = _load_sorting_or_error(rec_name, sorter_name, output_folder)
+            else:
+                result = err
+            catalog.update(rec_name, sorter_name, output_folder,
+                           sorting=None if isinstance(result, Exception) else result)
+            yield rec_name, sorter_name, result
+    finally:
+        if export_folder is not None:
+            BinaryExportStore(export_folder).cleanup()
+
+
+def _load_sorting_or_error(rec_name, sorter_name, output_folder):
+    if not is_log_ok(output_folder):
+        # run with raise_error=False
+        return SpikeSortingError(f"{sorter_name} failed on {rec_name}. You can inspect the runtime trace in "
+                                 f"{output_folder / 'spikeinterface_log.json'}")
+    try:
+        return sorter_dict[sorter_name].get_result_from_folder(output_folder)
+    except Exception as err:
+        return err
+
+
+def _setup_sweep_point(rec, SorterClass, setup_folder, verbose, params, export_folder):
+    if isinstance(rec, dict):
+        recording = se.load_extractor_from_dict(rec)
     else:
-        raise (ValueError('bad recording dict'))
+        recording = rec
+    sorter = SorterClass(recording=recording, output_folder=setup_folder, verbose=verbose,
+                         delete_output_folder=False, export_folder=export_folder)
+    sorter.set_params(**params)
+    try:
+        sorter._setup_recording(sorter.recording_list[0], sorter.output_folders[0])
+    except Exception:
+        # the points do their own setup and report the error in their log
+        return None
+    return sorter._exported_files
 
-    # when  grouping_property is not None : split in subrecording
-    # but the subrecording must have len=1 because otherwise it break
-    # the internal organisation of folder name.
-    if grouping_property is not None:
-        for rec_name, recording in recording_dict.items():
-            recording_list = recording.get_sub_extractors_by_property(grouping_property)
-            n_group = len(recording_list)
-            assert n_group == 1, 'run_sorters() works only if grouping_property=None or if it split into one subrecording'
-            recording_dict[rec_name] = recording_list[0]
-        grouping_property = None
 
-    need_serialize = engine != 'loop'
+def _run_sweep_point(rec, SorterClass, output_folder, verbose, params, raise_error, export_folder,
+                     setup_folder=None):
+    if isinstance(rec, dict):
+        recording = se.load_extractor_from_dict(rec)
+    else:
+        recording = rec
+    sorter = SorterClass(recording=recording, output_folder=output_folder, verbose=verbose,
+                         delete_output_folder=False, export_folder=export_folder)
+    if setup_folder is not None:
+        sorter._copy_setup(setup_folder, sorter.output_folders[0])
+    sorter.set_params(**params)
+    sorter.run(raise_error=raise_error, skip_setup=setup_folder is not None)
 
-    task_list = []
-    for rec_name, recording in recording_dict.items():
-        for sorter_name in sorter_list:
 
-            output_folder = working_folder / rec_name / sorter_name
+def _group_by_setup(SorterClass, params_list):
+    # indices of the grid points with the same values of the params read by the setup
+    groups = {}
+    for i, params in enumerate(params_list):
+        full_params = dict(SorterClass.default_params(), **params)
+        key = _params_key({name: full_params[name] for name in SorterClass.setup_params})
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
 
-            if is_log_ok(output_folder):
-                # check is output_folders exists
-                if mode == 'raise':
-                    raise (Exception('output folder already exists for {} {}'.format(rec_name, sorter_name)))
-                elif mode == 'overwrite':
-                    shutil.rmtree(str(output_folder))
-                elif mode == 'keep':
-                    continue
-                else:
-                    raise (ValueError('mode not in raise, overwrite, keep'))
-            params = sorter_params.get(sorter_name, {})
-            if need_serialize:
-                assert recording.check_if_dumpable(), 'run_sorters(engine=... ) if engine is not "loop" then recording have to be dumpable'
-                rec = recording.dump_to_dict()
-            else:
-                rec = recording
-            task_list.append((rec, sorter_name, output_folder, grouping_property, verbose, params, run_sorter_kwargs))
 
-    if engine == 'loop':
-        # simple loop in main process
-        for arg_list in task_list:
-            _run_one(arg_list)
+def _expand_param_grid(param_grid):
+    if isinstance(param_grid, dict):
+        param_grid = [param_grid]
+    params_list = []
+    for grid in param_grid:
+        names = sorted(grid.keys())
+        for values in itertools.product(*[grid[name] for name in names]):
+            params_list.append(dict(zip(names, values)))
+    return params_list
 
-    elif engine == 'multiprocessing':
-        # use mp.Pool
-        processes = engine_kwargs.get('processes', None)
-        pool = multiprocessing.Pool(processes)
-        pool.map(_run_one, task_list)
-        pool.close()
 
-    elif engine == 'dask':
-        client = engine_kwargs.get('client', None)
-        assert client is not None, 'For dask engine you have to provide : client = dask.distributed.Client(...)'
+def _params_key(params):
+    return tuple((name, tuple(value) if isinstance(value, list) else value)
+                 for name, value in sorted(params.items()))
 
-        tasks = []
-        for arg_list in task_list:
-            task = client.submit(_run_one, arg_list)
-            tasks.append(task)
 
-        for task in tasks:
-            task.result()
+def run_sorter_sweep(sorter_name_or_class, recording, param_grid, output_folder=None, n_jobs=1,
+                     joblib_backend='loky', verbose=False, raise_error=True):
+    """
+    Runs one sorter on one recording for all the points of a parameter grid.
 
-    if with_output:
-        if engine == 'dask':
-            print('Warning!! With engine="dask" you cannot have directly output results\n' \
-                  'Use : run_sorters(..., with_output=False)\n' \
-                  'And then: results = collect_sorting_outputs(output_folders)')
-            return
+    Each point is run in its own sub folder of output_folder. For the sorters declaring the params read by their
+    setup (setup_params: Tridesclous, Combinato, WaveClus), the setup is done once for the points with the same
+    values of these params and copied in their sub folders, the data files being hardlinked. For the other
+    sorters, only the binary copy of the recording made with _export_binary (Kilosort family, YASS, Klusta,
+    SpykingCircus) is shared: it is exported once and hardlinked in all the sub folders.
 
-        results = collect_sorting_outputs(working_folder)
-        return results
+    Parameters
+    ----------
+    sorter_name_or_class: str or SorterClass
+        The sorter to run
+    recording: RecordingExtractor
+        The recording extractor to be spike sorted
+    param_grid: dict or list of dict
+        Dict with parameter names as keys and lists of values to try. All the combinations are run.
+        A list of dicts runs the combinations of each grid (same as sklearn ParameterGrid).
+        Parameters that are not in the grid take their default value.
+    output_folder: str or Path
+        Path to output folder (default '{sorter_name}_sweep')
+    n_jobs: int
+        Number of grid points run in parallel (default 1)
+    joblib_backend: str
+        joblib backend when n_jobs != 1 (default 'loky')
+    verbose: bool
+        If True, output is verbose
+    raise_error: bool
+        If True, an error is raised if one of the runs fails (default). If False, the other runs continue and the
+        result of the failed ones is None.
+
+    Returns
+    -------
+    results: dict
+        SortingExtractor of each grid point, with the tuple of sorted (param_name, value) pairs as key.
+    """
+    if isinstance(sorter_name_or_class, str):
+        SorterClass = sorter_dict[sorter_name_or_class]
+    elif sorter_name_or_class in sorter_full_list:
+        SorterClass = sorter_name_or_class
+    else:
+        raise (ValueError('Unknown sorter'))
+
+    if output_folder is None:
+        output_folder = SorterClass.sorter_name + '_sweep'
+    output_folder = Path(output_folder).absolute()
+    output_folder.mkdir(parents=True, exist_ok=True)
+    export_folder = output_folder / 'export_store'
+
+    params_list = _expand_param_grid(param_grid)
+    output_folders = [output_folder / f'params_{i}' for i in range(len(params_list))]
+    with open(output_folder / 'sweep_params.json', 'w', encoding='utf8') as f:
+        json.dump({folder.name: params for folder, params in zip(output_folders, params_list)}, f, indent=4,
+                  default=str)
+
+    if n_jobs != 1 and joblib_backend != 'threading':
+        assert recording.check_if_dumpable(), 'run_sorter_sweep(n_jobs=...) if n_jobs is not 1 then the ' \
+                                              'recording has to be dumpable'
+        rec = recording.dump_to_dict()
+    else:
+        rec = recording
+
+    setup_folders = [None] * len(params_list)
+    setups_folder = output_folder / 'setups'
+    shared_exports = []
+    try:
+        if SorterClass.setup_params is not None:
+            setup_jobs = [(setups_folder / f'setup_{j}', indices)
+                          for j, indices in enumerate(_group_by_setup(SorterClass, params_list))
+                          if len(indices) > 1]
+            outputs = Parallel(n_jobs=n_jobs, backend=joblib_backend)(
+                delayed(_setup_sweep_point)(rec, SorterClass, setup_folder, verbose, params_list[indices[0]],
+                                            export_folder)
+                for setup_folder, indices in setup_jobs)
+            for (setup_folder, indices), exported_files in zip(setup_jobs, outputs):
+                if exported_files is None:
+                    continue
+                shared_exports.extend(exported_files)
+                for i in indices:
+                    setup_folders[i] = setup_folder
+
+        Parallel(n_jobs=n_jobs, backend=joblib_backend)(
+            delayed(_run_sweep_point)(rec, SorterClass, folder, verbose, params, raise_error, export_folder,
+                                      setup_folder)
+            for folder, params, setup_folder in zip(output_folders, params_list, setup_folders))
+    finally:
+        export_store = BinaryExportStore(export_folder)
+        for file_path in shared_exports:
+            export_store.release(file_path)
+        export_store.cleanup()
+        if setups_folder.is_dir():
+            shutil.rmtree(str(setups_folder))
+
+    results = {}
+    for folder, params in zip(output_folders, params_list):
+        if is_log_ok(folder):
+            sorting = SorterClass.get_result_from_folder(folder)
+            sorting.set_sampling_frequency(recording.get_sampling_frequency())
+        else:
+            sorting = None
+        results[_params_key(params)] = sorting
+    return results
 
 
 def is_log_ok(output_folder):
@@ -199,24 +856,87 @@ def iter_output_folders(output_folders):
             yield rec_name, sorter_name, output_folder
 
 
-def iter_sorting_output(output_folders):
+def _load_sorting_output(sorter_name, output_folder, use_spike_store=False):
+    SorterClass = sorter_dict[sorter_name]
+    if use_spike_store:
+        return SorterClass.get_spike_store_from_folder(output_folder)
+    return SorterClass.get_result_from_folder(output_folder)
+
+
+def iter_sorting_output(output_folders, use_spike_store=False):
     """
     Iterator over output_folder to retrieve all triplets
     (rec_name, sorter_name, sorting)
     """
     for rec_name, sorter_name, output_folder in iter_output_folders(output_folders):
-        SorterClass = sorter_dict[sorter_name]
-        sorting = SorterClass.get_result_from_folder(output_folder)
+        sorting = _load_sorting_output(sorter_name, output_folder, use_spike_store=use_spike_store)
         yield rec_name, sorter_name, sorting
 
 
-def collect_sorting_outputs(output_folders):
+def collect_sorting_outputs(output_folders, lazy=False, use_spike_store=False):
     """
     Collect results in a output_folders.
 
     The output is a  dict with double key access results[(rec_name, sorter_name)] of SortingExtractor.
+
+    If lazy=True, the output is a LazySortingOutputs mapping which loads each SortingExtractor on first access.
+    Use results.prefetch(n_jobs=...) to load them in parallel threads.
+
+    If use_spike_store=True, the sortings are loaded from the spike store of each output folder, which is faster
+    but only keeps the spike trains and unit properties (see BaseSorter.get_spike_store_from_folder).
     """
+    if lazy:
+        return LazySortingOutputs(output_folders, use_spike_store=use_spike_store)
     results = {}
-    for rec_name, sorter_name, sorting in iter_sorting_output(output_folders):
+    for rec_name, sorter_name, sorting in iter_sorting_output(output_folders, use_spike_store=use_spike_store):
         results[(rec_name, sorter_name)] = sorting
     return results
+
+
+class LazySortingOutputs(Mapping):
+    """
+    Read-only mapping results[(rec_name, sorter_name)] of SortingExtractor, loaded from the output folders
+    only when accessed. Loaded sortings are kept.
+    """
+    def __init__(self, output_folders, use_spike_store=False):
+        self._output_folders = {(rec_name, sorter_name): output_folder
+                                for rec_name, sorter_name, output_folder in iter_output_folders(output_folders)}
+        self._use_spike_store = use_spike_store
+        self._sortings = {}
+        self._locks = {key: threading.Lock() for key in self._output_folders}
+
+    def __getitem__(self, key):
+        if key not in self._output_folders:
+            raise KeyError(key)
+        # a sorting accessed from several threads is loaded once
+        with self._locks[key]:
+            if key not in self._sortings:
+                rec_name, sorter_name = key
+                self._sortings[key] = _load_sorting_output(sorter_name, self._output_folders[key],
+                                                           use_spike_store=self._use_spike_store)
+        return self._sortings[key]
+
+    def __iter__(self):
+        return iter(self._output_folders)
+
+    def __len__(self):
+        return len(self._output_folders)
+
+    def __repr__(self):
+        return f'LazySortingOutputs: {len(self)} outputs, {len(self._sortings)} loaded'
+
+    def is_loaded(self, key):
+        return key in self._sortings
+
+    def get_output_folder(self, key):
+        return self._output_folders[key]
+
+    def prefetch(self, keys=None, n_jobs=4):
+        """
+        Loads the sortings of keys (default all) with n_jobs threads.
+        """
+        if keys is None:
+            keys = list(self._output_folders.keys())
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(self.__getitem__, keys))
+        return self
@@ -0,0 +1,179 @@
+"""
+Catalog of the runs of a run_sorters working folder, stored in a SQLite database.
+
+The catalog has one row per (rec_name, sorter_name) with the status of the run, its run time, a hash of
+its params, the number of units and spikes and the size of the output folder. It is updated by the launcher
+each time a run ends, so that run_sorters(mode='keep'), run_sorters(with_output=True) and the queries below
+do not need to scan every output folder.
+
+The number of units and spikes is filled when the sorting was loaded by the launcher (iter_run_sorters,
+run_sorters(with_output=True)), otherwise it is None. The size of the output folder is only computed when
+asked with get_output_size(), because it needs to walk the whole folder.
+
+A catalog created in a working folder made without catalog is filled from the folders once (rebuild()).
+"""
+from pathlib import Path
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import contextlib
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    rec_name TEXT NOT NULL,
+    sorter_name TEXT NOT NULL,
+    output_folder TEXT NOT NULL,
+    status TEXT NOT NULL,
+    run_time REAL,
+    params_hash TEXT,
+    num_units INTEGER,
+    num_spikes INTEGER,
+    output_size INTEGER,
+    updated REAL,
+    PRIMARY KEY (rec_name, sorter_name)
+)
+"""
+
+_columns = ['rec_name', 'sorter_name', 'output_folder', 'status', 'run_time', 'params_hash', 'num_units',
+            'num_spikes', 'output_size', 'updated']
+
+
+class RunCatalog:
+    filename = 'spikesorters_catalog.sqlite'
+
+    def __init__(self, working_folder):
+        self.working_folder = Path(working_folder).absolute()
+        self.working_folder.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.working_folder / self.filename
+        is_new = not self.db_path.is_file()
+        with self._connect() as conn:
+            conn.execute(_schema)
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_status ON runs (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS runs_run_time ON runs (run_time)")
+        if is_new:
+            self.rebuild()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.db_path), timeout=60.)
+        try:
+            # commit or rollback
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def update(self, rec_name, sorter_name, output_folder, sorting=None):
+        """
+        Reads the log and params of the output folder and writes the row of the run.
+        """
+        output_folder = Path(output_folder)
+        log = None
+        log_path = output_folder / 'spikeinterface_log.json'
+        if log_path.is_file():
+            with open(log_path, 'r', encoding='utf8') as f:
+                log = json.load(f)
+        if log is not None and log.get('run_time', None) is not None:
+            status = 'ok'
+            run_time = log['run_time']
+        else:
+            status = 'failed'
+            run_time = None
+
+        params_hash = None
+        params_path = output_folder / 'spikeinterface_params.json'
+        if params_path.is_file():
+            with open(params_path, 'rb') as f:
+                params_hash = hashlib.sha1(f.read()).hexdigest()
+
+        num_units, num_spikes = None, None
+        if sorting is not None:
+            num_units, num_spikes = _count_spikes(sorting)
+
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO runs ({', '.join(_columns)}) "
+                         f"VALUES ({', '.join('?' * len(_columns))})",
+                         (rec_name, sorter_name, str(output_folder), status, run_time, params_hash, num_units,
+                          num_spikes, None, time.time()))
+
+    def set_sorting(self, rec_name, sorter_name, sorting):
+        """
+        Fills the number of units and spikes of a run.
+        """
+        num_units, num_spikes = _count_spikes(sorting)
+        with self._connect() as conn:
+            conn.execute("UPDATE runs SET num_units = ?, num_spikes = ? WHERE rec_name = ? AND sorter_name = ?",
+                         (num_units, num_spikes, rec_name, sorter_name))
+
+    def get_output_size(self, rec_name, sorter_name):
+        """
+        Returns the size in bytes of the output folder of a run (None if the run is not in the catalog).
+        The size is computed on the first call after each update of the run and then kept in the catalog.
+        """
+        run = self.get(rec_name, sorter_name)
+        if run is None:
+            return None
+        if run['output_size'] is not None:
+            return run['output_size']
+        output_size = 0
+        for root, dirs, files in os.walk(run['output_folder']):
+            for file_name in files:
+                try:
+                    output_size += os.stat(os.path.join(root, file_name)).st_size
+                except OSError:
+                    pass
+        with self._connect() as conn:
+            conn.execute("UPDATE runs SET output_size = ? WHERE rec_name = ? AND sorter_name = ?",
+                         (output_size, rec_name, sorter_name))
+        return output_size
+
+    def remove(self, rec_name, sorter_name):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM runs WHERE rec_name = ? AND sorter_name = ?", (rec_name, sorter_name))
+
+    def rebuild(self):
+        """
+        Scans the working folder and writes the rows of all the runs (used for folders made without catalog).
+        """
+        for rec_name in os.listdir(self.working_folder):
+            if not (self.working_folder / rec_name).is_dir():
+                continue
+            for sorter_name in os.listdir(self.working_folder / rec_name):
+                output_folder = self.working_folder / rec_name / sorter_name
+                if (output_folder / 'spikeinterface_log.json').is_file():
+                    self.update(rec_name, sorter_name, output_folder)
+
+    def get(self, rec_name, sorter_name):
+        """
+        Returns the row of a run as a dict or None if the run is not in the catalog.
+        """
+        rows = self._select("WHERE rec_name = ? AND sorter_name = ?", (rec_name, sorter_name))
+        return rows[0] if len(rows) > 0 else None
+
+    def get_runs(self, status=None):
+        if status is None:
+            return self._select("ORDER BY rec_name, sorter_name")
+        return self._select("WHERE status = ? ORDER BY rec_name, sorter_name", (status,))
+
+    def done(self):
+        return self.get_runs(status='ok')
+
+    def failed(self):
+        return self.get_runs(status='failed')
+
+    def slowest(self, n=10):
+        return self._select("WHERE run_time IS NOT NULL ORDER BY run_time DESC LIMIT ?", (n,))
+
+    def _select(self, condition, args=()):
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(_columns)} FROM runs {condition}", args).fetchall()
+        return [dict(zip(_columns, row)) for row in rows]
+
+
+def _count_spikes(sorting):
+    unit_ids = sorting.get_unit_ids()
+    num_spikes = sum(len(sorting.get_unit_spike_train(unit_id)) for unit_id in unit_ids)
+    return len(unit_ids), int(num_spikes)
@@ -4,7 +4,15 @@ Some utils function to run command.
 from subprocess import Popen, PIPE, CalledProcessError, call, check_output
 import shlex
 import sys
+import os
+import json
+import hashlib
+import socket
+import time
+from pathlib import Path
+import numpy as np
 import spikeextractors as se
+from spikeextractors.baseextractor import _check_json
 
 def _run_command_and_print_output(command):
     command_list = shlex.split(command, posix="win" not in sys.platform)
@@ -72,5 +80,118 @@ def recover_recording(rec_arg):
     return recording
 
 
+def get_bindat_source(recording, dtype=None):
+    """
+    Returns (file_path, offset) of the raw file behind a time-major BinDatRecordingExtractor,
+    so that sorters can read it directly instead of copying it.
+    Returns None if the recording is not such a file, if it does not use all the channels of the file
+    in their order or if its dtype is not dtype.
+    """
+    if not isinstance(recording, se.BinDatRecordingExtractor) or recording._time_axis != 0:
+        return None
+    # a channel slice of the file can not be passed as the file itself
+    if not recording._complete_channels or recording._numchan != recording.get_num_channels() or \
+            list(recording._channels) != list(range(recording._numchan)):
+        return None
+    if dtype is not None and recording._timeseries.dtype != np.dtype(dtype):
+        return None
+    return Path(recording._datfile).absolute(), int(recording._timeseries.offset)
+
+
+def get_recording_fingerprint(recording):
+    """
+    Returns a hash identifying a recording, or None if the recording is not dumpable.
+
+    The hash combines the serialized dict of the recording with the size and the modification
+    time of the files it refers to, so that a file rewritten in place gets a new fingerprint.
+    """
+    if not recording.check_if_dumpable():
+        return None
+    rec_dict = _check_json(recording.make_serialized_dict())
+    file_stats = []
+    _collect_file_stats(rec_dict, file_stats)
+    txt = json.dumps([rec_dict, file_stats], sort_keys=True, default=str)
+    return hashlib.sha1(txt.encode('utf8')).hexdigest()
+
+
+def _collect_file_stats(obj, file_stats):
+    if isinstance(obj, dict):
+        for value in obj.values():
+            _collect_file_stats(value, file_stats)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _collect_file_stats(value, file_stats)
+    elif isinstance(obj, str) and os.path.isfile(obj):
+        stat = os.stat(obj)
+        file_stats.append([os.path.abspath(obj), stat.st_size, stat.st_mtime_ns])
+
+
+class FileLock:
+    """
+    Inter-process lock based on the atomic creation of a lock file (O_CREAT | O_EXCL).
+
+    The lock file contains the host name and the pid of the owner. A lock left by a dead process
+    of the same host is considered stale and is removed.
+    """
+    def __init__(self, lock_path, poll_interval=0.5):
+        self.lock_path = Path(lock_path)
+        self.poll_interval = poll_interval
+
+    def acquire(self):
+        while True:
+            try:
+                fd = os.open(str(self.lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._is_stale():
+                    try:
+                        os.remove(str(self.lock_path))
+                    except FileNotFoundError:
+                        pass
+                    continue
+                time.sleep(self.poll_interval)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{socket.gethostname()} {os.getpid()}')
+            return
+
+    def release(self):
+        try:
+            os.remove(str(self.lock_path))
+        except FileNotFoundError:
+            pass
+
+    def _is_stale(self):
+        try:
+            with open(str(self.lock_path), 'r') as f:
+                hostname, pid = f.read().split()
+            pid = int(pid)
+        except (OSError, ValueError):
+            # being written or removed by another process
+            return False
+        if hostname != socket.gethostname():
+            return False
+        if 'win' in sys.platform and sys.platform != 'darwin':
+            # os.kill() terminates the process on windows
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
 class SpikeSortingError(RuntimeError):
     """Raised whenever spike sorting fails"""
+
+
+class SpikeSortingTimeoutError(SpikeSortingError):
+    """Raised when a sorter is stopped because it exceeded its timeout or stopped writing to its log"""
@@ -1,3 +1,6 @@
+import asyncio
+import functools
+
 from .hdsort import HDSortSorter
 from .klusta import KlustaSorter
 from .tridesclous import TridesclousSorter
@@ -12,6 +15,7 @@ from .herdingspikes import HerdingspikesSorter
 from .waveclus import WaveClusSorter
 from .yass import YassSorter
 from .combinato import CombinatoSorter
+from .sorting_cache import SortingCache
 
 sorter_full_list = [
     HDSortSorter,
@@ -36,7 +40,8 @@ sorter_dict = {s.sorter_name: s for s in sorter_full_list}
 # generic launcher via function approach
 def run_sorter(sorter_name_or_class, recording, output_folder=None, delete_output_folder=False,
                grouping_property=None, parallel=False, verbose=False, raise_error=True, n_jobs=-1, joblib_backend='loky',
-               **params):
+               n_jobs_io=4, pipeline_depth=None, cache_folder=None, cache_max_size_gb=None, export_folder=None,
+               timeout=None, inactivity_timeout=None, **params):
     """
     Generic function to run a sorter via function approach.
 
@@ -71,6 +76,29 @@ def run_sorter(sorter_name_or_class, recording, output_folder=None, delete_outpu
         Number of jobs when parallel=True (default=-1)
     joblib_backend: str
         joblib backend when parallel=True (default='loky')
+    n_jobs_io: int or None
+        When parallel=True, the recordings of the different groups are also exported in parallel, with at most
+        n_jobs_io exports at the same time (default=4). If None, n_jobs is used.
+    pipeline_depth: int or None
+        If given and spike sorting is by 'grouping_property', each group is sorted as soon as its setup is done
+        while the next groups are set up, with at most pipeline_depth groups set up and waiting to be sorted
+        (default None: all groups are set up before sorting).
+    cache_folder: str or Path or None
+        If given, results are cached in this folder and a run with the same recording, sorter, sorter version
+        and parameters returns the cached sorting instead of running the sorter again (default None).
+        Only dumpable recordings can be cached.
+    cache_max_size_gb: float or None
+        Maximum size of the cache folder. The least recently used results are removed first (default None: no limit)
+    export_folder: str or Path or None
+        If given, the binary copies of the recording needed by some sorters (Kilosort family, YASS, Klusta) are
+        written once in this folder and shared between runs with hardlinks (default None)
+    timeout: float or None
+        For sorters running in a shell script (Matlab sorters, Kilosort family, Klusta, SpykingCircus, YASS, ...),
+        maximum run time in s of each group. The sorter is stopped and a SpikeSortingTimeoutError is raised, or
+        logged if raise_error=False (default None: no limit)
+    inactivity_timeout: float or None
+        For sorters running in a shell script, the sorter is stopped if it does not write anything to its log
+        for inactivity_timeout s, e.g. when Matlab waits for a license (default None: no limit)
     **params: keyword args
         Spike sorter specific arguments (they can be retrieved with 'get_default_params(sorter_name_or_class)'
 
@@ -88,14 +116,83 @@ def run_sorter(sorter_name_or_class, recording, output_folder=None, delete_outpu
         raise (ValueError('Unknown sorter'))
 
     sorter = SorterClass(recording=recording, output_folder=output_folder, grouping_property=grouping_property,
-                         verbose=verbose, delete_output_folder=delete_output_folder)
+                         verbose=verbose, delete_output_folder=delete_output_folder, export_folder=export_folder)
     sorter.set_params(**params)
-    sorter.run(raise_error=raise_error, parallel=parallel, n_jobs=n_jobs, joblib_backend=joblib_backend)
+
+    cache_key = None
+    if cache_folder is not None:
+        cache = SortingCache(cache_folder, max_size_gb=cache_max_size_gb)
+        cache_key = cache.make_key(recording, SorterClass, sorter.params, grouping_property=grouping_property)
+        if cache_key is None:
+            print("WARNING! The recording is not dumpable and its result can't be cached.")
+        else:
+            sortingextractor = cache.get(cache_key)
+            if sortingextractor is not None:
+                if verbose:
+                    print(f'{SorterClass.sorter_name} result loaded from cache {cache_key}')
+                sortingextractor.set_sampling_frequency(recording.get_sampling_frequency())
+                sortingextractor.copy_epochs(recording)
+                sortingextractor.copy_times(recording)
+                return sortingextractor
+
+    run_time = sorter.run(raise_error=raise_error, parallel=parallel, n_jobs=n_jobs, joblib_backend=joblib_backend,
+                          n_jobs_io=n_jobs_io, pipeline_depth=pipeline_depth, timeout=timeout,
+                          inactivity_timeout=inactivity_timeout)
     sortingextractor = sorter.get_result(raise_error=raise_error)
 
+    if cache_key is not None and run_time is not None:
+        cache.put(cache_key, sortingextractor, info={'sorter_name': SorterClass.sorter_name,
+                                                     'sorter_version': str(SorterClass.get_sorter_version()),
+                                                     'params': sorter.params})
+
     return sortingextractor
 
 
+async def run_sorter_async(sorter_name_or_class, recording, semaphore=None, executor=None, **kwargs):
+    """
+    Coroutine version of run_sorter(), to run several sorters concurrently from one python process.
+
+    The sorter runs in a thread of executor: shell based sorters (Kilosort family, IronClust, WaveClus, HDSort,
+    Combinato, Klusta, SpykingCircus, YASS) spend most of their time waiting for their process, so many of them
+    can run at the same time without pickling the recordings.
+
+    >>> semaphore = asyncio.Semaphore(4)
+    >>> sortings = await asyncio.gather(*[run_sorter_async(name, recording, semaphore=semaphore,
+    ...                                                    output_folder=name) for name in sorter_names])
+
+    Parameters
+    ----------
+    sorter_name_or_class: str or SorterClass
+        The sorter to run
+    recording: RecordingExtractor
+        The recording extractor to be spike sorted
+    semaphore: asyncio.Semaphore or None
+        If given, bounds the number of sorters running at the same time
+    executor: concurrent.futures.Executor or None
+        The executor running the sorter (default None: the default executor of the event loop, which has a
+        limited number of threads)
+    **kwargs: keyword args
+        The arguments of run_sorter()
+
+    Returns
+    -------
+    sortingextractor: SortingExtractor
+        The spike sorted data
+    """
+    if isinstance(sorter_name_or_class, str):
+        SorterClass = sorter_dict[sorter_name_or_class]
+    else:
+        SorterClass = sorter_name_or_class
+    assert SorterClass.compatible_with_parallel['threading'], f"{SorterClass.sorter_name} can't run in a thread"
+
+    loop = asyncio.get_running_loop()
+    func = functools.partial(run_sorter, sorter_name_or_class, recording, **kwargs)
+    if semaphore is None:
+        return await loop.run_in_executor(executor, func)
+    async with semaphore:
+        return await loop.run_in_executor(executor, func)
+
+
 def available_sorters():
     """
     Lists available sorters.
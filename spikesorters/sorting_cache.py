@@ -0,0 +1,120 @@
+"""
+Content-addressed cache of sorting results.
+
+A result is identified by the fingerprint of the recording, the sorter name,
+the sorter version and the sorter params. When the same combination is run
+again, the cached SortingExtractor is returned instead of running the sorter.
+
+Each entry is a sub folder of the cache folder containing:
+  * sorting.npz : spike trains in the NpzSortingExtractor format
+  * unit_properties.json : unit properties (only json-compatible values)
+  * info.json : what the entry was computed from
+
+The modification time of the entry folder is refreshed on each hit, so the
+least recently used entries are removed first when the cache is over its size cap.
+"""
+from pathlib import Path
+import os
+import json
+import hashlib
+import shutil
+import datetime
+import uuid
+
+import spikeextractors as se
+from spikeextractors.baseextractor import _check_json
+
+from .sorter_tools import get_recording_fingerprint
+from .spike_store import get_json_unit_properties
+
+
+class SortingCache:
+    def __init__(self, cache_folder, max_size_gb=None):
+        self.cache_folder = Path(cache_folder).absolute()
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.max_size_gb = max_size_gb
+
+    def make_key(self, recording, SorterClass, params, grouping_property=None):
+        """
+        Returns the cache key for a run, or None if the recording cannot be fingerprinted
+        (not dumpable), in which case the run is not cached.
+        """
+        fingerprint = get_recording_fingerprint(recording)
+        if fingerprint is None:
+            return None
+        key_dict = {
+            'recording': fingerprint,
+            'sorter_name': SorterClass.sorter_name,
+            'sorter_version': str(SorterClass.get_sorter_version()),
+            'params': _check_json(dict(params)),
+            'grouping_property': grouping_property,
+        }
+        txt = json.dumps(key_dict, sort_keys=True, default=str)
+        return hashlib.sha1(txt.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        entry_folder = self.cache_folder / key
+        if not (entry_folder / 'sorting.npz').is_file():
+            return None
+        sorting = se.NpzSortingExtractor(entry_folder / 'sorting.npz')
+        properties_file = entry_folder / 'unit_properties.json'
+        if properties_file.is_file():
+            with open(properties_file, 'r', encoding='utf8') as f:
+                unit_properties = json.load(f)
+            for unit_id, properties in zip(sorting.get_unit_ids(), unit_properties):
+                for property_name, value in properties.items():
+                    sorting.set_unit_property(unit_id, property_name, value)
+        # refresh the last access time for the LRU eviction
+        os.utime(entry_folder)
+        return sorting
+
+    def put(self, key, sorting, info=None):
+        entry_folder = self.cache_folder / key
+        if entry_folder.is_dir():
+            return
+        # write in a temporary folder and rename to avoid partial entries
+        tmp_folder = self.cache_folder / ('.tmp_' + uuid.uuid4().hex)
+        tmp_folder.mkdir()
+        try:
+            se.NpzSortingExtractor.write_sorting(sorting, tmp_folder / 'sorting.npz')
+            with open(tmp_folder / 'unit_properties.json', 'w', encoding='utf8') as f:
+                json.dump(get_json_unit_properties(sorting), f)
+            info = dict(info) if info is not None else {}
+            info['datetime'] = datetime.datetime.now()
+            with open(tmp_folder / 'info.json', 'w', encoding='utf8') as f:
+                json.dump(_check_json(info), f, indent=4, default=str)
+            os.rename(str(tmp_folder), str(entry_folder))
+        except OSError:
+            # another process wrote the same entry in the meantime
+            if not entry_folder.is_dir():
+                raise
+        finally:
+            if tmp_folder.is_dir():
+                shutil.rmtree(str(tmp_folder), ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_size_gb.
+        """
+        if self.max_size_gb is None:
+            return
+        entries = []
+        total_size = 0
+        for entry_folder in self.cache_folder.iterdir():
+            if not entry_folder.is_dir() or entry_folder.name.startswith('.tmp_'):
+                continue
+            size = sum(f.stat().st_size for f in entry_folder.iterdir() if f.is_file())
+            entries.append((entry_folder.stat().st_mtime, size, entry_folder))
+            total_size += size
+        max_size = self.max_size_gb * 1024 ** 3
+        for _, size, entry_folder in sorted(entries, key=lambda e: e[0]):
+            if total_size <= max_size:
+                break
+            shutil.rmtree(str(entry_folder), ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        for entry_folder in self.cache_folder.iterdir():
+            if entry_folder.is_dir():
+                shutil.rmtree(str(entry_folder), ignore_errors=True)
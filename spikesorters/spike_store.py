@@ -0,0 +1,127 @@
+"""
+Compact spike store written beside each sorter output.
+
+The output of each sorter has its own format (phy, kwik, mda, mat, hdf5, ...) which can be slow to parse.
+At the end of a run, the result is converted once into a 'spike_store' sub folder of the output folder:
+  * unit_ids.npy : the unit ids
+  * offsets.npy : int64, the spikes of unit i are spike_times[offsets[i]:offsets[i + 1]] (CSR layout)
+  * spike_times.npy : int64, spike frames sorted for each unit
+  * unit_properties.json : unit properties (only json-compatible values)
+  * info.json : sampling frequency and sizes
+
+The npy files are memory-mapped by SpikeStoreSortingExtractor, so loading a big sorting is immediate
+and only the spike trains that are used are read. The store is loaded on request with
+SorterClass.get_spike_store_from_folder() or use_spike_store=True: spike features are not kept, so
+get_result_from_folder() still parses the sorter output.
+"""
+from pathlib import Path
+import os
+import json
+import shutil
+
+import numpy as np
+import spikeextractors as se
+from spikeextractors.baseextractor import _check_json
+
+spike_store_folder_name = 'spike_store'
+
+
+def get_json_unit_properties(sorting):
+    """
+    Returns the list (one dict per unit) of the json-compatible unit properties of sorting.
+    """
+    unit_properties = []
+    for unit_id in sorting.get_unit_ids():
+        properties = {}
+        for property_name in sorting.get_unit_property_names(unit_id):
+            # _check_json only takes dicts
+            value = _check_json({'value': sorting.get_unit_property(unit_id, property_name)})['value']
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            properties[property_name] = value
+        unit_properties.append(properties)
+    return unit_properties
+
+
+def write_spike_store(sorting, folder_path, sampling_frequency=None):
+    folder_path = Path(folder_path)
+    unit_ids = sorting.get_unit_ids()
+    spike_trains = [np.sort(np.asarray(sorting.get_unit_spike_train(unit_id), dtype='int64'))
+                    for unit_id in unit_ids]
+    offsets = np.zeros(len(unit_ids) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(spike_train) for spike_train in spike_trains])
+    if len(spike_trains) > 0:
+        spike_times = np.concatenate(spike_trains)
+    else:
+        spike_times = np.zeros(0, dtype='int64')
+    if sorting.get_sampling_frequency() is not None:
+        sampling_frequency = sorting.get_sampling_frequency()
+
+    # write in a temporary folder and rename to avoid partial stores
+    tmp_folder = folder_path.parent / (folder_path.name + '_tmp')
+    if tmp_folder.is_dir():
+        shutil.rmtree(str(tmp_folder))
+    tmp_folder.mkdir(parents=True)
+    np.save(tmp_folder / 'unit_ids.npy', np.array(unit_ids))
+    np.save(tmp_folder / 'offsets.npy', offsets)
+    np.save(tmp_folder / 'spike_times.npy', spike_times)
+    with open(tmp_folder / 'unit_properties.json', 'w', encoding='utf8') as f:
+        json.dump(get_json_unit_properties(sorting), f)
+    info = {
+        'sampling_frequency': sampling_frequency,
+        'num_units': len(unit_ids),
+        'num_spikes': int(offsets[-1]),
+    }
+    with open(tmp_folder / 'info.json', 'w', encoding='utf8') as f:
+        json.dump(_check_json(info), f, indent=4)
+    if folder_path.is_dir():
+        shutil.rmtree(str(folder_path))
+    os.rename(str(tmp_folder), str(folder_path))
+
+
+def has_spike_store(folder_path):
+    # info.json is the last file written before the rename
+    return (Path(folder_path) / 'info.json').is_file()
+
+
+class SpikeStoreSortingExtractor(se.SortingExtractor):
+    extractor_name = 'SpikeStoreSortingExtractor'
+    installed = True
+    is_writable = True
+    mode = 'folder'
+    installation_mesg = ""
+
+    def __init__(self, folder_path):
+        se.SortingExtractor.__init__(self)
+        folder_path = Path(folder_path)
+        self._unit_ids = np.load(folder_path / 'unit_ids.npy')
+        self._offsets = np.load(folder_path / 'offsets.npy')
+        self._spike_times = np.load(folder_path / 'spike_times.npy', mmap_mode='r')
+        self._unit_index = {unit_id: i for i, unit_id in enumerate(self._unit_ids.tolist())}
+        with open(folder_path / 'info.json', 'r', encoding='utf8') as f:
+            info = json.load(f)
+        self._sampling_frequency = info['sampling_frequency']
+        with open(folder_path / 'unit_properties.json', 'r', encoding='utf8') as f:
+            unit_properties = json.load(f)
+        for unit_id, properties in zip(self.get_unit_ids(), unit_properties):
+            for property_name, value in properties.items():
+                self.set_unit_property(unit_id, property_name, value)
+        self._kwargs = {'folder_path': str(folder_path.absolute())}
+
+    def get_unit_ids(self):
+        return self._unit_ids.tolist()
+
+    def get_unit_spike_train(self, unit_id, start_frame=None, end_frame=None):
+        if unit_id not in self._unit_index:
+            raise ValueError(f"{unit_id} is an invalid unit id")
+        i = self._unit_index[unit_id]
+        spike_train = self._spike_times[self._offsets[i]:self._offsets[i + 1]]
+        start = 0 if start_frame is None else np.searchsorted(spike_train, start_frame, side='left')
+        stop = len(spike_train) if end_frame is None else np.searchsorted(spike_train, end_frame, side='left')
+        return np.array(spike_train[start:stop])
+
+    @staticmethod
+    def write_sorting(sorting, save_path):
+        write_spike_store(sorting, save_path)
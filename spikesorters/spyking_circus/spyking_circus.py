@@ -1,14 +1,14 @@
 import copy
 from pathlib import Path
 import os
+import shutil
 import numpy as np
-from numpy.lib.format import open_memmap
 import sys
 
 import spikeextractors as se
 from ..basesorter import BaseSorter
 from ..utils.shellscript import ShellScript
-from ..sorter_tools import recover_recording
+from ..sorter_tools import recover_recording, get_bindat_source
 
 try:
     import circus
@@ -23,6 +23,9 @@ class SpykingcircusSorter(BaseSorter):
 
     sorter_name = 'spykingcircus'
     requires_locations = False
+    memory_base_gb = 1.0
+    export_file_name = 'recording.dat'
+    export_dtype = None
 
     _default_params = {
         'detect_sign': -1,  # -1 - 1 - 0
@@ -35,6 +38,8 @@ class SpykingcircusSorter(BaseSorter):
         'num_workers': None,
         'whitening_max_elts': 1000,  # I believe it relates to subsampling and affects compute time
         'clustering_max_elts': 10000,  # I believe it relates to subsampling and affects compute time
+        'chunk_mb': 500,
+        'n_jobs_bin': 1
         }
 
     _params_description = {
@@ -49,6 +54,8 @@ class SpykingcircusSorter(BaseSorter):
         'num_workers': "Number of workers (if None, half of the cpu number is used)",
         'whitening_max_elts': "Max number of events per electrode for whitening",
         'clustering_max_elts': "Max number of events per electrode for clustering",
+        'chunk_mb': "Chunk size in Mb for saving to binary format (default 500Mb)",
+        'n_jobs_bin': "Number of jobs for saving to binary format (Default 1)"
     }
 
     sorter_description = """Spyking Circus uses a smart clustering and a greedy template matching approach for 
@@ -75,6 +82,13 @@ class SpykingcircusSorter(BaseSorter):
     def get_sorter_version():
         return circus.__version__
 
+    def _get_export_dtype(self, recording):
+        # int16 data is kept as int16, the rest is converted to float32
+        dtype = recording.get_traces(start_frame=0, end_frame=1).dtype
+        if dtype == np.dtype('int16'):
+            return dtype
+        return np.dtype('float32')
+
     def _setup_recording(self, recording, output_folder):
         p = self.params
         source_dir = Path(__file__).parent
@@ -85,21 +99,35 @@ class SpykingcircusSorter(BaseSorter):
         recording.save_to_probe_file(probe_file, grouping_property=None,
                                      radius=p['adjacency_radius'])
 
-        # save binary file
+        # raw binary file: the outputs are written in a folder named after the file
         file_name = 'recording'
-        # We should make this copy more efficient with chunks
-
-        n_chan = recording.get_num_channels()
-        n_frames = recording.get_num_frames()
-        chunk_size = 2 ** 24 // n_chan
-        npy_file = str(output_folder / file_name) + '.npy'
-        data_file = open_memmap(npy_file, shape=(n_frames, n_chan), dtype=np.float32, mode='w+')
-        nb_chunks = n_frames // chunk_size
-        for i in range(nb_chunks + 1):
-            start_frame = i*chunk_size
-            end_frame = min((i+1)*chunk_size, n_frames)
-            data = recording.get_traces(start_frame=start_frame, end_frame=end_frame).astype('float32')
-            data_file[start_frame:end_frame, :] = data.T
+        dat_file = output_folder / (file_name + '.dat')
+        if dat_file.is_symlink():
+            # never write through the link of a previous run
+            dat_file.unlink()
+        dtype = self._get_export_dtype(recording)
+        data_offset = 0
+        # spyking circus filters the data in place: files that are not owned by this run are read
+        # with overwrite=False
+        overwrite = self.export_store is None
+        bindat_source = get_bindat_source(recording, dtype=dtype)
+        if bindat_source is not None:
+            try:
+                if dat_file.is_file():
+                    dat_file.unlink()
+                os.symlink(str(bindat_source[0]), str(dat_file))
+                data_offset = bindat_source[1]
+                overwrite = False
+            except OSError:
+                bindat_source = None
+        if bindat_source is None:
+            exported_file = self._export_binary(recording, dat_file, dtype=dtype)
+            if exported_file != dat_file.absolute():
+                # the export store could not link its file in the output folder
+                try:
+                    os.symlink(str(exported_file), str(dat_file))
+                except OSError:
+                    shutil.copyfile(str(exported_file), str(dat_file))
 
         if p['detect_sign'] < 0:
             detect_sign = 'negative'
@@ -117,7 +145,8 @@ class SpykingcircusSorter(BaseSorter):
             auto = p['auto_merge']
         else:
             auto = 0
-        circus_config = ''.join(circus_config).format(sample_rate, probe_file, p['template_width_ms'],
+        circus_config = ''.join(circus_config).format(sample_rate, dtype.name, recording.get_num_channels(),
+                    data_offset, probe_file, overwrite, p['template_width_ms'],
                     p['detect_threshold'], detect_sign, p['filter'], p['whitening_max_elts'],
                     p['clustering_max_elts'], auto)
         with (output_folder / (file_name + '.params')).open('w') as f:
@@ -136,15 +165,16 @@ class SpykingcircusSorter(BaseSorter):
         if 'win' in sys.platform and sys.platform != 'darwin':
             shell_cmd = '''
                         spyking-circus {recording} -c {num_workers}
-                    '''.format(recording=output_folder / 'recording.npy', num_workers=num_workers)
+                    '''.format(recording=output_folder / 'recording.dat', num_workers=num_workers)
         else:
             shell_cmd = '''
                         #!/bin/bash
                         spyking-circus {recording} -c {num_workers}
-                    '''.format(recording=output_folder / 'recording.npy', num_workers=num_workers)
+                    '''.format(recording=output_folder / 'recording.dat', num_workers=num_workers)
 
         shell_script = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                   log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                   timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()
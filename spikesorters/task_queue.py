@@ -0,0 +1,162 @@
+"""
+Durable queue of (recording, sorter) tasks stored in a SQLite database.
+
+Each task has a state:
+  * 'pending' : waiting for a worker
+  * 'running' : claimed by a worker, which refreshes its heartbeat while the sorter runs
+  * 'done' : the sorter returned
+  * 'failed' : the sorter raised, the traceback is kept in the error column
+
+The database lives in the working folder of run_sorters, so a batch that was interrupted (crash, reboot)
+is resumed from its last state: running tasks whose heartbeat is too old are put back in the queue.
+"""
+from pathlib import Path
+import sqlite3
+import pickle
+import time
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    task BLOB NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submit_time REAL,
+    start_time REAL,
+    heartbeat REAL,
+    end_time REAL,
+    error TEXT
+)
+"""
+
+
+class TaskQueue:
+    def __init__(self, db_path, timeout=60.):
+        self.db_path = Path(db_path).absolute()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # time to wait for the lock of another process
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute(_schema)
+
+    def _connect(self):
+        # one connection per operation: the queue is used from several threads and processes
+        return _Connection(self.db_path, self.timeout)
+
+    def add_tasks(self, keys, tasks):
+        """
+        Adds the tasks that are not already in the queue. Tasks already in the queue keep their state, except
+        the pending and failed ones whose task changed (e.g. new sorter params): their task is replaced and they
+        are put back in the queue. Returns the number of tasks replaced.
+        """
+        now = time.time()
+        rows = [(key, pickle.dumps(task)) for key, task in zip(keys, tasks)]
+        with self._connect() as conn:
+            previous = dict(conn.execute("SELECT key, task FROM tasks WHERE state IN ('pending', 'failed')").fetchall())
+            conn.executemany("INSERT OR IGNORE INTO tasks (key, task, state, submit_time) VALUES (?, ?, 'pending', ?)",
+                             [(key, task, now) for key, task in rows])
+            changed = [(task, now, key) for key, task in rows if key in previous and previous[key] != task]
+            conn.executemany("UPDATE tasks SET task = ?, state = 'pending', worker = NULL, submit_time = ?, "
+                             "error = NULL WHERE key = ? AND state IN ('pending', 'failed')", changed)
+        return len(changed)
+
+    def claim(self, worker):
+        """
+        Marks the oldest pending task as running for worker.
+        Returns (task_id, task) or None when there is no pending task.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT id, task FROM tasks WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            task_id, task = row
+            conn.execute("UPDATE tasks SET state = 'running', worker = ?, attempts = attempts + 1, start_time = ?, "
+                         "heartbeat = ?, end_time = NULL, error = NULL WHERE id = ?", (worker, now, now, task_id))
+        return task_id, pickle.loads(task)
+
+    def heartbeat(self, task_id, worker=None):
+        with self._connect() as conn:
+            conn.execute("UPDATE tasks SET heartbeat = ? WHERE id = ? AND state = 'running' AND "
+                         "(? IS NULL OR worker = ?)", (time.time(), task_id, worker, worker))
+
+    def finish(self, task_id, error=None, worker=None):
+        """
+        Marks a task as done (or failed when error is the traceback). With worker, the task is only changed if it
+        is still running for this worker: a task put back in the queue and claimed by another worker is left to
+        the new owner. Returns True if the task was changed.
+        """
+        state = 'done' if error is None else 'failed'
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE tasks SET state = ?, end_time = ?, error = ? WHERE id = ? AND "
+                                  "(? IS NULL OR (state = 'running' AND worker = ?))",
+                                  (state, time.time(), error, task_id, worker, worker))
+            return cursor.rowcount == 1
+
+    def requeue_stale(self, stale_timeout):
+        """
+        Puts back in the queue the running tasks without heartbeat for more than stale_timeout s
+        (their worker died). Returns the number of tasks put back.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE tasks SET state = 'pending', worker = NULL "
+                                  "WHERE state = 'running' AND heartbeat < ?", (time.time() - stale_timeout,))
+            return cursor.rowcount
+
+    def reset(self, states=('failed',)):
+        """
+        Puts back in the queue the tasks in the given states.
+        """
+        with self._connect() as conn:
+            conn.execute(f"UPDATE tasks SET state = 'pending', worker = NULL "
+                         f"WHERE state IN ({', '.join('?' * len(states))})", tuple(states))
+
+    def get_states(self):
+        """
+        Returns a dict key: (state, error)
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, state, error FROM tasks").fetchall()
+        return {key: (state, error) for key, state, error in rows}
+
+    def count(self, state):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM tasks WHERE state = ?", (state,)).fetchone()[0]
+
+    def summary(self):
+        """
+        Returns a list of dicts with the state, worker, timings and error of each task.
+        """
+        columns = ['key', 'state', 'worker', 'attempts', 'submit_time', 'start_time', 'heartbeat', 'end_time',
+                   'error']
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(columns)} FROM tasks ORDER BY id").fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+
+class _Connection:
+    """
+    Connection opened for one transaction. The write lock is taken at the beginning (BEGIN IMMEDIATE)
+    so that read-then-update operations (claim) are atomic between processes.
+    """
+    def __init__(self, db_path, timeout):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = sqlite3.connect(str(self.db_path), timeout=self.timeout, isolation_level=None)
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.conn.execute('COMMIT')
+            else:
+                self.conn.execute('ROLLBACK')
+        finally:
+            self.conn.close()
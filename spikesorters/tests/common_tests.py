@@ -1,4 +1,6 @@
 import unittest
+import json
+import numpy as np
 import spikeextractors as se
 
 
@@ -26,8 +28,21 @@ class SorterCommonTestSuite:
 
         for unit_id in sorting.get_unit_ids():
             print('unit #', unit_id, 'nb', len(sorting.get_unit_spike_train(unit_id)))
+
+        # the spike store has the same spike trains as the sorter output
+        assert (sorter.output_folders[0] / 'spike_store' / 'info.json').is_file()
+        sorting_output = self.SorterClass.get_spike_store_from_folder(sorter.output_folders[0])
+        assert list(sorting.get_unit_ids()) == list(sorting_output.get_unit_ids())
+        for unit_id in sorting.get_unit_ids():
+            assert np.array_equal(np.sort(sorting.get_unit_spike_train(unit_id)),
+                                  sorting_output.get_unit_spike_train(unit_id))
         del sorting
 
+        with open(sorter.output_folders[0] / 'spikeinterface_log.json', 'r', encoding='utf8') as f:
+            timing = json.load(f)['timing']
+        for stage in ('setup', 'queue_wait', 'run', 'get_result_from_folder', 'get_result'):
+            assert stage in timing
+
     def test_several_groups(self):
 
         # run sorter with several groups in paralel or not
@@ -57,6 +72,26 @@ class SorterCommonTestSuite:
                         print('unit #', unit_id, 'nb', len(sorting.get_unit_spike_train(unit_id)))
                     del sorting
 
+    def test_several_groups_pipeline(self):
+        # setup of the next group overlaps with the sorting of the previous one
+        recording, sorting_gt = se.example_datasets.toy_example(num_channels=8, duration=30, seed=1, dumpable=True,
+                                                                dump_folder='test_groups')
+        for ch_id in range(0, 4):
+            recording.set_channel_property(ch_id, 'group', 0)
+        for ch_id in range(4, 8):
+            recording.set_channel_property(ch_id, 'group', 1)
+
+        params = self.SorterClass.default_params()
+        for parallel in [False, True]:
+            sorter = self.SorterClass(recording=recording, output_folder=None,
+                                      grouping_property='group', verbose=False)
+            sorter.set_params(**params)
+            sorter.run(parallel=parallel, pipeline_depth=1)
+            sorting = sorter.get_result()
+            assert len(sorter.output_folders) == 2
+            for unit_id in sorting.get_unit_ids():
+                print('unit #', unit_id, 'nb', len(sorting.get_unit_spike_train(unit_id)))
+            del sorting
 
     def test_with_BinDatRecordingExtractor(self):
         # some sorter (TDC, KS, KS2, ...) work by default with the raw binary
@@ -85,6 +120,14 @@ class SorterCommonTestSuite:
 
         for unit_id in sorting.get_unit_ids():
             print('unit #', unit_id, 'nb', len(sorting.get_unit_spike_train(unit_id)))
+
+        # the spike store has the same spike trains as the sorter output
+        assert (sorter.output_folders[0] / 'spike_store' / 'info.json').is_file()
+        sorting_output = self.SorterClass.get_spike_store_from_folder(sorter.output_folders[0])
+        assert list(sorting.get_unit_ids()) == list(sorting_output.get_unit_ids())
+        for unit_id in sorting.get_unit_ids():
+            assert np.array_equal(np.sort(sorting.get_unit_spike_train(unit_id)),
+                                  sorting_output.get_unit_spike_train(unit_id))
         del sorting
 
     def test_get_version(self):
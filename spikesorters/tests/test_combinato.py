@@ -0,0 +1,81 @@
+import shutil
+from pathlib import Path
+import unittest
+import pytest
+import numpy as np
+import spikeextractors as se
+from spikesorters import CombinatoSorter
+from spikesorters.combinato.combinato import HAVE_H5PY, write_combinato_h5, _merge_resource_usage
+from spikesorters.tests.common_tests import SorterCommonTestSuite
+
+
+# This run several tests
+@pytest.mark.skipif(not CombinatoSorter.is_installed(), reason='combinato not installed')
+class CombinatoCommonTestSuite(SorterCommonTestSuite, unittest.TestCase):
+    SorterClass = CombinatoSorter
+
+
+@pytest.mark.skipif(not HAVE_H5PY, reason='h5py not installed')
+def test_write_combinato_h5():
+    import h5py
+
+    folder = Path('test_combinato_h5')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+
+    recording, _ = se.example_datasets.toy_example(num_channels=4, duration=10, seed=0)
+    file_paths = [folder / f'recording_{i}.h5' for i in range(recording.get_num_channels())]
+    # small chunks to check the concatenation
+    write_combinato_h5(recording, file_paths, chunk_mb=0.1)
+    traces = recording.get_traces()
+    for i, file_path in enumerate(file_paths):
+        with h5py.File(file_path, 'r') as f:
+            assert np.array_equal(f['data'][:], traces[i])
+            assert f['sr'][0] == recording.get_sampling_frequency()
+
+    # single channel raw file referenced by the h5 file
+    traces = recording.get_traces(channel_ids=[0]).astype('int16')
+    raw_file = folder / 'raw.dat'
+    with open(raw_file, 'wb') as f:
+        f.write(b'\x00' * 16)
+        traces.T.tofile(f)
+    bindat_recording = se.BinDatRecordingExtractor(raw_file, sampling_frequency=recording.get_sampling_frequency(),
+                                                   numchan=1, dtype='int16', time_axis=0, file_offset=16)
+    write_combinato_h5(bindat_recording, [folder / 'linked.h5'], link_raw_file=True)
+    with h5py.File(folder / 'linked.h5', 'r') as f:
+        assert f['data'].external is not None
+        assert np.array_equal(f['data'][:], traces[0])
+
+    # one channel of a two channel raw file can not be linked
+    traces = recording.get_traces(channel_ids=[0, 1]).astype('int16')
+    traces.T.tofile(folder / 'raw2.dat')
+    bindat_recording = se.BinDatRecordingExtractor(folder / 'raw2.dat',
+                                                   sampling_frequency=recording.get_sampling_frequency(),
+                                                   numchan=2, dtype='int16', time_axis=0, recording_channels=[1])
+    write_combinato_h5(bindat_recording, [folder / 'sliced.h5'], link_raw_file=True)
+    with h5py.File(folder / 'sliced.h5', 'r') as f:
+        assert f['data'].external is None
+        assert np.array_equal(f['data'][:], traces[1])
+
+
+def test_merge_resource_usage():
+    usages = [
+        {'source': 'proc', 'peak_rss_mb': 10., 'cpu_time_s': 1., 'read_bytes': 100, 'write_bytes': 10,
+         'max_threads': 2, 'elapsed_time_s': 3.},
+        {'source': 'proc', 'peak_rss_mb': 30., 'cpu_time_s': 2., 'read_bytes': 200, 'write_bytes': 20,
+         'max_threads': None, 'elapsed_time_s': 4.},
+    ]
+    usage = _merge_resource_usage(usages)
+    assert usage['cpu_time_s'] == 3.
+    assert usage['read_bytes'] == 300
+    assert usage['write_bytes'] == 30
+    assert usage['peak_rss_mb'] == 30.
+    assert usage['max_threads'] == 2
+
+
+if __name__ == '__main__':
+    CombinatoCommonTestSuite().test_on_toy()
+    CombinatoCommonTestSuite().test_several_groups()
+    CombinatoCommonTestSuite().test_with_BinDatRecordingExtractor()
+    test_write_combinato_h5()
@@ -0,0 +1,44 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import spikeextractors as se
+
+from spikesorters.export_store import BinaryExportStore
+
+
+def test_export_store():
+    folder = Path('test_export_store')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+
+    recording, _ = se.example_datasets.toy_example(num_channels=4, duration=10, seed=0, dumpable=True,
+                                                   dump_folder=folder / 'rec')
+    store = BinaryExportStore(folder / 'store')
+
+    (folder / 'sorter0').mkdir()
+    (folder / 'sorter1').mkdir()
+    file0 = store.acquire(recording, folder / 'sorter0' / 'recording.dat', dtype='int16')
+    file1 = store.acquire(recording, folder / 'sorter1' / 'recording.dat', dtype='int16')
+    assert file0.is_file() and file1.is_file()
+    assert file0.samefile(file1)
+    assert len(list((folder / 'store').glob('*.dat'))) == 1
+
+    traces = np.fromfile(file0, dtype='int16').reshape(-1, recording.get_num_channels()).T
+    assert traces.shape == (recording.get_num_channels(), recording.get_num_frames())
+
+    # still held by sorter1
+    store.release(file0)
+    store.cleanup()
+    assert len(list((folder / 'store').glob('*.dat'))) == 1
+
+    store.release(file1)
+    store.cleanup()
+    assert len(list((folder / 'store').glob('*.dat'))) == 0
+    # hardlinks keep the data
+    assert file0.is_file() and file1.is_file()
+
+
+if __name__ == '__main__':
+    test_export_store()
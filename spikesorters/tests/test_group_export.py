@@ -0,0 +1,37 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import spikeextractors as se
+
+from spikesorters.group_export import write_group_exports
+
+
+def test_write_group_exports():
+    folder = Path('test_group_export')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+
+    recording, _ = se.example_datasets.toy_example(num_channels=8, duration=10, seed=0)
+    recording.set_channel_groups([0, 0, 1, 1, 1, 2, 2, 2])
+    recording_list = recording.get_sub_extractors_by_property('group')
+
+    # small chunks to check the concatenation
+    file_paths = [folder / f'group{i}.dat' for i in range(len(recording_list))]
+    write_group_exports(recording, recording_list, file_paths, dtype='int16', chunk_mb=0.1)
+    for rec, file_path in zip(recording_list, file_paths):
+        traces = np.fromfile(file_path, dtype='int16').reshape(-1, rec.get_num_channels()).T
+        assert np.array_equal(traces, rec.get_traces().astype('int16'))
+
+    file_paths = [folder / f'group{i}' / 'raw.mda' for i in range(len(recording_list))]
+    write_group_exports(recording, recording_list, file_paths, dtype='float32', file_format='mda', chunk_mb=0.1)
+    for rec, file_path in zip(recording_list, file_paths):
+        header = np.fromfile(file_path, dtype='int32', count=5)
+        assert list(header) == [-3, 4, 2, rec.get_num_channels(), rec.get_num_frames()]
+        traces = np.fromfile(file_path, dtype='float32', offset=20).reshape(-1, rec.get_num_channels()).T
+        assert np.array_equal(traces, rec.get_traces().astype('float32'))
+
+
+if __name__ == '__main__':
+    test_write_group_exports()
@@ -0,0 +1,62 @@
+import shutil
+from pathlib import Path
+import unittest
+import pytest
+import numpy as np
+import spikeextractors as se
+from spikesorters import HDSortSorter
+from spikesorters.hdsort.hdsort import write_hdsort_h5
+from spikesorters.tests.common_tests import SorterCommonTestSuite
+
+try:
+    import h5py
+    HAVE_H5PY = True
+except ImportError:
+    HAVE_H5PY = False
+
+
+# This run several tests
+@pytest.mark.skipif(not HDSortSorter.is_installed(), reason='hdsort not installed')
+class HDSortCommonTestSuite(SorterCommonTestSuite, unittest.TestCase):
+    SorterClass = HDSortSorter
+
+
+@pytest.mark.skipif(not HAVE_H5PY, reason='h5py not installed')
+def test_write_hdsort_h5(monkeypatch):
+    folder = Path('test_hdsort_h5')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+
+    recording, _ = se.example_datasets.toy_example(num_channels=4, duration=10, seed=0)
+    # small chunks to check the concatenation
+    for chunk_mb in (0.1, None):
+        file_path = folder / f'recording_{chunk_mb}.h5'
+        write_hdsort_h5(recording, file_path, chunk_mb=chunk_mb)
+        with h5py.File(file_path, 'r') as f:
+            assert np.array_equal(f['ephys/signal'][:], recording.get_traces())
+            assert np.array_equal(f['ephys/frame_numbers'][:], np.arange(recording.get_num_frames()))
+            mapping = f['ephys/mapping'][:]
+            assert np.array_equal(mapping['electrode'], recording.get_channel_ids())
+            assert np.array_equal(mapping['channel'], recording.get_channel_ids())
+            locations = np.array(recording.get_channel_locations())
+            assert np.array_equal(mapping['x'], locations[:, 0])
+            assert np.array_equal(mapping['y'], locations[:, 1])
+
+    # an error of the reader thread is raised by the writer
+    get_traces = recording.get_traces
+
+    def failing_get_traces(channel_ids=None, start_frame=None, end_frame=None, **kwargs):
+        if start_frame is not None and start_frame >= recording.get_num_frames() // 2:
+            raise ValueError('read error')
+        return get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame, **kwargs)
+
+    monkeypatch.setattr(recording, 'get_traces', failing_get_traces)
+    with pytest.raises(ValueError, match='read error'):
+        write_hdsort_h5(recording, folder / 'failing.h5', chunk_mb=0.1)
+
+
+if __name__ == '__main__':
+    HDSortCommonTestSuite().test_on_toy()
+    HDSortCommonTestSuite().test_several_groups()
+    HDSortCommonTestSuite().test_with_BinDatRecordingExtractor()
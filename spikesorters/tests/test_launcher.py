@@ -1,11 +1,15 @@
 import os
 import shutil
 import time
+import json
+from pathlib import Path
 
 import pytest
 import spikeextractors as se
 
-from spikesorters import run_sorters, collect_sorting_outputs
+from spikesorters import run_sorters, iter_run_sorters, run_sorter_sweep, collect_sorting_outputs, KlustaSorter, \
+    CombinatoSorter, RunCatalog
+from spikesorters.launcher import _imap_with_memory_budget, _group_by_setup
 
 
 def test_run_sorters_with_list():
@@ -111,12 +115,180 @@ def test_collect_sorting_outputs():
     results = collect_sorting_outputs(working_folder)
     print(results)
 
+    lazy_results = collect_sorting_outputs(working_folder, lazy=True)
+    assert set(lazy_results.keys()) == set(results.keys())
+    key = list(lazy_results.keys())[0]
+    assert not lazy_results.is_loaded(key)
+    sorting = lazy_results[key]
+    assert lazy_results.is_loaded(key)
+    assert lazy_results[key] is sorting
+    lazy_results.prefetch(n_jobs=2)
+    assert all(lazy_results.is_loaded(key) for key in lazy_results)
+
+
+def test_run_sorter_sweep():
+    rec, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0, dumpable=True)
+
+    output_folder = 'test_run_sorter_sweep'
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder)
+
+    param_grid = {'detect_threshold': [5, 6], 'detect_sign': [-1, 1]}
+    results = run_sorter_sweep('tridesclous', rec, param_grid, output_folder=output_folder, n_jobs=2)
+    assert len(results) == 4
+    sorting = results[(('detect_sign', -1), ('detect_threshold', 5))]
+    assert sorting is not None
+
+    # the setup does not depend on the params: it is done once and the binary is shared by all the points
+    raw_files = [Path(output_folder) / f'params_{i}' / 'raw_signals.raw' for i in range(4)]
+    assert all(raw_file.samefile(raw_files[0]) for raw_file in raw_files)
+    assert not (Path(output_folder) / 'setups').exists()
+    for raw_file in raw_files:
+        with open(raw_file.parent / 'info.json', 'r') as f:
+            info = json.load(f)
+        assert info['datasource_kargs']['filenames'] == [str(raw_file.absolute())]
+    print(results)
+
+
+def test_group_by_setup():
+    params_list = [{'link_raw_file': False, 'detect_threshold': 5}, {'detect_threshold': 6},
+                   {'link_raw_file': True, 'detect_threshold': 5}]
+    # link_raw_file is False by default
+    assert _group_by_setup(CombinatoSorter, params_list) == [[0, 1], [2]]
+
+
+def test_run_catalog():
+    rec0, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0)
+    rec1, _ = se.example_datasets.toy_example(num_channels=8, duration=30, seed=0)
+
+    recording_dict = {'toy_tetrode': rec0, 'toy_octotrode': rec1}
+    working_folder = 'test_run_sorters_catalog'
+    if os.path.exists(working_folder):
+        shutil.rmtree(working_folder)
+
+    results = run_sorters(['tridesclous'], recording_dict, working_folder)
+
+    catalog = RunCatalog(working_folder)
+    assert len(catalog.done()) == 2
+    assert len(catalog.failed()) == 0
+    run = catalog.get('toy_tetrode', 'tridesclous')
+    assert run['run_time'] > 0
+    assert run['num_units'] == len(results[('toy_tetrode', 'tridesclous')].get_unit_ids())
+    assert run['output_size'] is None
+    assert catalog.get_output_size(run['rec_name'], run['sorter_name']) > 0
+    assert catalog.slowest(n=1)[0]['run_time'] >= run['run_time']
+
+    # a new catalog is rebuilt from the folders
+    os.remove(os.path.join(working_folder, RunCatalog.filename))
+    catalog = RunCatalog(working_folder)
+    assert len(catalog.done()) == 2
+
+
+def test_iter_run_sorters():
+    rec0, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0)
+    rec1, _ = se.example_datasets.toy_example(num_channels=8, duration=30, seed=0)
+
+    recording_dict = {'toy_tetrode': rec0, 'toy_octotrode': rec1}
+    sorter_list = ['tridesclous']
+    working_folder = 'test_run_sorters_iter'
+    if os.path.exists(working_folder):
+        shutil.rmtree(working_folder)
+
+    results = {}
+    for rec_name, sorter_name, sorting in iter_run_sorters(sorter_list, recording_dict, working_folder):
+        assert isinstance(sorting, se.SortingExtractor)
+        results[(rec_name, sorter_name)] = sorting
+    assert len(results) == 2
+
+
+@pytest.mark.skipif(not KlustaSorter.is_installed(), reason='klusta not installed')
+def test_run_sorters_asyncio():
+    recording_dict = {}
+    for i in range(4):
+        rec, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0)
+        recording_dict['rec_' + str(i)] = rec
+
+    working_folder = 'test_run_sorters_asyncio'
+    if os.path.exists(working_folder):
+        shutil.rmtree(working_folder)
+
+    results = run_sorters(['klusta'], recording_dict, working_folder, engine='asyncio',
+                          engine_kwargs={'max_concurrency': 2})
+    assert len(results) == 4
+
+
+def test_run_sorters_concurrent_futures():
+    recording_dict = {}
+    for i in range(4):
+        rec, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0, dumpable=True)
+        recording_dict['rec_' + str(i)] = rec
+
+    working_folder = 'test_run_sorters_concurrent_futures'
+    if os.path.exists(working_folder):
+        shutil.rmtree(working_folder)
+
+    results = run_sorters(['tridesclous'], recording_dict, working_folder, engine='concurrent_futures',
+                          engine_kwargs={'max_workers': 2})
+    assert len(results) == 4
+
+
+def test_run_sorters_sqlite():
+    recording_dict = {}
+    for i in range(4):
+        rec, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0, dumpable=True)
+        recording_dict['rec_' + str(i)] = rec
+
+    working_folder = 'test_run_sorters_sqlite'
+    if os.path.exists(working_folder):
+        shutil.rmtree(working_folder)
+
+    results = run_sorters(['tridesclous'], recording_dict, working_folder, engine='sqlite',
+                          engine_kwargs={'processes': 2})
+    assert len(results) == 4
+
+    # resume: all the tasks are already done in the queue
+    results = run_sorters(['tridesclous'], recording_dict, working_folder, engine='sqlite', mode='keep')
+    assert len(results) == 4
+
+
+def _sleep_task(arg):
+    name, duration = arg
+    t0 = time.time()
+    time.sleep(duration)
+    return name, t0, time.time()
+
+
+def test_run_with_memory_budget():
+    # 2 big tasks that do not fit together and 2 small ones
+    task_list = [('big0', 1.), ('big1', 1.), ('small0', 0.2), ('small1', 0.2)]
+    task_memory_gb = [3., 3., 0.5, 0.5]
+    outputs = _imap_with_memory_budget(_sleep_task, task_list, task_memory_gb, 4, 4.)
+    intervals = {name: (start, stop) for _, (name, start, stop), _ in outputs}
+    # big1 waits for big0 while the small ones run next to big0
+    assert intervals['big1'][0] >= intervals['big0'][1]
+    assert intervals['small0'][0] < intervals['big0'][1]
+    assert intervals['small1'][0] < intervals['big0'][1]
+
 
 if __name__ == '__main__':
     test_run_sorters_with_list()
 
     test_run_sorters_with_dict()
 
+    test_run_catalog()
+
+    test_iter_run_sorters()
+
+    test_run_sorters_asyncio()
+
+    test_run_sorters_concurrent_futures()
+
+    test_run_sorters_sqlite()
+
+    test_run_sorter_sweep()
+
+    test_run_with_memory_budget()
+
     # test_run_sorters_multiprocessing()
     
     # test_run_sorters_dask()
@@ -0,0 +1,89 @@
+import sys
+import time
+import shutil
+from pathlib import Path
+
+import pytest
+
+from spikesorters.utils.shellscript import ShellScript
+from spikesorters.sorter_tools import SpikeSortingTimeoutError
+
+
+@pytest.mark.skipif('win' in sys.platform and sys.platform != 'darwin', reason='bash script')
+def test_shellscript_resource_usage():
+    folder = Path('test_shellscript')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+
+    shell_script = ShellScript('''
+        #!/bin/bash
+        python -c "import time; x = bytearray(50 * 1024 ** 2); time.sleep(1)"
+    ''', script_path=folder / 'run_test', log_path=folder / 'test.log', resource_interval=0.1)
+    shell_script.start()
+    retcode = shell_script.wait()
+    assert retcode == 0
+
+    usage = shell_script.resource_usage
+    assert usage is not None
+    for key in ('peak_rss_mb', 'cpu_time_s', 'read_bytes', 'write_bytes', 'max_threads'):
+        assert key in usage
+    if usage['source'] == 'proc':
+        assert usage['peak_rss_mb'] > 50
+    assert (folder / 'test_resources.json').is_file()
+
+
+@pytest.mark.skipif('win' in sys.platform and sys.platform != 'darwin', reason='bash script')
+def test_shellscript_non_blocking_start():
+    folder = Path('test_shellscript')
+    folder.mkdir(exist_ok=True)
+
+    shell_scripts = []
+    t0 = time.perf_counter()
+    for i in range(3):
+        shell_script = ShellScript(f'''
+            #!/bin/bash
+            echo start {i}
+            sleep 1
+            echo stop {i}
+        ''', script_path=folder / f'run_sleep_{i}', log_path=folder / f'sleep_{i}.log')
+        shell_script.start()
+        shell_scripts.append(shell_script)
+    # the 3 scripts run at the same time
+    assert time.perf_counter() - t0 < 1
+    for shell_script in shell_scripts:
+        assert shell_script.wait() == 0
+    assert time.perf_counter() - t0 < 2.5
+
+    with open(folder / 'sleep_0.log', 'r') as f:
+        lines = f.readlines()
+    assert len(lines) == 2
+    assert lines[0].startswith('[') and lines[0].strip().endswith('start 0')
+
+
+@pytest.mark.skipif('win' in sys.platform and sys.platform != 'darwin', reason='bash script')
+def test_shellscript_timeout():
+    folder = Path('test_shellscript')
+    folder.mkdir(exist_ok=True)
+
+    # the child process is in the process group of the script and is stopped too
+    for kwargs in ({'timeout': 2}, {'inactivity_timeout': 2}):
+        shell_script = ShellScript('''
+            #!/bin/bash
+            echo start
+            sleep 60
+        ''', script_path=folder / 'run_hung', log_path=folder / 'hung.log', **kwargs)
+        t0 = time.perf_counter()
+        shell_script.start()
+        with pytest.raises(SpikeSortingTimeoutError):
+            shell_script.wait()
+        assert time.perf_counter() - t0 < 10
+        with open(folder / 'hung.log', 'r') as f:
+            lines = f.readlines()
+        assert 'TIMEOUT' in lines[-1]
+
+
+if __name__ == '__main__':
+    test_shellscript_resource_usage()
+    test_shellscript_non_blocking_start()
+    test_shellscript_timeout()
@@ -0,0 +1,48 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import spikeextractors as se
+
+from spikesorters import SortingCache, CombinatoSorter
+
+
+def test_sorting_cache():
+    cache_folder = Path('test_sorting_cache')
+    if cache_folder.is_dir():
+        shutil.rmtree(cache_folder)
+
+    recording, sorting_gt = se.example_datasets.toy_example(num_channels=4, duration=10, seed=0, dumpable=True,
+                                                            dump_folder='test_sorting_cache_rec')
+    cache = SortingCache(cache_folder, max_size_gb=None)
+
+    params = {'detect_threshold': 5}
+    key = cache.make_key(recording, CombinatoSorter, params)
+    assert key is not None
+    assert key == cache.make_key(recording, CombinatoSorter, dict(params))
+    assert key != cache.make_key(recording, CombinatoSorter, {'detect_threshold': 6})
+    assert key != cache.make_key(recording, CombinatoSorter, params, grouping_property='group')
+
+    assert cache.get(key) is None
+    for unit_id in sorting_gt.get_unit_ids():
+        sorting_gt.set_unit_property(unit_id, 'quality', 'good')
+        sorting_gt.set_unit_property(unit_id, 'group', np.int64(0))
+        sorting_gt.set_unit_property(unit_id, 'template', np.zeros(4))
+    cache.put(key, sorting_gt)
+    sorting = cache.get(key)
+    assert sorting is not None
+    assert np.array_equal(sorting.get_unit_ids(), sorting_gt.get_unit_ids())
+    for unit_id in sorting.get_unit_ids():
+        assert np.array_equal(sorting.get_unit_spike_train(unit_id), sorting_gt.get_unit_spike_train(unit_id))
+        assert sorting.get_unit_property(unit_id, 'quality') == 'good'
+        assert sorting.get_unit_property(unit_id, 'group') == 0
+        assert sorting.get_unit_property(unit_id, 'template') == [0.] * 4
+
+    # a zero size cap evicts everything
+    cache.max_size_gb = 0
+    cache.evict()
+    assert cache.get(key) is None
+
+
+if __name__ == '__main__':
+    test_sorting_cache()
@@ -0,0 +1,36 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import spikeextractors as se
+
+from spikesorters.spike_store import write_spike_store, SpikeStoreSortingExtractor
+
+
+def test_spike_store():
+    folder = Path('test_spike_store')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+
+    _, sorting = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0)
+    for unit_id in sorting.get_unit_ids():
+        sorting.set_unit_property(unit_id, 'quality', 'good')
+    write_spike_store(sorting, folder)
+
+    sorting_store = SpikeStoreSortingExtractor(folder)
+    assert sorting_store.get_unit_ids() == list(sorting.get_unit_ids())
+    assert sorting_store.get_sampling_frequency() == sorting.get_sampling_frequency()
+    for unit_id in sorting.get_unit_ids():
+        spike_train = np.sort(sorting.get_unit_spike_train(unit_id))
+        assert np.array_equal(sorting_store.get_unit_spike_train(unit_id), spike_train)
+        assert np.array_equal(sorting_store.get_unit_spike_train(unit_id, start_frame=1000, end_frame=50000),
+                              spike_train[(spike_train >= 1000) & (spike_train < 50000)])
+        assert sorting_store.get_unit_property(unit_id, 'quality') == 'good'
+
+    # the extractor can be dumped and loaded
+    sorting_loaded = se.load_extractor_from_dict(sorting_store.dump_to_dict())
+    assert sorting_loaded.get_unit_ids() == sorting_store.get_unit_ids()
+
+
+if __name__ == '__main__':
+    test_spike_store()
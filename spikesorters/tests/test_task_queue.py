@@ -0,0 +1,78 @@
+import time
+import shutil
+from pathlib import Path
+
+from spikesorters import TaskQueue
+
+
+def test_task_queue():
+    folder = Path('test_task_queue')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+
+    task_queue = TaskQueue(folder / 'tasks.sqlite')
+    task_queue.add_tasks(['a', 'b'], [{'name': 'a'}, {'name': 'b'}])
+    # already in the queue
+    task_queue.add_tasks(['a'], [{'name': 'a'}])
+    assert task_queue.count('pending') == 2
+
+    task_id, task = task_queue.claim('worker0')
+    assert task == {'name': 'a'}
+    task_queue.finish(task_id)
+    task_id, task = task_queue.claim('worker0')
+    task_queue.finish(task_id, error='Traceback')
+    assert task_queue.claim('worker0') is None
+
+    states = task_queue.get_states()
+    assert states['a'] == ('done', None)
+    assert states['b'] == ('failed', 'Traceback')
+
+    # the state is kept in the database
+    task_queue = TaskQueue(folder / 'tasks.sqlite')
+    task_queue.reset(('failed',))
+    task_id, task = task_queue.claim('worker1')
+    assert task == {'name': 'b'}
+    # the worker died
+    time.sleep(0.2)
+    assert task_queue.requeue_stale(0.1) == 1
+    assert task_queue.count('pending') == 1
+    summary = task_queue.summary()
+    assert summary[1]['attempts'] == 2
+
+    # the task is claimed again: the worker that lost it can not finish it
+    task_id, task = task_queue.claim('worker2')
+    assert not task_queue.finish(task_id, worker='worker1')
+    assert task_queue.get_states()['b'] == ('running', None)
+    assert task_queue.finish(task_id, worker='worker2')
+    assert task_queue.get_states()['b'] == ('done', None)
+
+
+def test_task_queue_changed_tasks():
+    folder = Path('test_task_queue')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+
+    task_queue = TaskQueue(folder / 'tasks.sqlite')
+    task_queue.add_tasks(['a', 'b', 'c'], [{'params': 1}, {'params': 1}, {'params': 1}])
+    task_id, _ = task_queue.claim('worker0')
+    task_queue.finish(task_id)
+    task_id, _ = task_queue.claim('worker0')
+    task_queue.finish(task_id, error='Traceback')
+
+    # same tasks: nothing changes
+    assert task_queue.add_tasks(['a', 'b', 'c'], [{'params': 1}, {'params': 1}, {'params': 1}]) == 0
+    assert task_queue.get_states()['b'] == ('failed', 'Traceback')
+
+    # new params: the failed and pending tasks are replaced, the done one is kept
+    assert task_queue.add_tasks(['a', 'b', 'c'], [{'params': 2}, {'params': 2}, {'params': 2}]) == 2
+    states = task_queue.get_states()
+    assert states['a'] == ('done', None)
+    assert states['b'] == ('pending', None)
+    assert states['c'] == ('pending', None)
+    _, task = task_queue.claim('worker0')
+    assert task == {'params': 2}
+
+
+if __name__ == '__main__':
+    test_task_queue()
+    test_task_queue_changed_tasks()
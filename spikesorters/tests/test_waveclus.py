@@ -3,10 +3,14 @@ if getpass.getuser() == 'samuel':
     kilosort_path = '/home/samuel/Documents/Spikeinterface/wave_clus/'
     os.environ["WAVECLUS_PATH"] = kilosort_path
 
+import shutil
+from pathlib import Path
 import unittest
 import pytest
+import numpy as np
 import spikeextractors as se
 from spikesorters import WaveClusSorter
+from spikesorters.waveclus.waveclus import HAVE_H5PY, write_mat_v73_channels
 from spikesorters.tests.common_tests import SorterCommonTestSuite
 
 # This run several tests
@@ -15,6 +19,30 @@ class WaveClusCommonTestSuite(SorterCommonTestSuite, unittest.TestCase):
     SorterClass = WaveClusSorter
 
 
+@pytest.mark.skipif(not HAVE_H5PY, reason='h5py not installed')
+def test_write_mat_v73_channels():
+    import h5py
+
+    folder = Path('test_waveclus_mat')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+
+    recording, _ = se.example_datasets.toy_example(num_channels=4, duration=10, seed=0)
+    file_paths = [folder / f'raw{i + 1}.mat' for i in range(recording.get_num_channels())]
+    # small chunks to check the concatenation
+    write_mat_v73_channels(recording, file_paths, chunk_mb=0.1)
+    traces = recording.get_traces()
+    for i, file_path in enumerate(file_paths):
+        with open(file_path, 'rb') as f:
+            header = f.read(128)
+        assert header.startswith(b'MATLAB 7.3 MAT-file') and header[-2:] == b'IM'
+        with h5py.File(file_path, 'r') as f:
+            assert f['data'].shape == (recording.get_num_frames(), 1)
+            assert np.array_equal(f['data'][:, 0], traces[i])
+            assert f['sr'][0, 0] == recording.get_sampling_frequency()
+
+
 if __name__ == '__main__':
     WaveClusCommonTestSuite().test_on_toy()
     WaveClusCommonTestSuite().test_several_groups()
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import shutil
+from pathlib import Path
+
+import pytest
+import spikeextractors as se
+
+from spikesorters import run_sorters
+from spikesorters.sorter_tools import SpikeSortingError
+from spikesorters.launcher import _iter_tasks_shared_folder
+from spikesorters.worker import _try_claim, _reclaim_stale_lock, _release_lock, _file_system_time
+
+
+def test_run_sorters_shared_folder():
+    recording_dict = {}
+    for i in range(4):
+        rec, _ = se.example_datasets.toy_example(num_channels=4, duration=30, seed=0, dumpable=True)
+        recording_dict['rec_' + str(i)] = rec
+
+    working_folder = 'test_worker_shared_folder'
+    if os.path.exists(working_folder):
+        shutil.rmtree(working_folder)
+
+    # 2 independent worker processes
+    results = run_sorters(['tridesclous'], recording_dict, working_folder, engine='shared_folder',
+                          engine_kwargs={'processes': 2, 'poll_interval': 0.5})
+    assert len(results) == 4
+    task_folder = Path(working_folder) / 'spikesorters_tasks'
+    assert len(list(task_folder.glob('*.done'))) == 4
+    assert len(list(task_folder.glob('*.lock'))) == 0
+    # the tasks are not run again by the workers of a later call
+    assert len(list(task_folder.glob('*.task'))) == 0
+
+
+@pytest.mark.skipif(shutil.which('false') is None, reason="needs the 'false' command")
+def test_shared_folder_dead_workers(monkeypatch):
+    working_folder = Path('test_worker_dead')
+    if working_folder.is_dir():
+        shutil.rmtree(working_folder)
+    working_folder.mkdir()
+
+    # the local workers exit at once with an error
+    monkeypatch.setattr(sys, 'executable', shutil.which('false'))
+    task_list = [['rec', None, working_folder / 'rec' / 'sorter']]
+    with pytest.raises(SpikeSortingError, match='exit codes'):
+        list(_iter_tasks_shared_folder(task_list, working_folder, processes=2, poll_interval=0.1))
+
+
+def test_reclaim_stale_lock():
+    folder = Path('test_worker_lock')
+    if folder.is_dir():
+        shutil.rmtree(folder)
+    folder.mkdir()
+    lock_path = folder / 'task.lock'
+    done_path = folder / 'task.done'
+
+    assert _try_claim(lock_path, done_path)
+    assert not _try_claim(lock_path, done_path)
+
+    # fresh lock is kept
+    _reclaim_stale_lock(lock_path, 60., _file_system_time(folder))
+    assert lock_path.is_file()
+
+    # lock of a dead worker
+    old_time = time.time() - 120
+    os.utime(str(lock_path), (old_time, old_time))
+    _reclaim_stale_lock(lock_path, 60., _file_system_time(folder))
+    assert not lock_path.is_file()
+    assert _try_claim(lock_path, done_path)
+
+    # a worker does not release the lock of another worker
+    with open(lock_path, 'w') as f:
+        f.write('other-node 1234')
+    _release_lock(lock_path)
+    assert lock_path.is_file()
+    lock_path.unlink()
+    assert _try_claim(lock_path, done_path)
+    _release_lock(lock_path)
+    assert not lock_path.is_file()
+
+
+if __name__ == '__main__':
+    test_run_sorters_shared_folder()
+    test_reclaim_stale_lock()
@@ -4,6 +4,7 @@ import shutil
 import numpy as np
 import copy
 import time
+import json
 from pprint import pprint
 
 import distutils.version
@@ -30,6 +31,12 @@ class TridesclousSorter(BaseSorter):
     sorter_name = 'tridesclous'
     requires_locations = False
     compatible_with_parallel = {'loky': True, 'multiprocessing': False, 'threading': False}
+    memory_factor = 1.5
+    export_file_name = 'raw_signals.raw'
+    export_dtype = 'float32'
+    # chunk_mb and n_jobs_bin only change how the binary is written
+    setup_params = []
+    setup_data_files = ['raw_signals.raw']
 
     _default_params = {
         'freq_min': 400.,
@@ -87,7 +94,6 @@ class TridesclousSorter(BaseSorter):
     def _setup_recording(self, recording, output_folder):
         # reset the output folder
         output_folder.mkdir(parents=True, exist_ok=True)
-        p = self.params
 
         # save prb file
         # note: only one group here, the split is done in basesorter
@@ -105,9 +111,7 @@ class TridesclousSorter(BaseSorter):
             if self.verbose:
                 print('Local copy of recording')
             # save binary file (chunk by hcunk) into a new file
-            raw_filename = output_folder / 'raw_signals.raw'
-            recording.write_to_binary_dat_format(raw_filename, time_axis=0, dtype='float32', chunk_mb=p["chunk_mb"],
-                                                 n_jobs=p["n_jobs_bin"], verbose=self.verbose)
+            raw_filename = self._export_binary(recording, output_folder / 'raw_signals.raw', dtype='float32')
             dtype = 'float32'
             offset = 0
 
@@ -122,6 +126,18 @@ class TridesclousSorter(BaseSorter):
         if self.verbose:
             print(tdc_dataio)
 
+    def _relocate_setup(self, setup_folder, output_folder):
+        # the DataIO keeps the absolute path of the raw file exported in the setup folder
+        info_file = output_folder / 'info.json'
+        with open(str(info_file), 'r', encoding='utf8') as f:
+            info = json.load(f)
+        datasource_kargs = info['datasource_kargs']
+        datasource_kargs['filenames'] = [str(output_folder / Path(filename).name)
+                                         if Path(filename).parent == setup_folder else filename
+                                         for filename in datasource_kargs['filenames']]
+        with open(str(info_file), 'w', encoding='utf8') as f:
+            json.dump(info, f, indent=4)
+
     def _run(self, recording, output_folder):
         recording = recover_recording(recording)
         tdc_dataio = tdc.DataIO(dirname=str(output_folder))
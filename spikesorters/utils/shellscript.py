@@ -6,14 +6,28 @@ import os
 from pathlib import Path
 import time
 import sys
-from typing import Optional, List, Any, Union
+import json
+import threading
+import datetime
+from typing import Optional, List, Any, Union, Dict
+
+try:
+    import resource
+
+    HAVE_RESOURCE = True
+except ImportError:
+    HAVE_RESOURCE = False
+
+from ..sorter_tools import SpikeSortingTimeoutError
 
 PathType = Union[str, Path]
 
 
 class ShellScript():
     def __init__(self, script: str, script_path: Optional[PathType] = None, log_path: Optional[PathType] = None,
-                 keep_temp_files: bool = False, verbose: bool = False):
+                 keep_temp_files: bool = False, verbose: bool = False, resource_interval: Optional[float] = 1.,
+                 flush_interval: float = 2., timeout: Optional[float] = None,
+                 inactivity_timeout: Optional[float] = None):
         lines = script.splitlines()
         lines = self._remove_initial_blank_lines(lines)
         if len(lines) > 0:
@@ -35,6 +49,25 @@ class ShellScript():
         self._start_time: Optional[float] = None
         self._verbose = verbose
         self._executable_script = True
+        self._script_log_path: Optional[Path] = None
+        # the output is written to the log by a background thread, flushed every flush_interval s
+        self._flush_interval = flush_interval
+        self._log_reader: Optional[threading.Thread] = None
+        self._last_output_time: Optional[float] = None
+        # resources used by the process tree, sampled every resource_interval s (None to disable)
+        self._resource_interval = resource_interval
+        self._resource_monitor = None
+        self._resource_stop = threading.Event()
+        self._rusage_start = None
+        self.resource_usage: Optional[Dict[str, Any]] = None
+        # the script is stopped when running longer than timeout s or when it does not
+        # write any output for inactivity_timeout s (None to disable)
+        self._timeout = timeout
+        self._inactivity_timeout = inactivity_timeout
+        self._watchdog_stop = threading.Event()
+        self._new_session = False
+        self._timeout_logged = False
+        self.timeout_reason: Optional[str] = None
 
     def __del__(self):
         self.cleanup()
@@ -92,23 +125,133 @@ class ShellScript():
                 # cmd = ["sh", str(script_path)]
         print(f'RUNNING SHELL SCRIPT: {cmd}')
         self._start_time = time.time()
+        self._script_log_path = script_log_path
+        if HAVE_RESOURCE:
+            self._rusage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # with a watchdog, the script runs in its own process group so that stop() also reaches
+        # the programs it launched (e.g. matlab)
+        self._new_session = self._has_watchdog() and os.name == 'posix'
         self._process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1,
-                                         universal_newlines=True)
+                                         universal_newlines=True, start_new_session=self._new_session)
+        if self._resource_interval is not None:
+            self._resource_monitor = _ResourceMonitor(self._process.pid)
+            self._resource_stop.clear()
+            threading.Thread(target=self._monitor_resources, daemon=True).start()
+        self._last_output_time = time.time()
+        self._log_reader = threading.Thread(target=self._read_output, args=(script_log_path,), daemon=True)
+        self._log_reader.start()
+        if self._has_watchdog():
+            self._watchdog_stop.clear()
+            threading.Thread(target=self._watchdog, daemon=True).start()
+
+    def _has_watchdog(self) -> bool:
+        return self._timeout is not None or self._inactivity_timeout is not None
+
+    def _watchdog(self) -> None:
+        while not self._watchdog_stop.wait(1.) and self.isRunning():
+            if self._timeout is not None and self.elapsedTimeSinceStart() > self._timeout:
+                self.timeout_reason = f'running for more than {self._timeout} s'
+            elif self._inactivity_timeout is not None and self.secondsSinceLastOutput() > self._inactivity_timeout:
+                self.timeout_reason = f'no output for more than {self._inactivity_timeout} s'
+            if self.timeout_reason is not None:
+                print(f'STOPPING SHELL SCRIPT: {self.timeout_reason}')
+                self.stop()
+                return
+
+    def _read_output(self, script_log_path: Path) -> None:
+        last_flush = time.time()
         with open(script_log_path, 'w+') as script_log_file:
             for line in self._process.stdout:
-                script_log_file.write(line)
+                now = time.time()
+                self._last_output_time = now
+                timestamp = datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+                script_log_file.write(f'[{timestamp}] {line}')
                 if self._verbose:  # Print onto console depending on the verbose property passed on from the sorter class
-                    print(line)
+                    print(line, end='')
+                if now - last_flush > self._flush_interval:
+                    script_log_file.flush()
+                    last_flush = now
+        self._process.stdout.close()
 
     def wait(self, timeout=None) -> Optional[int]:
         if not self.isRunning():
+            if self.isFinished():
+                self._on_finished()
             return self.returnCode()
         assert self._process is not None, "Unexpected self._process is None even though it is running."
         try:
             retcode = self._process.wait(timeout=timeout)
-            return retcode
         except:
             return None
+        self._on_finished()
+        return retcode
+
+    def _raise_if_timed_out(self) -> None:
+        if self.timeout_reason is None:
+            return
+        message = f'TIMEOUT: shell script stopped, {self.timeout_reason}'
+        if self._timeout_logged:
+            raise SpikeSortingTimeoutError(message)
+        self._timeout_logged = True
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        if self._script_log_path is not None:
+            with open(self._script_log_path, 'a') as f:
+                f.write(f'[{timestamp}] {message}\n')
+        raise SpikeSortingTimeoutError(message)
+
+    def _join_log_reader(self) -> None:
+        # the output can still be read after the process exit
+        if self._log_reader is not None:
+            self._log_reader.join()
+            self._log_reader = None
+
+    def secondsSinceLastOutput(self) -> Optional[float]:
+        if self._last_output_time is None:
+            return None
+        return time.time() - self._last_output_time
+
+    def _monitor_resources(self):
+        while not self._resource_stop.is_set() and self._process.poll() is None:
+            self._resource_monitor.sample()
+            self._resource_stop.wait(self._resource_interval)
+
+    def _on_finished(self) -> None:
+        self._join_log_reader()
+        self._watchdog_stop.set()
+        self._finalize_resource_usage()
+        self._raise_if_timed_out()
+
+    def _finalize_resource_usage(self) -> None:
+        if self.resource_usage is not None:
+            return
+        self._resource_stop.set()
+        usage = None
+        if self._resource_monitor is not None and self._resource_monitor.available:
+            usage = self._resource_monitor.usage()
+        elif HAVE_RESOURCE and self._rusage_start is not None:
+            # no /proc: children of the whole python process since start (includes concurrent scripts)
+            rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            maxrss = rusage.ru_maxrss / 1024 if sys.platform != 'darwin' else rusage.ru_maxrss / 1024 ** 2
+            usage = {
+                'source': 'rusage',
+                'peak_rss_mb': maxrss,
+                'cpu_time_s': (rusage.ru_utime - self._rusage_start.ru_utime) +
+                              (rusage.ru_stime - self._rusage_start.ru_stime),
+                'read_bytes': (rusage.ru_inblock - self._rusage_start.ru_inblock) * 512,
+                'write_bytes': (rusage.ru_oublock - self._rusage_start.ru_oublock) * 512,
+                'max_threads': None,
+            }
+        if usage is None:
+            return
+        usage['elapsed_time_s'] = self.elapsedTimeSinceStart()
+        self.resource_usage = usage
+        if self._script_log_path is not None:
+            resource_path = self._script_log_path.parent / (self._script_log_path.stem + '_resources.json')
+            try:
+                with open(resource_path, 'w') as f:
+                    json.dump(usage, f, indent=4)
+            except OSError:
+                pass
 
     def cleanup(self) -> None:
         if self._keep_temp_files:
@@ -124,19 +267,28 @@ class ShellScript():
         signals = [signal.SIGINT] * 10 + [signal.SIGTERM] * 10 + [signal.SIGKILL] * 10
 
         for signal0 in signals:
-            self._process.send_signal(signal0)
+            self._send_signal(signal0)
             try:
                 self._process.wait(timeout=0.02)
                 return
             except:
                 pass
 
+    def _send_signal(self, sig) -> None:
+        if self._new_session:
+            try:
+                os.killpg(self._process.pid, sig)
+            except ProcessLookupError:
+                pass
+        else:
+            self._process.send_signal(sig)
+
     def kill(self) -> None:
         if not self.isRunning():
             return
 
         assert self._process is not None, "Unexpected self._process is None even though it is running."
-        self._process.send_signal(signal.SIGKILL)
+        self._send_signal(signal.SIGKILL)
         try:
             self._process.wait(timeout=1)
         except:
@@ -148,7 +300,7 @@ class ShellScript():
             return True
 
         assert self._process is not None, "Unexpected self._process is None even though it is running."
-        self._process.send_signal(sig)
+        self._send_signal(sig)
         try:
             self._process.wait(timeout=timeout)
             return True
@@ -196,6 +348,101 @@ class ShellScript():
         return ii
 
 
+class _ResourceMonitor:
+    """
+    Samples the resources of a process and of all its descendants through /proc (linux only).
+
+    Values are approximations: processes living less than a sampling interval are missed,
+    and cpu time and io of a process are kept from its last sample.
+    """
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.available = Path('/proc/self/stat').is_file()
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if self.available else 4096
+        self._clock_ticks = os.sysconf('SC_CLK_TCK') if self.available else 100
+        self._cpu_ticks = {}
+        self._root_cpu_ticks = 0
+        self._io = {}
+        self.peak_rss = 0
+        self.max_threads = 0
+
+    def sample(self) -> None:
+        if not self.available:
+            return
+        stats = {}
+        for proc_dir in Path('/proc').iterdir():
+            if not proc_dir.name.isdigit():
+                continue
+            stat = _read_proc_stat(proc_dir)
+            if stat is not None:
+                stats[int(proc_dir.name)] = stat
+        children = {}
+        for pid, stat in stats.items():
+            children.setdefault(stat['ppid'], []).append(pid)
+        tree = []
+        to_visit = [self.pid]
+        while len(to_visit) > 0:
+            pid = to_visit.pop()
+            if pid in stats:
+                tree.append(pid)
+                to_visit.extend(children.get(pid, []))
+        rss = 0
+        threads = 0
+        for pid in tree:
+            stat = stats[pid]
+            rss += stat['rss']
+            threads += stat['num_threads']
+            self._cpu_ticks[pid] = stat['utime'] + stat['stime']
+            if pid == self.pid:
+                # includes the descendants already waited for
+                self._root_cpu_ticks = stat['utime'] + stat['stime'] + stat['cutime'] + stat['cstime']
+            io = _read_proc_io(pid)
+            if io is not None:
+                self._io[pid] = io
+        self.peak_rss = max(self.peak_rss, rss * self._page_size)
+        self.max_threads = max(self.max_threads, threads)
+
+    def usage(self) -> Dict[str, Any]:
+        cpu_ticks = max(sum(self._cpu_ticks.values()), self._root_cpu_ticks)
+        return {
+            'source': 'proc',
+            'peak_rss_mb': self.peak_rss / 1024 ** 2,
+            'cpu_time_s': cpu_ticks / self._clock_ticks,
+            'read_bytes': sum(io[0] for io in self._io.values()),
+            'write_bytes': sum(io[1] for io in self._io.values()),
+            'max_threads': self.max_threads,
+        }
+
+
+def _read_proc_stat(proc_dir: Path) -> Optional[Dict[str, int]]:
+    try:
+        with open(proc_dir / 'stat', 'r') as f:
+            content = f.read()
+    except OSError:
+        return None
+    # the command name can contain spaces: fields start after the last ')'
+    fields = content[content.rfind(')') + 2:].split()
+    return {
+        'ppid': int(fields[1]),
+        'utime': int(fields[11]),
+        'stime': int(fields[12]),
+        'cutime': int(fields[13]),
+        'cstime': int(fields[14]),
+        'num_threads': int(fields[17]),
+        'rss': int(fields[21]),
+    }
+
+
+def _read_proc_io(pid: int):
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    values = dict(line.split(':') for line in lines if ':' in line)
+    return int(values.get('read_bytes', 0)), int(values.get('write_bytes', 0))
+
+
 def _rmdir_with_retries(dirname, num_retries, delay_between_tries=1):
     for retry_num in range(1, num_retries + 1):
         if not Path(dirname).is_dir():
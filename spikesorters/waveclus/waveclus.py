@@ -3,6 +3,8 @@ import os
 from typing import Union
 import sys
 import copy
+import datetime
+import numpy as np
 from scipy.io import savemat
 
 import spikeextractors as se
@@ -10,6 +12,12 @@ from ..basesorter import BaseSorter
 from ..utils.shellscript import ShellScript
 from ..sorter_tools import recover_recording
 
+try:
+    import h5py
+    HAVE_H5PY = True
+except ImportError:
+    HAVE_H5PY = False
+
 PathType = Union[str, Path]
 
 
@@ -35,6 +43,9 @@ class WaveClusSorter(BaseSorter):
     sorter_name: str = 'waveclus'
     waveclus_path: Union[str, None] = os.getenv('WAVECLUS_PATH', None)
     requires_locations = False
+    memory_base_gb = 2.0
+    setup_params = []
+    setup_data_files = ['raw*.mat']
 
     _default_params = {
         'detect_threshold': 5,
@@ -59,7 +70,8 @@ class WaveClusSorter(BaseSorter):
         'stdmax': 50,
         'max_spk': 40000,
         'ref_ms': 1.5,
-        'interpolation': True
+        'interpolation': True,
+        'chunk_mb': 500
     }
 
     _params_description = {
@@ -88,7 +100,8 @@ class WaveClusSorter(BaseSorter):
         'max_spk': "Maximum number of spikes used by the SPC algorithm",
         'ref_ms': "Refractory time in milliseconds, all the threshold crossing inside this period are detected as the "
                   "same spike",
-        'interpolation': "Enable or disable interpolation to improve the alignments of the spikes"
+        'interpolation': "Enable or disable interpolation to improve the alignments of the spikes",
+        'chunk_mb': "Chunk size in Mb for saving the mat files (default 500Mb)"
     }
 
     sorter_description = """Wave Clus combines a wavelet-based feature extraction and paramagnetic clustering with a 
@@ -137,10 +150,14 @@ class WaveClusSorter(BaseSorter):
 
         output_folder.mkdir(parents=True, exist_ok=True)
         # Generate mat files in the dataset directory
-        for nch, id in enumerate(recording.get_channel_ids()):
-            vcFile_mat = str(output_folder / ('raw' + str(nch + 1) + '.mat'))
-            savemat(vcFile_mat,
-                    {'data': recording.get_traces(channel_ids=[id]), 'sr': recording.get_sampling_frequency()})
+        file_paths = [output_folder / ('raw' + str(nch + 1) + '.mat') for nch in range(recording.get_num_channels())]
+        if HAVE_H5PY:
+            # one pass over the recording for all channels, without the 2GB limit of v5 mat files
+            write_mat_v73_channels(recording, file_paths, chunk_mb=self.params['chunk_mb'])
+        else:
+            for vcFile_mat, id in zip(file_paths, recording.get_channel_ids()):
+                savemat(str(vcFile_mat),
+                        {'data': recording.get_traces(channel_ids=[id]), 'sr': recording.get_sampling_frequency()})
 
     def _run(self, recording, output_folder):
         recording = recover_recording(recording)
@@ -167,6 +184,8 @@ class WaveClusSorter(BaseSorter):
             p['sort_filter_order'] = 0
         del p['enable_sort_filter']
 
+        del p['chunk_mb']
+
         if p['interpolation']:
             p['interpolation'] = 'y'
         else:
@@ -233,7 +252,8 @@ class WaveClusSorter(BaseSorter):
                 matlab -nosplash -nodisplay -log -r run_waveclus
             '''.format(tmpdir=tmpdir)
         shell_cmd = ShellScript(shell_cmd, script_path=output_folder / f'run_{self.sorter_name}',
-                                log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose)
+                                log_path=output_folder / f'{self.sorter_name}.log', verbose=self.verbose,
+                                timeout=self.timeout, inactivity_timeout=self.inactivity_timeout)
         shell_cmd.start()
 
         retcode = shell_cmd.wait()
@@ -252,3 +272,76 @@ class WaveClusSorter(BaseSorter):
         result_fname = str(output_folder / 'times_results.mat')
         sorting = se.WaveClusSortingExtractor(file_path=result_fname)
         return sorting
+
+
+# MATLAB class of the numpy dtypes
+_matlab_classes = {
+    'float64': 'double',
+    'float32': 'single',
+    'int8': 'int8',
+    'int16': 'int16',
+    'int32': 'int32',
+    'int64': 'int64',
+    'uint8': 'uint8',
+    'uint16': 'uint16',
+    'uint32': 'uint32',
+    'uint64': 'uint64',
+}
+
+
+def _write_mat_v73_header(file_path):
+    # the 128 first bytes of the 512 bytes userblock identify a v7.3 mat file for MATLAB
+    now = datetime.datetime.now().strftime('%a %b %d %H:%M:%S %Y')
+    text = f'MATLAB 7.3 MAT-file, Platform: {sys.platform}, Created on: {now} HDF5 schema 1.00 .'
+    header = text.encode('ascii').ljust(116, b' ')[:116] + b'\x00' * 8 + b'\x00\x02' + b'IM'
+    with open(file_path, 'r+b') as f:
+        f.write(header)
+
+
+def write_mat_v73_channels(recording, file_paths, chunk_mb=500):
+    """
+    Writes each channel of recording in a v7.3 (HDF5) mat file with the variables 'data' (1 x num_frames)
+    and 'sr', the sampling frequency.
+
+    The traces are read once, by chunks of all channels, and appended to the 'data' of each file.
+
+    Parameters
+    ----------
+    recording: RecordingExtractor
+        The recording to write
+    file_paths: list
+        One mat file per channel
+    chunk_mb: int
+        Size in Mb of the chunks read from recording
+    """
+    assert len(file_paths) == recording.get_num_channels()
+    num_frames = recording.get_num_frames()
+    dtype = recording.get_traces(start_frame=0, end_frame=1).dtype
+    matlab_class = _matlab_classes[dtype.name]
+    chunk_size = max(1, int(chunk_mb * 1e6 / (recording.get_num_channels() * dtype.itemsize)))
+
+    files = []
+    try:
+        datasets = []
+        for file_path in file_paths:
+            f = h5py.File(str(file_path), mode='w', userblock_size=512)
+            files.append(f)
+            # MATLAB arrays are column-major: a 1 x num_frames array is stored as num_frames x 1
+            dset = f.create_dataset('data', shape=(num_frames, 1), dtype=dtype,
+                                    chunks=(max(1, min(num_frames, chunk_size, 2 ** 20)), 1))
+            dset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+            datasets.append(dset)
+            sr = f.create_dataset('sr', data=np.array([[float(recording.get_sampling_frequency())]]))
+            sr.attrs['MATLAB_class'] = np.bytes_('double')
+
+        for start_frame in range(0, num_frames, chunk_size):
+            end_frame = min(start_frame + chunk_size, num_frames)
+            traces = recording.get_traces(start_frame=start_frame, end_frame=end_frame)
+            for i, dset in enumerate(datasets):
+                dset[start_frame:end_frame, 0] = traces[i]
+    finally:
+        for f in files:
+            f.close()
+
+    for file_path in file_paths:
+        _write_mat_v73_header(file_path)
@@ -0,0 +1,271 @@
+"""
+Worker running the tasks of run_sorters(engine='shared_folder') from a shared working folder.
+
+Start as many workers as needed, on any node seeing the working folder (e.g. NFS):
+
+    python -m spikesorters.worker <working_folder>
+
+The tasks are files of the 'spikesorters_tasks' sub folder of the working folder:
+  * <name>.task : the task (pickle)
+  * <name>.lock : created atomically by the worker running the task, which touches it regularly (heartbeat)
+  * <name>.done : written at the end of the task, json with the worker, timings and error
+
+A lock that was not touched for stale_timeout s belongs to a dead worker and is reclaimed by another worker.
+Times are compared with the clock of the file system, so the clocks of the nodes do not need to be in sync.
+The task files are removed by run_sorters at the end of the call, so tasks of previous calls are not run again.
+"""
+from pathlib import Path
+import os
+import sys
+import json
+import pickle
+import socket
+import argparse
+import threading
+import traceback
+import time
+
+task_folder_name = 'spikesorters_tasks'
+
+
+def get_task_name(output_folder):
+    output_folder = Path(output_folder)
+    return f'{output_folder.parent.name}__{output_folder.name}'
+
+
+def write_tasks(working_folder, task_list):
+    """
+    Writes the tasks of run_sorters in the working folder and returns their names.
+    """
+    task_folder = Path(working_folder) / task_folder_name
+    task_folder.mkdir(parents=True, exist_ok=True)
+    names = []
+    for arg_list in task_list:
+        name = get_task_name(arg_list[2])
+        # a task run again (mode='overwrite') starts from scratch
+        done_path = task_folder / (name + '.done')
+        if done_path.is_file():
+            done_path.unlink()
+        tmp_path = task_folder / (name + '.task_tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(arg_list, f)
+        os.replace(str(tmp_path), str(task_folder / (name + '.task')))
+        names.append(name)
+    return names
+
+
+def read_done(working_folder, name):
+    """
+    Returns the content of the done file of the task or None if the task is not done.
+    """
+    done_path = Path(working_folder) / task_folder_name / (name + '.done')
+    try:
+        with open(done_path, 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_tasks(working_folder, names):
+    """
+    Removes the task files of names so that workers do not run them again. The done files are kept.
+    """
+    task_folder = Path(working_folder) / task_folder_name
+    for name in names:
+        try:
+            (task_folder / (name + '.task')).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def has_running_task(working_folder, names, stale_timeout=60.):
+    """
+    Returns True if a worker (local or on another node) holds the lock of one of the tasks and touched it
+    less than stale_timeout s ago.
+    """
+    task_folder = Path(working_folder) / task_folder_name
+    now = _file_system_time(task_folder)
+    for name in names:
+        try:
+            mtime = (task_folder / (name + '.lock')).stat().st_mtime
+        except OSError:
+            continue
+        if now - mtime < stale_timeout:
+            return True
+    return False
+
+
+def run_worker(working_folder, heartbeat_interval=10., stale_timeout=60., wait=0., poll_interval=5.,
+               verbose=False):
+    """
+    Runs the tasks of the working folder until they are all done.
+
+    Parameters
+    ----------
+    working_folder: str or Path
+        The working folder of run_sorters
+    heartbeat_interval: float
+        Time in s between two touches of the lock of the running task
+    stale_timeout: float
+        Locks not touched for this time in s are reclaimed
+    wait: float
+        When all the tasks are done, wait for new tasks during this time in s before exiting
+    poll_interval: float
+        Time in s between two scans of the task folder when no task can be claimed
+    verbose: bool
+        If True, print the tasks run by the worker
+    """
+    task_folder = Path(working_folder) / task_folder_name
+    idle_since = time.time()
+    while True:
+        names = []
+        if task_folder.is_dir():
+            names = sorted(p.stem for p in task_folder.glob('*.task'))
+        not_done = [name for name in names if not (task_folder / (name + '.done')).is_file()]
+
+        claimed = None
+        if len(not_done) > 0:
+            now = _file_system_time(task_folder)
+            for name in not_done:
+                lock_path = task_folder / (name + '.lock')
+                _reclaim_stale_lock(lock_path, stale_timeout, now)
+                if _try_claim(lock_path, task_folder / (name + '.done')):
+                    claimed = name
+                    break
+
+        if claimed is None:
+            if len(not_done) == 0 and time.time() - idle_since >= wait:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        if verbose:
+            print(f'Running task {claimed}')
+        _run_task(task_folder, claimed, heartbeat_interval)
+        idle_since = time.time()
+
+
+def _worker_id():
+    return f'{socket.gethostname()} {os.getpid()}'
+
+
+def _file_system_time(folder):
+    # the mtime of a file written now, in the clock of the file system
+    clock_path = Path(folder) / ('.clock_' + _worker_id().replace(' ', '_'))
+    with open(clock_path, 'w') as f:
+        f.write('')
+    now = clock_path.stat().st_mtime
+    clock_path.unlink()
+    return now
+
+
+def _try_claim(lock_path, done_path):
+    try:
+        fd = os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(_worker_id())
+    if done_path.is_file():
+        # finished between the scan and the claim
+        lock_path.unlink()
+        return False
+    return True
+
+
+def _owns_lock(lock_path):
+    try:
+        with open(lock_path, 'r') as f:
+            return f.read() == _worker_id()
+    except OSError:
+        return False
+
+
+def _release_lock(lock_path):
+    # a lock reclaimed as stale (e.g. the heartbeat was stuck) belongs to another worker now
+    if _owns_lock(lock_path):
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _reclaim_stale_lock(lock_path, stale_timeout, now):
+    try:
+        mtime = lock_path.stat().st_mtime
+    except FileNotFoundError:
+        return
+    if now - mtime < stale_timeout:
+        return
+    # the rename is atomic: only one worker reclaims the lock
+    stale_path = lock_path.parent / (lock_path.name + '_stale_' + _worker_id().replace(' ', '_'))
+    try:
+        os.rename(str(lock_path), str(stale_path))
+    except FileNotFoundError:
+        return
+    # another worker may have reclaimed and claimed the task again between the stat and the rename
+    if now - stale_path.stat().st_mtime < stale_timeout:
+        try:
+            os.link(str(stale_path), str(lock_path))
+        except OSError:
+            pass
+    stale_path.unlink()
+
+
+def _run_task(task_folder, name, heartbeat_interval):
+    from .launcher import _run_one
+
+    lock_path = task_folder / (name + '.lock')
+    heartbeat_stop = threading.Event()
+
+    def send_heartbeat():
+        while not heartbeat_stop.wait(heartbeat_interval):
+            if not _owns_lock(lock_path):
+                continue
+            try:
+                os.utime(str(lock_path), None)
+            except OSError:
+                pass
+
+    heartbeat_thread = threading.Thread(target=send_heartbeat, daemon=True)
+    heartbeat_thread.start()
+    start_time = time.time()
+    try:
+        with open(task_folder / (name + '.task'), 'rb') as f:
+            arg_list = pickle.load(f)
+        _run_one(arg_list)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        heartbeat_stop.set()
+        heartbeat_thread.join()
+
+    done = {
+        'worker': _worker_id(),
+        'start_time': start_time,
+        'end_time': time.time(),
+        'error': error,
+    }
+    tmp_path = task_folder / (name + '.done_tmp')
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(done, f, indent=4)
+    os.replace(str(tmp_path), str(task_folder / (name + '.done')))
+    _release_lock(lock_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the tasks of run_sorters(engine="shared_folder")')
+    parser.add_argument('working_folder', help='working folder of run_sorters')
+    parser.add_argument('--heartbeat-interval', type=float, default=10.)
+    parser.add_argument('--stale-timeout', type=float, default=60.)
+    parser.add_argument('--wait', type=float, default=0., help='wait for new tasks during this time (s)')
+    parser.add_argument('--poll-interval', type=float, default=5.)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    run_worker(args.working_folder, heartbeat_interval=args.heartbeat_interval, stale_timeout=args.stale_timeout,
+               wait=args.wait, poll_interval=args.poll_interval, verbose=args.verbose)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
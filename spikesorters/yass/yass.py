@@ -25,6 +25,9 @@ class YassSorter(BaseSorter):
 
     sorter_name = 'yass'
     requires_locations = False
+    memory_base_gb = 2.0
+    memory_factor = 2.0
+    export_file_name = 'data.bin'
 
     # #################################################
 
@@ -181,11 +184,10 @@ class YassSorter(BaseSorter):
         #################### SAVE RAW INT16 data ########################
         #################################################################
         input_file_path = os.path.join(output_folder, 'data.bin')
-        recording.write_to_binary_dat_format(input_file_path,
-                                             dtype='int16',  # HARD CODE THIS FOR YASS
-                                             chunk_mb=p["chunk_mb"],
-                                             n_jobs=p["n_jobs_bin"],
-                                             verbose=self.verbose)
+        input_file_path = self._export_binary(recording, input_file_path,
+                                              dtype='int16')  # HARD CODE THIS FOR YASS
+        # absolute path when the shared export could not be linked in the output folder
+        self.yass_params['data']['recordings'] = str(input_file_path)
 
         retrain = False
         if self.params['neural_nets_path'] is None:
@@ -288,7 +290,8 @@ class YassSorter(BaseSorter):
         shell_script = ShellScript(shell_cmd,
                                    script_path=os.path.join(output_folder, self.sorter_name),
                                    log_path=os.path.join(output_folder, self.sorter_name + '.log'),
-                                   verbose=self.verbose)
+                                   verbose=self.verbose, timeout=self.timeout,
+                                   inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()
@@ -321,7 +324,8 @@ class YassSorter(BaseSorter):
         shell_script = ShellScript(shell_cmd,
                                    script_path=os.path.join(output_folder, self.sorter_name),
                                    log_path=os.path.join(output_folder, self.sorter_name + '.log'),
-                                   verbose=self.verbose)
+                                   verbose=self.verbose, timeout=self.timeout,
+                                   inactivity_timeout=self.inactivity_timeout)
         shell_script.start()
 
         retcode = shell_script.wait()